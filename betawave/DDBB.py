@@ -1,6 +1,9 @@
+import logging
 import sqlite3
 from werkzeug.security import generate_password_hash, check_password_hash
 
+logger = logging.getLogger(__name__)
+
 def init_db():
     conn = sqlite3.connect('music.db')
     c = conn.cursor()
@@ -131,7 +134,8 @@ def is_favorite(user_id, song_id):
     return result
 
 def delete_user(user_id):
-    conn = sqlite3.connect('music.db')
+    from db import get_db
+    conn = get_db()
     c = conn.cursor()
     try:
         # Delete user's favorites
@@ -149,7 +153,6 @@ def delete_user(user_id):
         conn.commit()
         return True
     except Exception as e:
-        print(f"Error deleting user: {e}")
-        return False
-    finally:
-        conn.close()
\ No newline at end of file
+        logger.debug("delete_user failed user_id=%s: %s", user_id, e)
+        conn.rollback()
+        return False
\ No newline at end of file
@@ -1,221 +1,673 @@
-from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for, session, flash
+from flask import Blueprint, Flask, Response, current_app, g, render_template, request, jsonify, send_file, redirect, url_for, session, flash
 from functools import wraps
 import sqlite3
-from werkzeug.security import generate_password_hash, check_password_hash
-import yt_dlp
-import tempfile
+import urllib3
 import os
-import traceback
+import shutil
+import hashlib
+import logging
+import math
+import re
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+import assets
+import db
+import events
+import log_config
+import metrics
+import migrations
+import passwords
+import sessions
+from db import get_db
+from stream_cache import StreamCache, StreamStore
+import jobs
+from events import EventBus, TooManySubscribersError
+from passwords import PasswordPolicy
+from ratelimit import AttemptLimiter
+from jobs import JobQueue, JobStore, QueueFullError
+from transcode_cache import TranscodeCache
 
-app = Flask(__name__)
-app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'tu_clave_secreta_super_segura')
+# Importar este módulo no crea nada: la aplicación se construye con
+# create_app() (ver wsgi.py) y yt_dlp se carga la primera vez que se usa.
 
-# Ensure data directory exists
-data_dir = Path('data')
-data_dir.mkdir(exist_ok=True)
+logger = logging.getLogger('betawave')
+bp = Blueprint('main', __name__)
 
-# Database configuration
-app.config['DATABASE'] = os.environ.get('DATABASE_PATH', str(data_dir / 'music.db'))
+# Métricas del proceso, expuestas en /metrics (ver metrics.py)
+registry = metrics.Registry()
+QUERY_LATENCY = registry.histogram('betawave_db_query_duration_seconds',
+                                   'SQLite latency by data-access function', ['query'])
+YTDLP_LATENCY = registry.histogram('betawave_ytdlp_duration_seconds', 'yt-dlp extract_info latency',
+                                   ['operation'], buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+YTDLP_ERRORS = registry.counter('betawave_ytdlp_errors_total', 'yt-dlp extract_info errors', ['operation'])
+PASSWORD_HASH_LATENCY = registry.histogram('betawave_password_hash_duration_seconds',
+                                          'Password hashing and verification latency', ['operation'])
+LOGIN_THROTTLED = registry.counter('betawave_login_throttled_total', 'Login attempts rejected by the limiter',
+                                   ['reason'])
+VIDEO_METADATA_LOOKUPS = registry.counter('betawave_video_metadata_lookups_total',
+                                          'video_metadata lookups by result', ['result'])
 
-# Static files configuration
-app.static_folder = 'static'
-app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0  # Disable cache for development
-app.config['STATIC_FOLDER'] = app.static_folder
+# Proxy de audio
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_PASSTHROUGH_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges')
+
+# Precarga en segundo plano de las siguientes canciones
+PREFETCH_MAX_SONGS = 5
+
+# Descargas: la conversión con FFmpeg se hace fuera de la petición
+DOWNLOAD_FORMATS = ('mp3', 'wav', 'aac', 'flac', 'm4a', 'opus', 'vorbis')
+# Extensión del fichero que deja FFmpegExtractAudio para cada códec (ACODECS de yt-dlp)
+DOWNLOAD_EXTENSIONS = {'aac': 'm4a', 'vorbis': 'ogg'}
+DOWNLOAD_QUALITY = '192'
+
+# Importación masiva de canciones
+IMPORT_MAX_SONGS = 500
+
+# Paginación de la búsqueda y de las listas
+SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_PAGE_SIZE = 200
+LIST_MAX_PAGE_SIZE = 500
+ADMIN_PAGE_SIZE = 50
+ADMIN_MAX_PAGE_SIZE = 200
+
+# Columnas por las que se puede ordenar el listado de usuarios del panel, con
+# su desempate: cada par recorre un índice (ver migrations.py)
+ADMIN_USER_SORTS = {
+    'created': ('u.created_at', 'u.id'),
+    'username': ('u.username COLLATE NOCASE', 'u.id'),
+    'songs': ('st.songs_count', 'st.user_id'),
+    'favorites': ('st.favorites_count', 'st.user_id'),
+}
+ADMIN_ROLES = ('user', 'admin')
+
+# Borrado masivo de usuarios: usuarios por transacción, para no retener el
+# bloqueo de escritura mientras se borran en cascada sus canciones
+ADMIN_DELETE_CHUNK = 100
+
+# Sincronización incremental: con más cambios sale más a cuenta recargar todo
+CHANGES_MAX_SONGS = 500
+
+def default_config():
+    """
+    Configuración a partir de las variables de entorno. Se lee al crear la
+    aplicación, no al importar el módulo
+    """
+    env = os.environ.get
+    data_dir = env('DATA_DIR', 'data')
+    return {
+        'SECRET_KEY': env('FLASK_SECRET_KEY', 'tu_clave_secreta_super_segura'),
+        'DATABASE': env('DATABASE_PATH', os.path.join(data_dir, 'music.db')),
+        'SEND_FILE_MAX_AGE_DEFAULT': 0,  # /static sin hash (ver assets.py)
+        # Logging: LOG_FORMAT=json|text y muestreo de INFO/DEBUG
+        'LOG_LEVEL': env('LOG_LEVEL', 'INFO'),
+        'LOG_FORMAT': env('LOG_FORMAT', 'json'),
+        'LOG_SAMPLE_RATE': float(env('LOG_SAMPLE_RATE', 1.0)),
+        'METRICS_ALLOWED_ADDRS': set(env('METRICS_ALLOWED_ADDRS', '127.0.0.1,::1').split(',')),
+        # Con varios workers, directorio donde cada uno vuelca sus métricas para
+        # sumarlas en /metrics (lo fija gunicorn.conf.py). Sin él, solo las del proceso
+        'METRICS_DIR': env('METRICS_DIR') or None,
+        'METRICS_FLUSH_INTERVAL': float(env('METRICS_FLUSH_INTERVAL', metrics.DEFAULT_FLUSH_INTERVAL)),
+        # Caché de URLs de audio ya resueltas por yt-dlp
+        'STREAM_CACHE_SIZE': int(env('STREAM_CACHE_SIZE', 512)),
+        'STREAM_CACHE_TTL': int(env('STREAM_CACHE_TTL', 3600)),
+        'STREAM_POOL_SIZE': int(env('STREAM_POOL_SIZE', 10)),
+        'PREFETCH_WORKERS': int(env('PREFETCH_WORKERS', 2)),
+        'DOWNLOAD_WORKERS': int(env('DOWNLOAD_WORKERS', 2)),
+        'DOWNLOAD_MAX_PENDING': int(env('DOWNLOAD_MAX_PENDING', 20)),
+        # Segundos que un worker que se para espera a sus trabajos en marcha.
+        # Debe ser menor que el graceful_timeout de gunicorn
+        'JOBS_SHUTDOWN_TIMEOUT': float(env('JOBS_SHUTDOWN_TIMEOUT', 20)),
+        'DOWNLOAD_CACHE_DIR': env('DOWNLOAD_CACHE_DIR', os.path.join(data_dir, 'download_cache')),
+        'DOWNLOAD_CACHE_MAX_MB': int(env('DOWNLOAD_CACHE_MAX_MB', 2048)),
+        # Importaciones a la vez por proceso, en cola y hilos de extracción de cada una
+        'IMPORT_JOBS': int(env('IMPORT_JOBS', 1)),
+        'IMPORT_MAX_PENDING': int(env('IMPORT_MAX_PENDING', 10)),
+        'IMPORT_WORKERS': int(env('IMPORT_WORKERS', 4)),
+        # Metadatos de vídeos: pasado este tiempo se vuelven a pedir a YouTube
+        'VIDEO_METADATA_MAX_AGE': int(env('VIDEO_METADATA_MAX_AGE', 30 * 24 * 3600)),
+        # Registro de cambios de /api/changes: lo más antiguo se borra al arrancar
+        'LIBRARY_CHANGES_MAX_AGE': int(env('LIBRARY_CHANGES_MAX_AGE', 30 * 24 * 3600)),
+        # Sesiones en SQLite con una caché por proceso: un cambio hecho en otro
+        # proceso (revocación, rol) tarda como mucho SESSION_CACHE_TTL segundos
+        'SESSION_CACHE_SIZE': int(env('SESSION_CACHE_SIZE', sessions.DEFAULT_CACHE_SIZE)),
+        'SESSION_CACHE_TTL': float(env('SESSION_CACHE_TTL', sessions.DEFAULT_CACHE_TTL)),
+        # Contraseñas: método con parámetros explícitos (ver passwords.py) y
+        # cuántos hashes a la vez por proceso
+        'PASSWORD_HASH_METHOD': env('PASSWORD_HASH_METHOD', passwords.DEFAULT_METHOD),
+        'PASSWORD_SALT_LENGTH': int(env('PASSWORD_SALT_LENGTH', passwords.DEFAULT_SALT_LENGTH)),
+        'PASSWORD_HASH_CONCURRENCY': int(env('PASSWORD_HASH_CONCURRENCY', 1)),
+        # Límite de fallos de inicio de sesión por IP y por usuario
+        'LOGIN_MAX_FAILURES_PER_IP': int(env('LOGIN_MAX_FAILURES_PER_IP', 20)),
+        'LOGIN_MAX_FAILURES_PER_USER': int(env('LOGIN_MAX_FAILURES_PER_USER', 5)),
+        'LOGIN_ATTEMPT_WINDOW': int(env('LOGIN_ATTEMPT_WINDOW', 300)),
+        # /api/events: cada conexión ocupa un hilo del worker mientras dura,
+        # así que por defecto se deja al menos la mitad para lo demás
+        'EVENTS_MAX_SUBSCRIBERS': int(env('EVENTS_MAX_SUBSCRIBERS', max(1, int(env('WEB_THREADS', 8)) // 2))),
+        'EVENTS_HEARTBEAT': float(env('EVENTS_HEARTBEAT', 15)),
+        'EVENTS_MAX_DURATION': float(env('EVENTS_MAX_DURATION', 300)),
+    }
+
+class Services:
+    """
+    Cachés, colas de trabajos y conexiones salientes de una instancia de la
+    aplicación. Cada app creada con create_app() tiene las suyas
+    """
+
+    def __init__(self, app):
+        config = app.config
+        self.stream_cache = StreamCache(max_entries=config['STREAM_CACHE_SIZE'], ttl=config['STREAM_CACHE_TTL'],
+                                        store=StreamStore(app))
+        # Proxy de audio: conexiones HTTP reutilizables hacia googlevideo
+        self.http_pool = urllib3.PoolManager(
+            num_pools=10,
+            maxsize=config['STREAM_POOL_SIZE'],
+            timeout=urllib3.Timeout(connect=5, read=30),
+            retries=False
+        )
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=config['PREFETCH_WORKERS'],
+                                                    thread_name_prefix='prefetch')
+        self.prefetch_pending = set()
+        self.prefetch_lock = threading.Lock()
+        self.password_policy = PasswordPolicy(config['PASSWORD_HASH_METHOD'], config['PASSWORD_SALT_LENGTH'],
+                                              config['PASSWORD_HASH_CONCURRENCY'])
+        self.login_ip_limiter = AttemptLimiter(config['LOGIN_MAX_FAILURES_PER_IP'], config['LOGIN_ATTEMPT_WINDOW'])
+        self.login_user_limiter = AttemptLimiter(config['LOGIN_MAX_FAILURES_PER_USER'],
+                                                 config['LOGIN_ATTEMPT_WINDOW'])
+        # Avisos a los navegadores conectados (ver /api/events)
+        self.events = EventBus(max_subscribers=config['EVENTS_MAX_SUBSCRIBERS'])
+        self.download_queue = JobQueue(
+            max_workers=config['DOWNLOAD_WORKERS'],
+            max_pending=config['DOWNLOAD_MAX_PENDING'],
+            name='download',
+            store=JobStore(app),
+            app=app,
+            on_finish=partial(self.job_finished, 'download')
+        )
+        self.import_queue = JobQueue(
+            max_workers=config['IMPORT_JOBS'],
+            max_pending=config['IMPORT_MAX_PENDING'],
+            name='import',
+            store=JobStore(app),
+            app=app,
+            on_finish=partial(self.job_finished, 'import')
+        )
+        self.session_cache = app.session_interface.cache
+        self.transcode_cache = TranscodeCache(config['DOWNLOAD_CACHE_DIR'],
+                                              max_bytes=config['DOWNLOAD_CACHE_MAX_MB'] * 1024 * 1024)
+        _instances.add(self)
+
+    def queues(self):
+        return (('download', self.download_queue), ('import', self.import_queue))
+
+    def job_finished(self, queue_name, job):
+        self.events.publish(job.user_id, 'job', dict(job.to_dict(), queue=queue_name))
+
+    def shutdown(self, jobs_timeout=0):
+        self.events.close()
+        # Cerrar todas las colas antes de esperar a los trabajos en marcha
+        for _, queue in self.queues():
+            queue.close()
+        deadline = time.monotonic() + jobs_timeout
+        for _, queue in self.queues():
+            queue.shutdown(max(0, deadline - time.monotonic()))
+        self.prefetch_executor.shutdown(wait=False, cancel_futures=True)
+        self.http_pool.clear()
+
+# Servicios vivos del proceso, para las métricas agregadas
+_instances = weakref.WeakSet()
+
+def get_services():
+    return current_app.extensions['betawave']
+
+def _caches():
+    for services in list(_instances):
+        yield 'stream', services.stream_cache
+        yield 'download', services.transcode_cache
+        yield 'session', services.session_cache
+
+def _cache_counts(attribute):
+    counts = {}
+    for name, cache in _caches():
+        counts[(name,)] = counts.get((name,), 0) + getattr(cache, attribute)
+    return counts
+
+def _hit_ratios(hits, misses):
+    return {key: hits[key] / (hits[key] + misses.get(key, 0)) if hits[key] + misses.get(key, 0) else 0.0
+            for key in hits}
+
+def _cache_hit_ratios():
+    return _hit_ratios(_cache_counts('hits'), _cache_counts('misses'))
+
+def _job_counts():
+    counts = {}
+    for services in list(_instances):
+        for name, queue in services.queues():
+            for state, count in queue.stats().items():
+                counts[(name, state)] = counts.get((name, state), 0) + count
+    return counts
+
+registry.callback('betawave_cache_hits_total', 'Cache hits', lambda: _cache_counts('hits'),
+                  ['cache'], kind='counter')
+registry.callback('betawave_cache_misses_total', 'Cache misses', lambda: _cache_counts('misses'),
+                  ['cache'], kind='counter')
+registry.callback('betawave_cache_hit_ratio', 'Cache hit ratio since start', _cache_hit_ratios, ['cache'],
+                  combine=lambda totals: _hit_ratios(totals.get('betawave_cache_hits_total', {}),
+                                                     totals.get('betawave_cache_misses_total', {})))
+registry.callback('betawave_stream_cache_entries', 'Stream URLs currently cached',
+                  lambda: sum(s.stream_cache.stats()['entries'] for s in list(_instances)))
+registry.callback('betawave_jobs', 'Background jobs by queue and state', _job_counts, ['queue', 'state'])
+registry.callback('betawave_event_subscribers', 'Open /api/events connections',
+                  lambda: sum(s.events.count() for s in list(_instances)))
+
+def create_app(config=None):
+    """
+    Crea una instancia de la aplicación. config sobrescribe los valores de
+    default_config(). La base de datos no se toca aquí: init_db() se ejecuta
+    una sola vez al arrancar el servidor
+    """
+    app = Flask(__name__)
+    app.config.from_mapping(default_config())
+    if config:
+        app.config.update(config)
+
+    log_config.configure_logging(
+        level=app.config['LOG_LEVEL'],
+        json_format=app.config['LOG_FORMAT'] == 'json',
+        sample_rate=app.config['LOG_SAMPLE_RATE']
+    )
+    log_config.init_app(app)
+    metrics.init_app(app, registry)
+    if app.config['METRICS_DIR']:
+        # Se pone en marcha en cada worker después del fork (ver gunicorn.conf.py)
+        app.extensions['metrics'] = metrics.MultiProcessCollector(registry, app.config['METRICS_DIR'],
+                                                                  app.config['METRICS_FLUSH_INTERVAL'])
+    # Conexiones persistentes a la base de datos (ver db.py)
+    db.init_app(app)
+    # Sesiones en el servidor y usuario de cada petición (ver sessions.py)
+    sessions.init_app(app)
+
+    # Ficheros estáticos con hash en la URL y caché de larga duración
+    assets.init_app(app)
+
+    app.extensions['betawave'] = Services(app)
+    app.register_blueprint(bp)
+    return app
+
+def shutdown(app):
+    """
+    Parada ordenada de un proceso: deja de aceptar trabajos y cierra las
+    conexiones a la base de datos y a YouTube
+    """
+    logger.info("Shutting down worker %s", os.getpid())
+    app.extensions['betawave'].shutdown(app.config['JOBS_SHUTDOWN_TIMEOUT'])
+    db.close_pool(app.config['DATABASE'])
 
 # Database Functions
 def init_db():
-    db_path = app.config['DATABASE']
-    print(f"\n[init_db] Initializing database at: {db_path}")
+    db_path = current_app.config['DATABASE']
+    logger.info("Initializing database at %s", db_path)
     
     # Ensure parent directory exists
     Path(db_path).parent.mkdir(parents=True, exist_ok=True)
     
-    conn = sqlite3.connect(db_path)
+    # Descartar conexiones previas por si el fichero se ha recreado
+    db.close_pool(db_path)
+    conn = db.connect(db_path)
     c = conn.cursor()
     
     try:
-        # Crear tabla users si no existe
-        print("[init_db] Creating users table...")
-        c.execute('''CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            email TEXT,
-            role TEXT DEFAULT 'user',
-            created_at DATETIME
-        )''')
+        # Crear o actualizar el esquema (ver migrations.py)
+        version = migrations.migrate(conn)
+        logger.info("Schema version: %s", version)
+        
+        c.execute("DELETE FROM sessions WHERE expires_at < ?", (int(time.time()),))
+        c.execute("DELETE FROM stream_urls WHERE expires_at < ?", (time.time(),))
+        
+        # Olvidar los cambios antiguos: quien sincronice desde ahí recarga todo
+        c.execute("DELETE FROM library_changes WHERE created_at < ?",
+                  (int(time.time()) - current_app.config['LIBRARY_CHANGES_MAX_AGE'],))
         
         # Verificar si el usuario admin existe
         c.execute("SELECT username FROM users WHERE username = 'admin'")
         admin_exists = c.fetchone()
-        print(f"[init_db] Admin exists: {admin_exists is not None}")
         
         # Si no existe el admin, crearlo
         if not admin_exists:
             from datetime import datetime
-            admin_password = generate_password_hash('admin123')
+            admin_password = hash_password('admin123')
             current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            print("[init_db] Creating admin user...")
+            logger.info("Creating admin user")
             c.execute("INSERT INTO users (username, password, role, created_at) VALUES (?, ?, 'admin', ?)",
                      ('admin', admin_password, current_time))
-
-        # Verificar si existe la columna role
-        c.execute("PRAGMA table_info(users)")
-        columns = [column[1] for column in c.fetchall()]    
-        print(f"[init_db] Users table columns: {columns}")
-        
-        if 'role' not in columns:
-            print("[init_db] Adding role column...")
-            c.execute("ALTER TABLE users ADD COLUMN role TEXT DEFAULT 'user'")    
-        
-        # Verificar si existe la columna created_at
-        if 'created_at' not in columns:
-            print("[init_db] Adding created_at column...")
-            c.execute("ALTER TABLE users ADD COLUMN created_at DATETIME")
-            current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            c.execute("UPDATE users SET created_at = ? WHERE created_at IS NULL", (current_time,))
-
-        # Crear tabla songs si no existe
-        print("[init_db] Creating songs table...")
-        c.execute('''CREATE TABLE IF NOT EXISTS songs
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      name TEXT NOT NULL,
-                      artist TEXT,
-                      url TEXT NOT NULL,
-                      user_id INTEGER NOT NULL,
-                      FOREIGN KEY(user_id) REFERENCES users(id))''')
-        
-        print("[init_db] Creating favorites table...")
-        c.execute('''CREATE TABLE IF NOT EXISTS favorites
-                     (user_id INTEGER NOT NULL,
-                      song_id INTEGER NOT NULL,
-                      PRIMARY KEY (user_id, song_id),
-                      FOREIGN KEY(user_id) REFERENCES users(id),
-                      FOREIGN KEY(song_id) REFERENCES songs(id))''')
-        
-        print("[init_db] Creating user_config table...")
-        c.execute('''CREATE TABLE IF NOT EXISTS user_config
-                     (user_id INTEGER PRIMARY KEY,
-                      dark_mode BOOLEAN DEFAULT 0,
-                      default_volume INTEGER DEFAULT 50,
-                      FOREIGN KEY(user_id) REFERENCES users(id))''')
         
         conn.commit()
-        print("[init_db] Database initialization complete!")
-        
-        # Verify tables were created
-        c.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        tables = c.fetchall()
-        print(f"[init_db] Tables in database: {[t[0] for t in tables]}")
+        logger.info("Database initialization complete")
         
     except sqlite3.Error as e:
-        print(f"[init_db] SQLite error: {e}")
+        logger.error("SQLite error initializing database: %s", e)
         conn.rollback()
         raise
     finally:
         conn.close()
 
 def add_user(username, password, email=None, role='user'):
-    print(f"[add_user] Adding user: username={username}, email={email}, role={role}")
-    db_path = app.config.get('DATABASE', 'music.db')
-    print(f"[add_user] Using database: {db_path}")
-    conn = sqlite3.connect(db_path)
+    logger.debug("add_user username=%s role=%s", username, role)
+    conn = get_db()
     c = conn.cursor()
     try:
         from datetime import datetime
         current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        hashed_pw = generate_password_hash(password)
+        hashed_pw = hash_password(password)
         c.execute("INSERT INTO users (username, password, email, role, created_at) VALUES (?, ?, ?, ?, ?)",
                  (username, hashed_pw, email, role, current_time))
         conn.commit()
-        print("[add_user] User added successfully")
         return True
     except sqlite3.IntegrityError as e:
-        print(f"[add_user] SQLite Integrity Error: {e}")
+        logger.debug("add_user rejected username=%s: %s", username, e)
+        conn.rollback()
         return False
     except sqlite3.Error as e:
-        print(f"[add_user] SQLite Error: {e}")
+        logger.debug("add_user failed username=%s: %s", username, e)
+        conn.rollback()
         return False
-    finally:
-        conn.close()
+
+@QUERY_LATENCY.timed(query='record_login')
+def record_login(user_id):
+    conn = get_db()
+    from datetime import datetime
+    conn.execute("UPDATE users SET last_login_at = ? WHERE id = ?",
+                 (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), user_id))
+    conn.commit()
+
+@QUERY_LATENCY.timed(query='delete_users')
+def delete_users(user_ids, chunk_size=ADMIN_DELETE_CHUNK):
+    """
+    Borra los usuarios indicados que no sean administradores. Sus canciones,
+    favoritos, configuración, trabajos y sesiones se borran en cascada (ver
+    migrations.py). Cada
+    tanda de chunk_size usuarios es una transacción. Devuelve los ids borrados
+    """
+    conn = get_db()
+    c = conn.cursor()
+    ids = sorted({int(user_id) for user_id in user_ids})
+    deleted = []
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        placeholders = ','.join('?' * len(chunk))
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.execute(f"SELECT id FROM users WHERE id IN ({placeholders}) AND role IS NOT 'admin'", chunk)
+            chunk = [row[0] for row in c.fetchall()]
+            placeholders = ','.join('?' * len(chunk))
+            if chunk:
+                c.execute(f"DELETE FROM users WHERE id IN ({placeholders})", chunk)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        deleted.extend(chunk)
+        logger.debug("delete_users deleted %s users", len(chunk))
+    # Sus sesiones se han borrado en cascada; falta sacarlas de la caché
+    current_app.session_interface.forget_users(deleted)
+    # Cerrar las pestañas que tengan abiertas
+    bus = get_services().events
+    for user_id in deleted:
+        bus.publish(user_id, 'logout')
+    return deleted
+
+@QUERY_LATENCY.timed(query='get_inactive_user_ids')
+def get_inactive_user_ids(days):
+    """
+    Usuarios (no administradores) que llevan más de days días sin iniciar
+    sesión, o sin registrarse si nunca la han iniciado. last_login_at también
+    se actualiza al renovar una sesión abierta (ver sessions.py), así que
+    puede ir hasta media vida de la sesión por detrás del último uso
+    """
+    from datetime import datetime, timedelta
+    cutoff = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    c = get_db().cursor()
+    c.execute("""SELECT id FROM users
+                 WHERE role IS NOT 'admin' AND COALESCE(last_login_at, created_at) < ?""", (cutoff,))
+    return [row[0] for row in c.fetchall()]
+
+def hash_password(password):
+    with PASSWORD_HASH_LATENCY.time(operation='hash'):
+        return get_services().password_policy.hash(password)
+
+def check_password(stored_hash, password):
+    with PASSWORD_HASH_LATENCY.time(operation='verify'):
+        return get_services().password_policy.verify(stored_hash, password)
 
 def verify_user(username, password):
-    db_path = app.config.get('DATABASE', 'music.db')
-    conn = sqlite3.connect(db_path)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT id, username, password, role FROM users WHERE username=?", (username,))
     user = c.fetchone()
-    conn.close()
-    if user and check_password_hash(user[2], password):
+    if user and check_password(user[2], password):
+        # Hash con un método o coste anterior: se rehace ahora que se conoce la contraseña
+        if get_services().password_policy.needs_rehash(user[2]):
+            logger.info("Rehashing password of user %s", user[0])
+            c.execute("UPDATE users SET password=? WHERE id=?", (hash_password(password), user[0]))
+            conn.commit()
         return {'id': user[0], 'username': user[1], 'role': user[3]}
     return None
 
+@QUERY_LATENCY.timed(query='add_song')
 def add_song(name, artist, url, user_id):
-    db_path = app.config.get('DATABASE', 'music.db')
-    conn = sqlite3.connect(db_path)
+    conn = get_db()
     c = conn.cursor()
     try:
         c.execute("INSERT INTO songs (name, artist, url, user_id) VALUES (?, ?, ?, ?)",
                  (name, artist, url, user_id))
         conn.commit()
+        notify_library_change(user_id)
         return c.lastrowid
     except sqlite3.IntegrityError:
+        conn.rollback()
         return None
-    finally:
-        conn.close()
 
-def get_songs(user_id):
-    db_path = app.config.get('DATABASE', 'music.db')
-    conn = sqlite3.connect(db_path)
+@QUERY_LATENCY.timed(query='add_songs')
+def add_songs(user_id, songs):
+    """
+    Inserta varias canciones (nombre, artista, url) en una sola transacción,
+    ignorando las que el usuario ya tenía. Devuelve cuántas se insertaron
+    """
+    conn = get_db()
     c = conn.cursor()
-    c.execute("SELECT id, name, artist, url FROM songs WHERE user_id=?", (user_id,))
-    songs = [{'id': row[0], 'name': row[1], 'artist': row[2], 'url': row[3]} for row in c.fetchall()]
-    conn.close()
-    return songs
+    try:
+        c.executemany("INSERT OR IGNORE INTO songs (name, artist, url, user_id) VALUES (?, ?, ?, ?)",
+                      [(name, artist, url, user_id) for name, artist, url in songs])
+        conn.commit()
+        if c.rowcount > 0:
+            notify_library_change(user_id)
+        return max(c.rowcount, 0)
+    except sqlite3.Error:
+        conn.rollback()
+        raise
 
-def search_songs(user_id, search_term):
+@QUERY_LATENCY.timed(query='get_library_revision')
+def get_library_revision(user_id):
+    """
+    Revisión actual de las canciones y favoritos del usuario (ver migrations.py)
     """
-    Busca canciones por nombre o artista
+    c = get_db().cursor()
+    c.execute("SELECT library_revision FROM users WHERE id=?", (user_id,))
+    row = c.fetchone()
+    return row[0] if row else 0
+
+def notify_library_change(user_id):
     """
-    db_path = app.config.get('DATABASE', 'music.db')
-    conn = sqlite3.connect(db_path)
+    Avisa a los navegadores del usuario conectados a este proceso de que su
+    biblioteca ha cambiado. Solo lee la revisión si hay alguien escuchando
+    """
+    bus = get_services().events
+    if bus.has_subscribers(user_id):
+        bus.publish(user_id, 'library', {'revision': get_library_revision(user_id)})
+
+@QUERY_LATENCY.timed(query='get_library_changes')
+def get_library_changes(user_id, since):
+    """
+    Cambios en las canciones y favoritos del usuario desde la revisión since:
+    las canciones añadidas o modificadas (con su estado de favorito) y los ids
+    de las borradas. Con reset=True el cliente debe recargar las listas enteras
+    """
+    conn = get_db()
     c = conn.cursor()
+    # Una sola transacción de lectura: la revisión y los cambios coinciden
+    started = not conn.in_transaction
+    if started:
+        c.execute("BEGIN")
     try:
+        c.execute("SELECT library_revision FROM users WHERE id=?", (user_id,))
+        row = c.fetchone()
+        revision = row[0] if row else 0
+        changes = {'revision': revision, 'reset': False, 'songs': [], 'deleted': []}
+        if since == revision:
+            return changes
+        if since < 0 or since > revision:
+            changes['reset'] = True
+            return changes
+
+        c.execute("SELECT MIN(revision), COUNT(DISTINCT song_id) FROM library_changes WHERE user_id=? AND revision > ?",
+                  (user_id, since))
+        oldest, count = c.fetchone()
+        # Faltan cambios (ya borrados o anteriores al registro) o son demasiados
+        if oldest != since + 1 or count > CHANGES_MAX_SONGS:
+            changes['reset'] = True
+            return changes
+
         c.execute("""
-            SELECT id, name, artist, url 
-            FROM songs 
-            WHERE user_id = ? AND (
-                LOWER(name) LIKE ? OR 
-                LOWER(artist) LIKE ?
-            )
-        """, (user_id, f'%{search_term.lower()}%', f'%{search_term.lower()}%'))
-        
-        songs = [
-            {
-                'id': row[0],
-                'name': row[1],
-                'artist': row[2],
-                'url': row[3]
-            }
+            SELECT DISTINCT song_id FROM library_changes WHERE user_id=? AND revision > ?
+        """, (user_id, since))
+        changed_ids = [row[0] for row in c.fetchall()]
+        placeholders = ','.join('?' * len(changed_ids))
+        c.execute(f"""
+            SELECT s.id, s.name, s.artist, s.url, f.song_id IS NOT NULL
+            FROM songs s
+            LEFT JOIN favorites f ON f.user_id = s.user_id AND f.song_id = s.id
+            WHERE s.user_id=? AND s.id IN ({placeholders})
+            ORDER BY s.id
+        """, (user_id, *changed_ids))
+        changes['songs'] = [
+            {'id': row[0], 'name': row[1], 'artist': row[2], 'url': row[3], 'is_favorite': bool(row[4])}
             for row in c.fetchall()
         ]
-        return songs
+        present = {song['id'] for song in changes['songs']}
+        changes['deleted'] = sorted(song_id for song_id in changed_ids if song_id not in present)
+        return changes
     finally:
-        conn.close()
+        if started:
+            conn.commit()
+
+@QUERY_LATENCY.timed(query='get_songs')
+def get_songs(user_id, after_id=0, limit=None):
+    """
+    Devuelve las canciones del usuario ordenadas por id. Con after_id y limit
+    se obtiene una página a partir de la última canción recibida
+    """
+    c = get_db().cursor()
+    c.execute("""
+        SELECT s.id, s.name, s.artist, s.url, f.song_id IS NOT NULL
+        FROM songs s
+        LEFT JOIN favorites f ON f.user_id = s.user_id AND f.song_id = s.id
+        WHERE s.user_id=? AND s.id > ?
+        ORDER BY s.id
+        LIMIT ?
+    """, (user_id, after_id, -1 if limit is None else limit))
+    return [
+        {'id': row[0], 'name': row[1], 'artist': row[2], 'url': row[3], 'is_favorite': bool(row[4])}
+        for row in c.fetchall()
+    ]
+
+def _fts_query(search_term):
+    """
+    Convierte el texto buscado en una consulta FTS5 de prefijos: "pal"* "otra"*
+    """
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', search_term))
+
+@QUERY_LATENCY.timed(query='search_songs')
+def search_songs(user_id, search_term, limit=None, offset=0):
+    """
+    Busca canciones por nombre o artista usando el índice de texto completo
+    """
+    c = get_db().cursor()
+    limit = -1 if limit is None else limit
+    match = _fts_query(search_term)
+    try:
+        if match:
+            c.execute("""
+                SELECT s.id, s.name, s.artist, s.url, f.song_id IS NOT NULL
+                FROM songs_fts
+                JOIN songs s ON s.id = songs_fts.rowid
+                LEFT JOIN favorites f ON f.user_id = s.user_id AND f.song_id = s.id
+                WHERE songs_fts MATCH ? AND s.user_id = ?
+                ORDER BY songs_fts.rank
+                LIMIT ? OFFSET ?
+            """, (match, user_id, limit, offset))
+        else:
+            c.execute("""
+                SELECT s.id, s.name, s.artist, s.url, f.song_id IS NOT NULL
+                FROM songs s
+                LEFT JOIN favorites f ON f.user_id = s.user_id AND f.song_id = s.id
+                WHERE s.user_id = ?
+                ORDER BY s.id
+                LIMIT ? OFFSET ?
+            """, (user_id, limit, offset))
+    except sqlite3.OperationalError as e:
+        # SQLite sin FTS5: búsqueda lineal con LIKE
+        logger.debug("FTS unavailable, using LIKE: %s", e)
+        c.execute("""
+            SELECT s.id, s.name, s.artist, s.url, f.song_id IS NOT NULL
+            FROM songs s
+            LEFT JOIN favorites f ON f.user_id = s.user_id AND f.song_id = s.id
+            WHERE s.user_id = ? AND (
+                LOWER(s.name) LIKE ? OR 
+                LOWER(s.artist) LIKE ?
+            )
+            LIMIT ? OFFSET ?
+        """, (user_id, f'%{search_term.lower()}%', f'%{search_term.lower()}%', limit, offset))
+    
+    songs = [
+        {
+            'id': row[0],
+            'name': row[1],
+            'artist': row[2],
+            'url': row[3],
+            'is_favorite': bool(row[4])
+        }
+        for row in c.fetchall()
+    ]
+    return songs
 
+@QUERY_LATENCY.timed(query='get_song_url')
 def get_song_url(song_id, user_id):
-    db_path = app.config.get('DATABASE', 'music.db')
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
+    c = get_db().cursor()
     c.execute("SELECT url FROM songs WHERE id=? AND user_id=?", (song_id, user_id))
     result = c.fetchone()
-    conn.close()
     return result[0] if result else None
 
+@QUERY_LATENCY.timed(query='get_song_urls')
+def get_song_urls(song_ids, user_id):
+    """
+    Devuelve las URLs de varias canciones del usuario respetando el orden pedido
+    """
+    if not song_ids:
+        return []
+    placeholders = ','.join('?' * len(song_ids))
+    c = get_db().cursor()
+    c.execute(f"SELECT id, url FROM songs WHERE user_id=? AND id IN ({placeholders})",
+              (user_id, *song_ids))
+    urls = dict(c.fetchall())
+    return [urls[song_id] for song_id in song_ids if song_id in urls]
+
+@QUERY_LATENCY.timed(query='delete_song')
 def delete_song(song_id, user_id):
-    db_path = app.config.get('DATABASE', 'music.db')
-    conn = sqlite3.connect(db_path)
+    conn = get_db()
     c = conn.cursor()
     try:
         # Primero verificar que la canción existe y pertenece al usuario
@@ -230,91 +682,173 @@ def delete_song(song_id, user_id):
         c.execute("DELETE FROM songs WHERE id=? AND user_id=?", (song_id, user_id))
         
         conn.commit()
+        notify_library_change(user_id)
         return True
     except sqlite3.Error as e:
-        print(f"Database error: {e}")
+        logger.debug("delete_song failed song_id=%s: %s", song_id, e)
+        conn.rollback()
         return False
-    finally:
-        conn.close()
 
+@QUERY_LATENCY.timed(query='add_favorite')
 def add_favorite(user_id, song_id):
-    db_path = app.config.get('DATABASE', 'music.db')
-    print(f"[add_favorite] Adding to favorites in database: {db_path}")
-    print(f"[add_favorite] user_id: {user_id}, song_id: {song_id}")
-    
-    conn = sqlite3.connect(db_path)
+    logger.debug("add_favorite user_id=%s song_id=%s", user_id, song_id)
+    conn = get_db()
     c = conn.cursor()
     try:
         # First check if the favorite already exists
         c.execute("SELECT 1 FROM favorites WHERE user_id=? AND song_id=?", (user_id, song_id))
         if c.fetchone() is not None:
-            print("[add_favorite] Favorite already exists")
             return True
 
         # Add the favorite
         c.execute("INSERT INTO favorites VALUES (?, ?)", (user_id, song_id))
         conn.commit()
-        print("[add_favorite] Successfully added favorite")
+        notify_library_change(user_id)
         return True
     except sqlite3.IntegrityError as e:
-        print(f"[add_favorite] SQL error: {e}")
+        logger.debug("add_favorite failed user_id=%s song_id=%s: %s", user_id, song_id, e)
+        conn.rollback()
         return False
-    finally:
-        conn.close()
 
+@QUERY_LATENCY.timed(query='remove_favorite')
 def remove_favorite(user_id, song_id):
-    db_path = app.config.get('DATABASE', 'music.db')
-    conn = sqlite3.connect(db_path)
+    conn = get_db()
     c = conn.cursor()
     c.execute("DELETE FROM favorites WHERE user_id=? AND song_id=?", (user_id, song_id))
     conn.commit()
-    rows_affected = c.rowcount
-    conn.close()
-    return rows_affected > 0
+    if c.rowcount > 0:
+        notify_library_change(user_id)
+    return c.rowcount > 0
 
-def get_favorites(user_id):
-    db_path = app.config.get('DATABASE', 'music.db')
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
+@QUERY_LATENCY.timed(query='get_favorites')
+def get_favorites(user_id, after_id=0, limit=None):
+    c = get_db().cursor()
+    # Solo canciones del propio usuario, igual que get_library_changes
     c.execute('''SELECT s.id, s.name, s.artist, s.url 
-                 FROM songs s JOIN favorites f ON s.id = f.song_id 
-                 WHERE f.user_id=?''', (user_id,))
-    favorites = [{'id': row[0], 'name': row[1], 'artist': row[2], 'url': row[3]} for row in c.fetchall()]
-    conn.close()
-    return favorites
+                 FROM favorites f JOIN songs s ON s.id = f.song_id AND s.user_id = f.user_id
+                 WHERE f.user_id=? AND f.song_id > ?
+                 ORDER BY f.song_id
+                 LIMIT ?''', (user_id, after_id, -1 if limit is None else limit))
+    return [
+        {'id': row[0], 'name': row[1], 'artist': row[2], 'url': row[3], 'is_favorite': True}
+        for row in c.fetchall()
+    ]
 
+@QUERY_LATENCY.timed(query='is_favorite')
 def is_favorite(user_id, song_id):
-    db_path = app.config.get('DATABASE', 'music.db')
-    print(f"[is_favorite] Checking favorites in database: {db_path}")
-    print(f"[is_favorite] user_id: {user_id}, song_id: {song_id}")
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
+    c = get_db().cursor()
     c.execute("SELECT 1 FROM favorites WHERE user_id=? AND song_id=?", (user_id, song_id))
     result = c.fetchone() is not None
-    print(f"[is_favorite] Found in favorites: {result}")
-    # Debug: check actual records
-    c.execute("SELECT * FROM favorites")
-    all_favs = c.fetchall()
-    print(f"[is_favorite] All favorites in DB: {all_favs}")
-    conn.close()
+    logger.debug("is_favorite user_id=%s song_id=%s -> %s", user_id, song_id, result)
     return result
 
+@QUERY_LATENCY.timed(query='get_favorite_statuses')
+def get_favorite_statuses(user_id, song_ids):
+    """
+    Devuelve {song_id: bool} para varias canciones con una sola consulta
+    """
+    c = get_db().cursor()
+    favorite_ids = set()
+    # Trocear para no superar el límite de parámetros de SQLite
+    for start in range(0, len(song_ids), 500):
+        chunk = song_ids[start:start + 500]
+        placeholders = ','.join('?' * len(chunk))
+        c.execute(f"SELECT song_id FROM favorites WHERE user_id=? AND song_id IN ({placeholders})",
+                  (user_id, *chunk))
+        favorite_ids.update(row[0] for row in c.fetchall())
+    return {song_id: song_id in favorite_ids for song_id in song_ids}
+
+@QUERY_LATENCY.timed(query='get_user_profile')
+def get_user_profile(user_id):
+    """
+    Datos del perfil y contadores de canciones y favoritos, leídos de
+    user_stats (ver migrations.py) sin recorrer las canciones del usuario
+    """
+    c = get_db().cursor()
+    c.execute("""
+        SELECT u.username, u.email, u.created_at,
+               COALESCE(st.songs_count, 0), COALESCE(st.favorites_count, 0)
+        FROM users u
+        LEFT JOIN user_stats st ON st.user_id = u.id
+        WHERE u.id = ?
+    """, (user_id,))
+    row = c.fetchone()
+    if row is None:
+        return None
+    return {'username': row[0], 'email': row[1], 'created_at': row[2],
+            'songs_count': row[3], 'favorites_count': row[4]}
+
+def _admin_user_filters(search, role):
+    conditions, params = [], []
+    if search:
+        # Prefijo del nombre: LIKE sin distinguir mayúsculas usa el índice NOCASE
+        conditions.append("u.username LIKE ? ESCAPE '\\'")
+        params.append(re.sub(r'([\\%_])', r'\\\1', search) + '%')
+    if role:
+        conditions.append("u.role = ?")
+        params.append(role)
+    return ('WHERE ' + ' AND '.join(conditions)) if conditions else '', params
+
+@QUERY_LATENCY.timed(query='get_admin_users')
+def get_admin_users(search='', role=None, sort='created', descending=True, limit=ADMIN_PAGE_SIZE, offset=0):
+    """
+    Página del listado de usuarios del panel con sus contadores de canciones
+    y favoritos, en una sola consulta. Devuelve (usuarios, total)
+    """
+    column, tiebreak = ADMIN_USER_SORTS[sort]
+    direction = 'DESC' if descending else 'ASC'
+    where, params = _admin_user_filters(search, role)
+    c = get_db().cursor()
+    c.execute(f"""
+        SELECT u.id, u.username, u.email, u.created_at, u.role, st.songs_count, st.favorites_count
+        FROM users u
+        JOIN user_stats st ON st.user_id = u.id
+        {where}
+        ORDER BY {column} {direction}, {tiebreak} {direction}
+        LIMIT ? OFFSET ?
+    """, (*params, limit, offset))
+    users = [
+        {'id': row[0], 'username': row[1], 'email': row[2], 'created_at': row[3], 'role': row[4],
+         'songs_count': row[5], 'favorites_count': row[6]}
+        for row in c.fetchall()
+    ]
+    c.execute(f"SELECT COUNT(*) FROM users u {where}", params)
+    return users, c.fetchone()[0]
+
+@QUERY_LATENCY.timed(query='get_admin_summary')
+def get_admin_summary():
+    """
+    Totales del panel agrupados por rol: usuarios, canciones y favoritos
+    """
+    c = get_db().cursor()
+    c.execute("""
+        SELECT u.role, COUNT(*), SUM(st.songs_count), SUM(st.favorites_count)
+        FROM users u
+        JOIN user_stats st ON st.user_id = u.id
+        GROUP BY u.role
+    """)
+    summary = {'users': 0, 'songs': 0, 'favorites': 0, 'roles': {}}
+    for role, users, songs, favorites in c.fetchall():
+        summary['roles'][role or 'user'] = summary['roles'].get(role or 'user', 0) + users
+        summary['users'] += users
+        summary['songs'] += songs or 0
+        summary['favorites'] += favorites or 0
+    return summary
+
+@QUERY_LATENCY.timed(query='get_user_config')
 def get_user_config(user_id):
-    db_path = app.config.get('DATABASE', 'music.db')
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
+    c = get_db().cursor()
     c.execute("SELECT dark_mode, default_volume FROM user_config WHERE user_id=?", (user_id,))
     config = c.fetchone()
-    conn.close()
     
     if config is None:
         # Return default values if no config exists
         return {'dark_mode': False, 'default_volume': 50}
     return {'dark_mode': bool(config[0]), 'default_volume': config[1]}
 
+@QUERY_LATENCY.timed(query='save_user_config')
 def save_user_config(user_id, dark_mode, default_volume):
-    db_path = app.config.get('DATABASE', 'music.db')
-    conn = sqlite3.connect(db_path)
+    conn = get_db()
     c = conn.cursor()
     try:
         c.execute("""INSERT OR REPLACE INTO user_config (user_id, dark_mode, default_volume) 
@@ -322,18 +856,350 @@ def save_user_config(user_id, dark_mode, default_volume):
         conn.commit()
         return True
     except sqlite3.Error as e:
-        print(f"Database error: {e}")
+        logger.debug("save_user_config failed user_id=%s: %s", user_id, e)
+        conn.rollback()
         return False
+
+@QUERY_LATENCY.timed(query='get_video_metadata')
+def get_video_metadata(video_ids):
+    """
+    Devuelve {video_id: metadatos} de los vídeos ya guardados, caducados o no
+    """
+    c = get_db().cursor()
+    metadata = {}
+    video_ids = list(dict.fromkeys(video_ids))
+    for start in range(0, len(video_ids), 500):
+        chunk = video_ids[start:start + 500]
+        placeholders = ','.join('?' * len(chunk))
+        c.execute(f"""SELECT video_id, title, artist, duration, thumbnail, fetched_at
+                      FROM video_metadata WHERE video_id IN ({placeholders})""", chunk)
+        for row in c.fetchall():
+            metadata[row[0]] = {'video_id': row[0], 'title': row[1], 'artist': row[2],
+                                'duration': row[3], 'thumbnail': row[4], 'fetched_at': row[5]}
+    return metadata
+
+@QUERY_LATENCY.timed(query='save_video_metadata')
+def save_video_metadata(entries):
+    conn = get_db()
+    c = conn.cursor()
+    try:
+        c.executemany("""INSERT OR REPLACE INTO video_metadata
+                         (video_id, title, artist, duration, thumbnail, fetched_at)
+                         VALUES (?, ?, ?, ?, ?, ?)""",
+                      [(e['video_id'], e['title'], e['artist'], e['duration'], e['thumbnail'], e['fetched_at'])
+                       for e in entries])
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.debug("save_video_metadata failed: %s", e)
+        conn.rollback()
+
+def is_metadata_fresh(entry):
+    return time.time() - entry['fetched_at'] < current_app.config['VIDEO_METADATA_MAX_AGE']
+
+# YouTube Functions
+def ytdlp_extract(url, ydl_opts, operation, download=False):
+    """
+    Llama a extract_info de yt-dlp midiendo su duración y sus errores
+    """
+    # yt_dlp tarda en importarse: solo se carga la primera vez que hace falta
+    import yt_dlp
+    try:
+        with YTDLP_LATENCY.time(operation=operation):
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                return ydl.extract_info(url, download=download)
+    except Exception:
+        YTDLP_ERRORS.inc(operation=operation)
+        raise
+
+def extract_video_id(song_url):
+    """
+    Obtiene el id del vídeo de una URL de YouTube (watch?v=, youtu.be/, shorts/)
+    """
+    parsed = urlparse(song_url)
+    video_id = parse_qs(parsed.query).get('v', [None])[0]
+    if not video_id:
+        parts = [part for part in parsed.path.split('/') if part]
+        if parts and (parsed.netloc.endswith('youtu.be') or parts[0] in ('shorts', 'embed', 'live')):
+            video_id = parts[-1]
+    # Si no se reconoce la URL, usar un hash estable de la misma
+    return video_id or hashlib.sha1(song_url.encode('utf-8')).hexdigest()
+
+def resolve_stream_url(song_url):
+    """
+    Obtiene la URL de audio de una canción, usando la caché si es posible
+    """
+    stream_cache = get_services().stream_cache
+    stream_url = stream_cache.get(song_url)
+    if stream_url:
+        return stream_url
+
+    ydl_opts = {
+        'format': 'bestaudio',  # Solo busca formatos de audio
+        'quiet': True,
+        'extract_flat': True,
+        'force_ipv4': True,
+        'socket_timeout': 5,  # Reducir timeout a 5 segundos
+        'nocheckcertificate': True,  # Evitar chequeos de certificados
+        'prefer_insecure': True,  # Preferir conexiones más rápidas aunque sean menos seguras
+        'geo_bypass': True  # Evitar restricciones geográficas
+    }
+    info = ytdlp_extract(song_url, ydl_opts, 'stream')
+    stream_url = info['url']
+    stream_cache.put(song_url, stream_url)
+    return stream_url
+
+def run_download(job, song_url, format_type):
+    """
+    Descarga y convierte el audio de una canción dentro de un trabajo de la cola
+    """
+    def progress_hook(d):
+        if d['status'] == 'downloading':
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            if total:
+                # El último tramo corresponde a la conversión con FFmpeg
+                job.progress = min(d.get('downloaded_bytes', 0) * 90 / total, 90)
+                job.save()
+        elif d['status'] == 'finished':
+            job.status = jobs.PROCESSING
+            job.progress = 90.0
+            job.save(force=True)
+
+    extension = DOWNLOAD_EXTENSIONS.get(format_type, format_type)
+    transcode_cache = get_services().transcode_cache
+    cache_key = (extract_video_id(song_url), format_type, DOWNLOAD_QUALITY)
+    cached = transcode_cache.get(cache_key)
+    if cached:
+        job.filepath, title = cached
+        job.filename = f"{title}.{extension}"
+        return
+
+    temp_dir = transcode_cache.make_temp_dir()
+    ydl_opts = {
+        'format': 'bestaudio/best',
+        'quiet': True,
+        'outtmpl': os.path.join(temp_dir, 'audio.%(ext)s'),
+        'progress_hooks': [progress_hook],
+        'postprocessors': [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': format_type,
+            'preferredquality': DOWNLOAD_QUALITY,
+        }]
+    }
+
+    try:
+        info = ytdlp_extract(song_url, ydl_opts, 'download', download=True)
+        # Ruta real tras la conversión, si yt-dlp la indica
+        downloads = info.get('requested_downloads') or [{}]
+        source = downloads[0].get('filepath') or os.path.join(temp_dir, f'audio.{extension}')
+        job.filepath = transcode_cache.put(cache_key, source, info['title'])
+        job.filename = f"{info['title']}.{extension}"
     finally:
-        conn.close()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def open_upstream_stream(song_url, range_header=None):
+    """
+    Abre la respuesta de audio original sin cargarla en memoria. Si la URL en
+    caché ha caducado o se ha revocado, la vuelve a resolver una vez
+    """
+    services = get_services()
+    headers = {'Range': range_header} if range_header else {}
+    for attempt in range(2):
+        upstream = services.http_pool.request('GET', resolve_stream_url(song_url), headers=headers,
+                                     preload_content=False)
+        if upstream.status not in (403, 404, 410) or attempt == 1:
+            return upstream
+        upstream.release_conn()
+        services.stream_cache.invalidate(song_url)
+
+def is_youtube_url(url):
+    return 'youtube.com' in url or 'youtu.be' in url
+
+def infer_artist(info, song_name):
+    """
+    Deduce el artista a partir de los metadatos de yt-dlp o del título
+    """
+    # Intentar obtener el artista del video de diferentes formas
+    artist = (
+        info.get('artist', '') or           # Metadatos del artista
+        info.get('creator', '') or          # Creador del video
+        info.get('uploader', '') or         # Quien subió el video
+        info.get('channel', '')             # Nombre del canal
+    )
+    
+    # Si no se encontró el artista, intentar extraerlo del título
+    if not artist and ' - ' in song_name:
+        # Formatos comunes: "Artista - Canción", "Artista - Topic - Canción"
+        parts = song_name.split(' - ')
+        artist = parts[0].strip()
+        # Si hay "Topic" en el nombre del artista, usar solo la primera parte
+        if 'topic' in artist.lower():
+            artist = artist.split('Topic')[0].strip()
+    
+    # Si aún no hay artista, intentar usar el nombre del canal sin "- Topic"
+    if not artist:
+        channel = info.get('channel', '')
+        if channel:
+            if ' - Topic' in channel:
+                artist = channel.replace(' - Topic', '').strip()
+            else:
+                artist = channel
+    
+    # Si todo lo anterior falló, usar "Artista Desconocido"
+    return artist or 'Artista Desconocido'
+
+METADATA_YDL_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'extract_flat': 'in_playlist',  # Extracción más rápida de metadatos
+    'force_ipv4': True,
+    'socket_timeout': 5,
+    'nocheckcertificate': True,
+    'prefer_insecure': True
+}
+
+def fetch_video_metadata(song_url):
+    """
+    Pide a YouTube los metadatos de un video (título, artista, duración y portada)
+    """
+    info = ytdlp_extract(song_url, METADATA_YDL_OPTS, 'metadata')
+    song_name = info.get('title', '')
+    if not song_name:
+        raise ValueError('No se pudo obtener el título del video')
+    thumbnails = info.get('thumbnails') or [{}]
+    duration = info.get('duration')
+    return {
+        'video_id': extract_video_id(song_url),
+        'title': song_name,
+        'artist': infer_artist(info, song_name),
+        'duration': int(duration) if duration else None,
+        'thumbnail': info.get('thumbnail') or thumbnails[-1].get('url'),
+        'fetched_at': int(time.time())
+    }
+
+def extract_song_metadata(song_url):
+    """
+    Devuelve (título, artista) de un video de YouTube, consultando primero la
+    tabla video_metadata. Si los datos guardados han caducado se refrescan, y
+    si YouTube falla se siguen usando los antiguos
+    """
+    video_id = extract_video_id(song_url)
+    entry = get_video_metadata([video_id]).get(video_id)
+    if entry is not None and is_metadata_fresh(entry):
+        VIDEO_METADATA_LOOKUPS.inc(result='hit')
+    else:
+        VIDEO_METADATA_LOOKUPS.inc(result='miss' if entry is None else 'stale')
+        try:
+            entry = fetch_video_metadata(song_url)
+            save_video_metadata([entry])
+        except Exception as e:
+            if entry is None:
+                raise
+            logger.warning("Using stale metadata for %s: %s", video_id, e)
+    return entry['title'], entry['artist']
+
+def expand_playlist(playlist_url):
+    """
+    Devuelve las URLs de los videos de una playlist sin extraer cada uno
+    """
+    info = ytdlp_extract(playlist_url, METADATA_YDL_OPTS, 'playlist')
+    if info.get('_type') != 'playlist':
+        return [playlist_url]
+    return [
+        entry.get('url') or f"https://www.youtube.com/watch?v={entry['id']}"
+        for entry in info.get('entries') or []
+        if entry and (entry.get('url') or entry.get('id'))
+    ]
+
+def run_import(job, user_id, playlist_url, song_urls):
+    """
+    Importa varias canciones: toma de video_metadata las ya conocidas, extrae
+    el resto en paralelo y las inserta todas en una sola transacción
+    """
+    urls = expand_playlist(playlist_url) if playlist_url else list(song_urls)
+    urls = list(dict.fromkeys(urls))[:IMPORT_MAX_SONGS]
+    job.result = {'total': len(urls), 'processed': 0, 'cached': 0,
+                  'imported': 0, 'skipped': 0, 'failed': 0}
+
+    video_ids = [extract_video_id(url) for url in urls]
+    known = get_video_metadata(video_ids)
+
+    entries = [None] * len(urls)
+    pending = []
+    for index, video_id in enumerate(video_ids):
+        entry = known.get(video_id)
+        if entry and is_metadata_fresh(entry):
+            VIDEO_METADATA_LOOKUPS.inc(result='hit')
+            entries[index] = entry
+            job.result['cached'] += 1
+            job.result['processed'] += 1
+        else:
+            VIDEO_METADATA_LOOKUPS.inc(result='miss' if entry is None else 'stale')
+            pending.append(index)
+    job.progress = job.result['processed'] * 100 / max(len(urls), 1)
+
+    fetched = []
+    with ThreadPoolExecutor(max_workers=current_app.config['IMPORT_WORKERS'], thread_name_prefix='import-meta') as pool:
+        futures = {pool.submit(fetch_video_metadata, urls[index]): index for index in pending}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                entries[index] = future.result()
+                fetched.append(entries[index])
+            except Exception as e:
+                # Si había datos caducados, mejor usarlos que perder la canción
+                entries[index] = known.get(video_ids[index])
+                if entries[index] is None:
+                    logger.warning("Import: error extracting %s: %s", urls[index], e)
+                    job.result['failed'] += 1
+            job.result['processed'] += 1
+            job.progress = job.result['processed'] * 100 / max(len(urls), 1)
+            job.save()
+
+    songs = [(entry['title'], entry['artist'], url) for entry, url in zip(entries, urls) if entry]
+    if fetched:
+        save_video_metadata(fetched)
+    imported = add_songs(user_id, songs)
+    job.result['imported'] = imported
+    job.result['skipped'] = len(songs) - imported
+
+def _prefetch_stream(app, song_url):
+    services = app.extensions['betawave']
+    try:
+        with app.app_context():
+            resolve_stream_url(song_url)
+    except Exception as e:
+        logger.warning("Prefetch: error resolving %s: %s", song_url, e)
+    finally:
+        with services.prefetch_lock:
+            services.prefetch_pending.discard(song_url)
+
+def prefetch_streams(song_urls):
+    """
+    Resuelve en segundo plano las URLs que no estén ya en caché o en curso
+    """
+    services = get_services()
+    app = current_app._get_current_object()
+    scheduled = 0
+    for song_url in song_urls:
+        if services.stream_cache.contains(song_url):
+            continue
+        with services.prefetch_lock:
+            if song_url in services.prefetch_pending:
+                continue
+            services.prefetch_pending.add(song_url)
+        services.prefetch_executor.submit(_prefetch_stream, app, song_url)
+        scheduled += 1
+    return scheduled
 
 # Decorator para rutas de admin
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_role' not in session or session['user_role'] != 'admin':
+        # El rol sale de la tabla users (ver sessions.py), no de la cookie
+        user = g.get('user')
+        if user is None or user['role'] != 'admin':
             flash('Acceso no autorizado', 'error')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         return f(*args, **kwargs)
     return decorated_function
 
@@ -341,39 +1207,61 @@ def admin_required(f):
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        # Sesión revocada o usuario borrado: g.user es None
+        if g.get('user') is None:
             flash('Debes iniciar sesión para acceder a esta página', 'error')
-            return redirect(url_for('login', next=request.url))
+            return redirect(url_for('main.login', next=request.url))
         return f(*args, **kwargs)
     return decorated_function
 
 # Routes
-@app.route('/')
+@bp.route('/')
 @login_required
 def index():
     return render_template('index.html', username=session.get('username'))
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form.get('username')
         password = request.form.get('password')
+        
+        # Limitar los intentos antes de calcular ningún hash. Solo cuentan los
+        # fallos, también por IP: detrás de un NAT o proxy entran muchos usuarios
+        services = get_services()
+        ip, user_key = request.remote_addr, (username or '').lower()
+        throttled = None
+        if services.login_ip_limiter.blocked(ip):
+            throttled = ('ip', services.login_ip_limiter.retry_after(ip))
+        elif services.login_user_limiter.blocked(user_key):
+            throttled = ('user', services.login_user_limiter.retry_after(user_key))
+        if throttled:
+            LOGIN_THROTTLED.inc(reason=throttled[0])
+            logger.warning("Login throttled by %s for %s", throttled[0], user_key)
+            flash('Demasiados intentos de inicio de sesión. Espera unos minutos', 'error')
+            return render_template('login.html'), 429, {'Retry-After': str(throttled[1])}
+        
         user = verify_user(username, password)
         if user:
+            services.login_user_limiter.reset(user_key)
+            session.rotate()
             session['user_id'] = user['id']
             session['username'] = user['username']
             session['user_role'] = user['role']  # Guardar el rol del usuario en la sesión
+            record_login(user['id'])
             
             # Redirigir a panel de admin si es admin, sino a la página principal
             if user['role'] == 'admin':
-                return redirect(url_for('admin_dashboard'))
+                return redirect(url_for('main.admin_dashboard'))
             
-            next_url = request.args.get('next') or url_for('index')
+            next_url = request.args.get('next') or url_for('main.index')
             return redirect(next_url)
+        services.login_ip_limiter.hit(ip)
+        services.login_user_limiter.hit(user_key)
         flash('Usuario o contraseña incorrectos', 'error')
     return render_template('login.html')
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         username = request.form.get('username')
@@ -382,17 +1270,17 @@ def register():
         
         if add_user(username, password, email):
             flash('Registro exitoso! Por favor inicia sesión', 'success')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         flash('El usuario ya existe', 'error')
     return render_template('register.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     session.clear()
     flash('Has cerrado sesión correctamente', 'info')
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/profile', methods=['GET', 'POST'])
+@bp.route('/profile', methods=['GET', 'POST'])
 @login_required
 def profile():
     if request.method == 'POST':
@@ -401,35 +1289,36 @@ def profile():
         current_password = request.form.get('current_password')
         new_password = request.form.get('new_password')
         repeat_password = request.form.get('repeat_password')        # Obtener información del usuario actual
-        db_path = app.config.get('DATABASE', 'music.db')
-        conn = sqlite3.connect(db_path)
+        conn = get_db()
         c = conn.cursor()
         c.execute("SELECT password, email FROM users WHERE id = ?", (session['user_id'],))
         user_data = c.fetchone()
         
         if not user_data:
             flash('Usuario no encontrado', 'error')
-            conn.close()
-            return redirect(url_for('logout'))
+            return redirect(url_for('main.logout'))
             
         if user_data:
             current_stored_password = user_data[0]
             
             # Verificar si se está intentando cambiar la contraseña
             if current_password and new_password:
-                if not check_password_hash(current_stored_password, current_password):
+                if not check_password(current_stored_password, current_password):
                     flash('La contraseña actual es incorrecta', 'error')
-                    return redirect(url_for('profile'))
+                    return redirect(url_for('main.profile'))
 
                 # Verificar que las contraseñas nuevas coincidan
                 if new_password != repeat_password:
                     flash('Las contraseñas nuevas no coinciden', 'error')
-                    return redirect(url_for('profile'))
+                    return redirect(url_for('main.profile'))
                 
                 # Actualizar contraseña
-                new_password_hash = generate_password_hash(new_password)
+                new_password_hash = hash_password(new_password)
                 c.execute("UPDATE users SET password = ? WHERE id = ?", 
                          (new_password_hash, session['user_id']))
+                password_changed = True
+            else:
+                password_changed = False
             
             # Actualizar email y username
             c.execute("UPDATE users SET email = ?, username = ? WHERE id = ?", 
@@ -438,33 +1327,26 @@ def profile():
             
             # Actualizar el nombre de usuario en la sesión
             session['username'] = username
+            sessions_backend = current_app.session_interface
+            if password_changed:
+                # Cerrar las demás sesiones abiertas con la contraseña antigua
+                sessions_backend.revoke_user(session['user_id'], keep_token=session.token)
+            else:
+                sessions_backend.forget_users([session['user_id']])
             
             flash('Perfil actualizado correctamente', 'success')
-        conn.close()
-        return redirect(url_for('profile'))
+        return redirect(url_for('main.profile'))
     
-    # Obtener información del usuario y estadísticas
-    db_path = app.config.get('DATABASE', 'music.db')
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    # Obtener datos del usuario
-    c.execute("SELECT username, email FROM users WHERE id = ?", (session['user_id'],))
-    user_data = c.fetchone()
-    if not user_data:
+    # Obtener información del usuario y estadísticas en una sola consulta
+    profile_data = get_user_profile(session['user_id'])
+    if not profile_data:
         flash('Usuario no encontrado', 'error')
-        return redirect(url_for('logout'))
+        return redirect(url_for('main.logout'))
         
-    user = {'username': user_data[0], 'email': user_data[1] if user_data[1] else ''}
+    user = {'username': profile_data['username'], 'email': profile_data['email'] or ''}
     
-    # Obtener estadísticas
-    c.execute("SELECT COUNT(*) FROM songs WHERE user_id = ?", (session['user_id'],))
-    songs_count = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM favorites WHERE user_id = ?", (session['user_id'],))
-    favorites_count = c.fetchone()[0]
-      # Obtener fecha de registro y calcular días
-    c.execute("SELECT created_at FROM users WHERE id = ?", (session['user_id'],))
-    created_at = c.fetchone()[0]
+    # Calcular los días desde el registro
+    created_at = profile_data['created_at']
     if created_at:
         from datetime import datetime
         created_date = datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S')
@@ -472,101 +1354,233 @@ def profile():
     else:
         days_registered = 0
     
-    conn.close()
-    
     stats = {
-        'songs_count': songs_count,
-        'favorites_count': favorites_count,
+        'songs_count': profile_data['songs_count'],
+        'favorites_count': profile_data['favorites_count'],
         'days_registered': days_registered
     }
     
     return render_template('profile.html', user=user, stats=stats)
 
-@app.route('/admin')
+@bp.route('/admin')
 @login_required
 @admin_required
 def admin_dashboard():
-    db_path = app.config.get('DATABASE', 'music.db')
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    
-    # Obtener todos los usuarios
-    c.execute("""
-        SELECT id, username, email, created_at, role 
-        FROM users 
-        ORDER BY created_at DESC
-    """)
-    users = [
-        {
-            'id': row[0],
-            'username': row[1],
-            'email': row[2],
-            'created_at': row[3],
-            'role': row[4]
-        }
-        for row in c.fetchall()
-    ]
-    
-    conn.close()
-    return render_template('admin.html', users=users)
+    # Solo la primera página: el resto la pide admin.js a /admin/api/users
+    try:
+        listing = admin_user_listing(request.args)
+    except ValueError as e:
+        flash(str(e), 'error')
+        listing = admin_user_listing({})
+    return render_template('admin.html', summary=get_admin_summary(), **listing)
+
+def admin_user_listing(args):
+    """
+    Lee búsqueda, rol, orden y página de los parámetros de la petición y
+    devuelve la página de usuarios correspondiente
+    """
+    search = (args.get('q') or '').strip()
+    role = args.get('role') or None
+    sort = args.get('sort') or 'created'
+    order = args.get('order') or ('asc' if sort == 'username' else 'desc')
+    try:
+        page = max(int(args.get('page') or 1), 1)
+        page_size = max(1, min(int(args.get('page_size') or ADMIN_PAGE_SIZE), ADMIN_MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        raise ValueError('page y page_size deben ser números')
+    if sort not in ADMIN_USER_SORTS:
+        raise ValueError(f'Orden no válido: {sort}')
+    if order not in ('asc', 'desc'):
+        raise ValueError(f'Dirección no válida: {order}')
+    if role is not None and role not in ADMIN_ROLES:
+        raise ValueError(f'Rol no válido: {role}')
+
+    users, total = get_admin_users(search, role, sort, order == 'desc', page_size, (page - 1) * page_size)
+    return {
+        'users': users,
+        'total': total,
+        'page': page,
+        'page_size': page_size,
+        'pages': max(1, -(-total // page_size)),
+        'q': search,
+        'role': role or '',
+        'sort': sort,
+        'order': order
+    }
+
+@bp.route('/admin/api/users', methods=['GET'])
+@login_required
+@admin_required
+def admin_users_api():
+    try:
+        return jsonify(admin_user_listing(request.args))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.exception("Error listing users")
+        return jsonify({'error': str(e)}), 500
 
 
 
-@app.route('/admin/delete_user', methods=['POST'])
+@bp.route('/admin/delete_user', methods=['POST'])
 @login_required
 @admin_required
 def admin_delete_user():
+    user_id = None
     try:
         data = request.get_json()
         user_id = data.get('userId')
         
-        db_path = app.config.get('DATABASE', 'music.db')
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        
-        # Verificar que no sea un admin
-        c.execute("SELECT role FROM users WHERE id = ?", (user_id,))
-        user = c.fetchone()
-        if user and user[0] == 'admin':
+        # Los administradores no se borran: delete_users los salta
+        if not delete_users([user_id]):
             return jsonify({'success': False, 'error': 'No se puede eliminar un administrador'})
         
-        # Eliminar primero los registros relacionados
-        c.execute("DELETE FROM favorites WHERE user_id = ?", (user_id,))
-        c.execute("DELETE FROM songs WHERE user_id = ?", (user_id,))
-        c.execute("DELETE FROM user_config WHERE user_id = ?", (user_id,))
-        c.execute("DELETE FROM users WHERE id = ?", (user_id,))
-        
-        conn.commit()
-        conn.close()
-        
         return jsonify({'success': True})
     except Exception as e:
-        print(f"Error deleting user: {e}")
+        logger.exception("Error deleting user %s", user_id)
         return jsonify({'success': False, 'error': str(e)})
 
+@bp.route('/admin/delete_users', methods=['POST'])
+@login_required
+@admin_required
+def admin_delete_users():
+    data = request.get_json(silent=True) or {}
+    user_ids = data.get('userIds')
+    if not isinstance(user_ids, list) or not user_ids:
+        return jsonify({'success': False, 'error': 'userIds debe ser una lista de ids'}), 400
+    try:
+        deleted = delete_users(user_ids)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'userIds debe ser una lista de ids'}), 400
+    except Exception as e:
+        logger.exception("Error deleting %s users", len(user_ids))
+        return jsonify({'success': False, 'error': str(e)}), 500
+    return jsonify({'success': True, 'deleted': len(deleted), 'skipped': len(set(map(int, user_ids))) - len(deleted)})
+
+@bp.route('/admin/purge_inactive', methods=['POST'])
+@login_required
+@admin_required
+def admin_purge_inactive():
+    """
+    Borra los usuarios inactivos desde hace ?days días. Con dry_run solo
+    devuelve cuántos serían
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        days = int(data.get('days', 0))
+    except (TypeError, ValueError):
+        days = 0
+    if days < 1:
+        return jsonify({'success': False, 'error': 'days debe ser un número de días mayor que 0'}), 400
+    # Con menos días se borrarían cuentas en uso cuya sesión aún no se ha renovado
+    min_days = math.ceil(current_app.permanent_session_lifetime.total_seconds() / 86400 / 2)
+    if days < min_days:
+        return jsonify({'success': False, 'error': f'days debe ser al menos {min_days}'}), 400
+    try:
+        user_ids = get_inactive_user_ids(days)
+        if data.get('dry_run'):
+            return jsonify({'success': True, 'matched': len(user_ids), 'deleted': 0})
+        deleted = delete_users(user_ids)
+        logger.info("Purged %s users inactive for %s days", len(deleted), days)
+        return jsonify({'success': True, 'matched': len(user_ids), 'deleted': len(deleted)})
+    except Exception as e:
+        logger.exception("Error purging inactive users")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@bp.route('/admin/stream_cache', methods=['GET'])
+@login_required
+@admin_required
+def admin_stream_cache():
+    return jsonify(get_services().stream_cache.stats())
+
+@bp.route('/admin/download_cache', methods=['GET'])
+@login_required
+@admin_required
+def admin_download_cache():
+    return jsonify(get_services().transcode_cache.stats())
+
+@bp.route('/metrics', methods=['GET'])
+def metrics_route():
+    # Pensado para un Prometheus local; desde fuera solo para administradores
+    if request.remote_addr not in current_app.config['METRICS_ALLOWED_ADDRS'] and (g.get('user') or {}).get('role') != 'admin':
+        return jsonify({'error': 'Acceso no autorizado'}), 403
+    collector = current_app.extensions.get('metrics')
+    body = collector.render() if collector is not None else registry.render()
+    return Response(body, content_type=metrics.CONTENT_TYPE)
+
 # API Endpoints
-@app.route('/api/songs', methods=['GET'])
+def paginated_list(fetch_rows, etag_prefix=None):
+    """
+    Responde con una página de fetch_rows(after_id, limit) si se pasa ?limit=,
+    indicando el cursor de la siguiente página en la cabecera X-Next-Cursor.
+    Con etag_prefix, responde 304 sin consultar nada más si el cliente ya
+    tiene esa misma página
+    """
+    after_id = request.args.get('after', 0, type=int)
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, LIST_MAX_PAGE_SIZE))
+
+    etag = None
+    if etag_prefix is not None:
+        etag = f'{etag_prefix}-{after_id}-{limit or "all"}'
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+
+    if limit is None:
+        response = jsonify(fetch_rows(after_id, None))
+    else:
+        # Pedir una fila de más para saber si hay otra página
+        rows = fetch_rows(after_id, limit + 1)
+        response = jsonify(rows[:limit])
+        if len(rows) > limit:
+            response.headers['X-Next-Cursor'] = str(rows[limit - 1]['id'])
+    if etag is not None:
+        response.set_etag(etag)
+        # El navegador guarda la lista pero la revalida siempre con If-None-Match
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@bp.route('/api/songs', methods=['GET'])
 @login_required
 def get_songs_route():
     try:
-        songs = get_songs(session['user_id'])
-        return jsonify(songs)
+        user_id = session['user_id']
+        revision = get_library_revision(user_id)
+        response = paginated_list(lambda after_id, limit: get_songs(user_id, after_id, limit),
+                                  etag_prefix=f'songs-{user_id}-{revision}')
+        # Punto de partida para /api/changes
+        response.headers['X-Library-Revision'] = str(revision)
+        return response
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/search', methods=['POST'])
+@bp.route('/api/search', methods=['POST'])
 @login_required
 def search_songs_route():
     try:
         data = request.json
         search_term = data.get('search_term', '')
+        limit = max(1, min(int(data.get('limit', SEARCH_PAGE_SIZE)), SEARCH_MAX_PAGE_SIZE))
+        offset = int(data.get('offset', 0))
+        if offset < 0:
+            return jsonify({'error': 'offset no puede ser negativo'}), 400
         user_id = session['user_id']
-        songs = search_songs(user_id, search_term)
-        return jsonify(songs)
+        # Pedir una fila de más para saber si hay otra página
+        songs = search_songs(user_id, search_term, limit + 1, offset)
+        response = jsonify(songs[:limit])
+        if len(songs) > limit:
+            response.headers['X-Next-Offset'] = str(offset + limit)
+        return response
+    except (TypeError, ValueError):
+        return jsonify({'error': 'limit y offset deben ser números'}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/play', methods=['POST'])
+@bp.route('/api/play', methods=['POST'])
 @login_required
 def play_song():
     try:
@@ -576,41 +1590,75 @@ def play_song():
         
         if not song_url:
             return jsonify({'error': 'Canción no encontrada'}), 404
-        ydl_opts = {
-            'format': 'bestaudio',  # Solo busca formatos de audio
-            'quiet': True,
-            'extract_flat': True,
-            'force_ipv4': True,
-            'socket_timeout': 5,  # Reducir timeout a 5 segundos
-            'nocheckcertificate': True,  # Evitar chequeos de certificados
-            'prefer_insecure': True,  # Preferir conexiones más rápidas aunque sean menos seguras
-            'geo_bypass': True  # Evitar restricciones geográficas
-        }          # Primero obtener la información de la canción de nuestra base de datos
-        db_path = app.config.get('DATABASE', 'music.db')
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
+
+        # Primero obtener la información de la canción de nuestra base de datos
+        c = get_db().cursor()
         c.execute("SELECT name, artist FROM songs WHERE id=? AND user_id=?", (song_id, session['user_id']))
         song_info = c.fetchone()
-        conn.close()
 
         if not song_info:
             return jsonify({'error': 'Canción no encontrada'}), 404
 
         song_name, artist = song_info
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(song_url, download=False)
-            return jsonify({
-                'audio_stream_url': info['url'],
-                'song_id': song_id,
-                'title': song_name,
-                'artist': artist
-            })
+        # Duración y portada si ya se conocen, sin preguntar a YouTube
+        video_id = extract_video_id(song_url)
+        metadata = get_video_metadata([video_id]).get(video_id) or {}
+
+        # Resolver ya la URL para que el proxy la encuentre en caché
+        resolve_stream_url(song_url)
+        return jsonify({
+            'audio_stream_url': url_for('main.stream_song', song_id=song_id),
+            'song_id': song_id,
+            'title': song_name,
+            'artist': artist,
+            'duration': metadata.get('duration'),
+            'thumbnail': metadata.get('thumbnail')
+        })
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("Unhandled error in %s", request.path)
         return jsonify({'error': str(e), 'fallback_url': song_url}), 500
 
-@app.route('/api/download', methods=['POST'])
+@bp.route('/api/stream/<int:song_id>', methods=['GET'])
+@login_required
+def stream_song(song_id):
+    song_url = get_song_url(song_id, session['user_id'])
+    if not song_url:
+        return jsonify({'error': 'Canción no encontrada'}), 404
+    
+    try:
+        upstream = open_upstream_stream(song_url, request.headers.get('Range'))
+    except Exception as e:
+        logger.exception("Unhandled error in %s", request.path)
+        return jsonify({'error': str(e)}), 502
+    
+    def generate():
+        # Reenviar el audio por trozos y devolver la conexión al pool
+        try:
+            for chunk in upstream.stream(STREAM_CHUNK_SIZE):
+                yield chunk
+        finally:
+            upstream.release_conn()
+    
+    headers = {name: upstream.headers[name] for name in STREAM_PASSTHROUGH_HEADERS if name in upstream.headers}
+    headers.setdefault('Accept-Ranges', 'bytes')
+    headers['Cache-Control'] = 'no-store'
+    return Response(generate(), status=upstream.status, headers=headers, direct_passthrough=True)
+
+@bp.route('/api/prefetch', methods=['POST'])
+@login_required
+def prefetch_route():
+    try:
+        data = request.json or {}
+        song_ids = [int(song_id) for song_id in data.get('song_ids', [])][:PREFETCH_MAX_SONGS]
+        song_urls = get_song_urls(song_ids, session['user_id'])
+        return jsonify({'scheduled': prefetch_streams(song_urls)}), 202
+    except (TypeError, ValueError):
+        return jsonify({'error': 'song_ids debe ser una lista de IDs'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api/download', methods=['POST'])
 @login_required
 def download_song():
     try:
@@ -621,28 +1669,39 @@ def download_song():
         
         if not song_url:
             return jsonify({'error': 'Canción no encontrada'}), 404
+        if format_type not in DOWNLOAD_FORMATS:
+            return jsonify({'error': 'Formato no soportado'}), 400
         
-        temp_dir = tempfile.mkdtemp()
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'quiet': True,
-            'outtmpl': os.path.join(temp_dir, '%(title)s.%(ext)s'),
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': format_type,
-                'preferredquality': '192',
-            }]
-        }
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(song_url, download=True)
-            filepath = ydl.prepare_filename(info).replace('.webm', f'.{format_type}').replace('.m4a', f'.{format_type}')
-            return send_file(filepath, as_attachment=True, download_name=f"{info['title']}.{format_type}")
+        job = get_services().download_queue.submit(session['user_id'], run_download, song_url, format_type)
+        return jsonify(job.to_dict()), 202
+    except QueueFullError as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("Unhandled error in %s", request.path)
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/delete', methods=['POST'])
+@bp.route('/api/download/<job_id>', methods=['GET'])
+@login_required
+def download_status(job_id):
+    job = get_services().download_queue.get(job_id, session['user_id'])
+    if job is None:
+        return jsonify({'error': 'Descarga no encontrada'}), 404
+    return jsonify(job.to_dict())
+
+@bp.route('/api/download/<job_id>/file', methods=['GET'])
+@login_required
+def download_file(job_id):
+    job = get_services().download_queue.get(job_id, session['user_id'])
+    if job is None:
+        return jsonify({'error': 'Descarga no encontrada'}), 404
+    if job.status != jobs.DONE:
+        return jsonify({'error': 'La descarga aún no ha terminado', 'status': job.status}), 409
+    if not os.path.exists(job.filepath):
+        # El fichero ha salido de la caché de descargas
+        return jsonify({'error': 'La descarga ha caducado'}), 410
+    return send_file(job.filepath, as_attachment=True, download_name=job.filename)
+
+@bp.route('/api/delete', methods=['POST'])
 @login_required
 def delete_song_route():
     try:
@@ -655,10 +1714,10 @@ def delete_song_route():
             return jsonify({'success': True})
         return jsonify({'success': False, 'error': 'Canción no encontrada o no tienes permiso para eliminarla'}), 404
     except Exception as e:
-        print(f"Error deleting song: {str(e)}")
+        logger.exception("Error deleting song")
         return jsonify({'success': False, 'error': 'Error al eliminar la canción'}), 500
 
-@app.route('/api/add_song', methods=['POST'])
+@bp.route('/api/add_song', methods=['POST'])
 @login_required
 def add_song_route():    
     try:
@@ -669,131 +1728,123 @@ def add_song_route():
         if not song_url:
             return jsonify({'error': 'URL es requerida'}), 400
         
-        if 'youtube.com' not in song_url and 'youtu.be' not in song_url:
+        if not is_youtube_url(song_url):
             return jsonify({'error': 'Solo se aceptan URLs de YouTube'}), 400
             
-        # Obtener el título del video usando yt-dlp
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': 'in_playlist',  # Extracción más rápida de metadatos
-            'force_ipv4': True,
-            'socket_timeout': 5,
-            'nocheckcertificate': True,
-            'prefer_insecure': True
-        }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:            
-            try:
-                info = ydl.extract_info(song_url, download=False)
-                song_name = info.get('title', '')
-                if not song_name:
-                    return jsonify({'error': 'No se pudo obtener el título del video'}), 400
-                  # Intentar obtener el artista del video de diferentes formas
-                artist = (
-                    info.get('artist', '') or           # Metadatos del artista
-                    info.get('creator', '') or          # Creador del video
-                    info.get('uploader', '') or         # Quien subió el video
-                    info.get('channel', '')             # Nombre del canal
-                )
-                
-                # Si no se encontró el artista, intentar extraerlo del título
-                if not artist and ' - ' in song_name:
-                    # Formatos comunes: "Artista - Canción", "Artista - Topic - Canción"
-                    parts = song_name.split(' - ')
-                    artist = parts[0].strip()
-                    # Si hay "Topic" en el nombre del artista, usar solo la primera parte
-                    if 'topic' in artist.lower():
-                        artist = artist.split('Topic')[0].strip()
-                
-                # Si aún no hay artista, intentar usar el nombre del canal sin "- Topic"
-                if not artist:
-                    channel = info.get('channel', '')
-                    if channel:
-                        if ' - Topic' in channel:
-                            artist = channel.replace(' - Topic', '').strip()
-                        else:
-                            artist = channel
-                
-                # Si todo lo anterior falló, usar "Artista Desconocido"
-                if not artist:
-                    artist = 'Artista Desconocido'
-                    
-                song_id = add_song(song_name, artist, song_url, user_id)
-                if song_id:
-                    new_song = {
-                        'id': song_id,
-                        'name': song_name,
-                        'artist': artist,
-                        'url': song_url,
-                        'user_id': user_id
-                    }                    
-                    return jsonify({'success': True, 'song': new_song})
-                return jsonify({'error': 'La canción ya existe'}), 400
-            except Exception as e:
-                return jsonify({'error': 'Error al procesar el video: ' + str(e)}), 400
+        # Obtener el título y el artista del video usando yt-dlp
+        try:
+            song_name, artist = extract_song_metadata(song_url)
+        except Exception as e:
+            return jsonify({'error': 'Error al procesar el video: ' + str(e)}), 400
+            
+        song_id = add_song(song_name, artist, song_url, user_id)
+        if song_id:
+            new_song = {
+                'id': song_id,
+                'name': song_name,
+                'artist': artist,
+                'url': song_url,
+                'user_id': user_id
+            }                    
+            return jsonify({'success': True, 'song': new_song})
+        return jsonify({'error': 'La canción ya existe'}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/favorites', methods=['GET'])
+@bp.route('/api/import', methods=['POST'])
+@login_required
+def import_songs_route():
+    try:
+        data = request.json or {}
+        playlist_url = data.get('playlist_url')
+        song_urls = data.get('urls') or []
+        
+        if not playlist_url and not song_urls:
+            return jsonify({'error': 'Se requiere playlist_url o urls'}), 400
+        if playlist_url is not None and not isinstance(playlist_url, str):
+            return jsonify({'error': 'playlist_url debe ser una URL'}), 400
+        if not isinstance(song_urls, list) or not all(isinstance(url, str) for url in song_urls):
+            return jsonify({'error': 'urls debe ser una lista de URLs'}), 400
+        if not all(is_youtube_url(url) for url in ([playlist_url] if playlist_url else song_urls)):
+            return jsonify({'error': 'Solo se aceptan URLs de YouTube'}), 400
+        
+        job = get_services().import_queue.submit(session['user_id'], run_import, session['user_id'], playlist_url, song_urls)
+        return jsonify(job.to_dict()), 202
+    except QueueFullError as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api/import/<job_id>', methods=['GET'])
+@login_required
+def import_status(job_id):
+    job = get_services().import_queue.get(job_id, session['user_id'])
+    if job is None:
+        return jsonify({'error': 'Importación no encontrada'}), 404
+    return jsonify(job.to_dict())
+
+@bp.route('/api/favorites', methods=['GET'])
 @login_required
 def get_favorites_route():
     try:
-        favorites = get_favorites(session['user_id'])
-        return jsonify(favorites)
+        user_id = session['user_id']
+        revision = get_library_revision(user_id)
+        response = paginated_list(lambda after_id, limit: get_favorites(user_id, after_id, limit),
+                                  etag_prefix=f'favorites-{user_id}-{revision}')
+        response.headers['X-Library-Revision'] = str(revision)
+        return response
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api/changes', methods=['GET'])
+@login_required
+def library_changes_route():
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify({'error': 'since es requerido'}), 400
+    try:
+        return jsonify(get_library_changes(session['user_id'], since))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/toggle_favorite', methods=['POST'])
+@bp.route('/api/toggle_favorite', methods=['POST'])
 @login_required
 def toggle_favorite():
     try:
         data = request.json
         if not data or 'song_id' not in data:
-            print("[toggle_favorite] No song_id in request")
             return jsonify({'error': 'song_id es requerido'}), 400
             
         song_id = data.get('song_id')
         user_id = session['user_id']
-        print(f"[toggle_favorite] song_id: {song_id}, user_id: {user_id}")
         
-        # First verify the song exists
-        db_path = app.config.get('DATABASE', 'music.db')
-        print(f"[toggle_favorite] Using database: {db_path}")
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        c.execute("SELECT 1 FROM songs WHERE id=?", (song_id,))
+        # First verify the song exists and belongs to the user
+        c = get_db().cursor()
+        c.execute("SELECT 1 FROM songs WHERE id=? AND user_id=?", (song_id, user_id))
         song_exists = c.fetchone() is not None
-        conn.close()
         
         if not song_exists:
-            print("[toggle_favorite] Song not found")
             return jsonify({'error': 'Canción no encontrada'}), 404
         
-        print("[toggle_favorite] Song exists, checking current favorite status")
         # Check current favorite status
         current_status = is_favorite(user_id, song_id)
-        print(f"[toggle_favorite] Current favorite status: {current_status}")
         
         # Toggle the status
         if current_status:
-            print("[toggle_favorite] Removing from favorites")
             success = remove_favorite(user_id, song_id)
         else:
-            print("[toggle_favorite] Adding to favorites")
             success = add_favorite(user_id, song_id)
             
         if not success:
-            print("[toggle_favorite] Error updating favorites")
             return jsonify({'error': 'Error al actualizar favoritos'}), 500
             
         new_status = not current_status
-        print(f"[toggle_favorite] Operation successful, new status: {new_status}")
         return jsonify({'is_favorite': new_status})
     except Exception as e:
-        print(f"[toggle_favorite] Error: {e}")
+        logger.exception("Error toggling favorite")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/is_favorite', methods=['POST'])
+@bp.route('/api/is_favorite', methods=['POST'])
 @login_required
 def is_favorite_route():
     try:
@@ -805,7 +1856,70 @@ def is_favorite_route():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/config')
+@bp.route('/api/favorites/status', methods=['POST'])
+@login_required
+def favorite_statuses_route():
+    try:
+        data = request.json or {}
+        song_ids = [int(song_id) for song_id in data.get('song_ids', [])]
+        statuses = get_favorite_statuses(session['user_id'], song_ids)
+        return jsonify({'statuses': {str(song_id): status for song_id, status in statuses.items()}})
+    except (TypeError, ValueError):
+        return jsonify({'error': 'song_ids debe ser una lista de IDs'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api/events', methods=['GET'])
+@login_required
+def events_route():
+    """
+    Canal de server-sent events con los cambios de la biblioteca y el final
+    de los trabajos del usuario. No retiene ninguna conexión a la base de
+    datos: solo la pide un momento en cada latido, para ver cambios hechos
+    desde otros procesos del servidor
+    """
+    user_id = session['user_id']
+    try:
+        subscription = get_services().events.subscribe(user_id)
+    except TooManySubscribersError as e:
+        return jsonify({'error': str(e)}), 503
+
+    app = current_app._get_current_object()
+    heartbeat = app.config['EVENTS_HEARTBEAT']
+    max_duration = app.config['EVENTS_MAX_DURATION']
+    revision = get_library_revision(user_id)
+
+    def generate():
+        last_revision = revision
+        deadline = time.monotonic() + max_duration
+        try:
+            yield events.format_event('hello', {'revision': revision}, retry=heartbeat)
+            # Pasado max_duration se corta y el navegador se reconecta solo,
+            # para que los hilos del worker no queden ocupados para siempre
+            while time.monotonic() < deadline:
+                item = subscription.get(timeout=heartbeat)
+                if item is events.CLOSED:
+                    return
+                if item is None:
+                    with app.app_context():
+                        current = get_library_revision(user_id)
+                    if current == last_revision:
+                        yield ': ping\n\n'
+                        continue
+                    item = ('library', {'revision': current})
+                event, data = item
+                if event == 'library':
+                    last_revision = data['revision']
+                yield events.format_event(event, data)
+        finally:
+            subscription.close()
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@bp.route('/config')
 @login_required
 def config():
     user_config = get_user_config(session['user_id'])
@@ -814,7 +1928,7 @@ def config():
                          email=session.get('email'),
                          config=user_config)
 
-@app.route('/save_config', methods=['POST'])
+@bp.route('/save_config', methods=['POST'])
 def save_config():
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Not logged in'})
@@ -827,14 +1941,14 @@ def save_config():
         success = save_user_config(session['user_id'], dark_mode, default_volume)
         return jsonify({'success': success})
     except Exception as e:
-        print(f"Error saving config: {e}")
+        logger.exception("Error saving config")
         return jsonify({'success': False, 'error': str(e)})
 
-@app.route('/delete_account', methods=['POST'])
+@bp.route('/delete_account', methods=['POST'])
 def delete_account():
     if 'user_id' not in session:
         flash('Debes iniciar sesión primero.', 'error')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     from DDBB import delete_user
     
@@ -842,27 +1956,28 @@ def delete_account():
     current_password = request.form.get('current_password')
     
     # Verify the password before deletion
-    conn = sqlite3.connect('music.db')
-    c = conn.cursor()
+    c = get_db().cursor()
     c.execute("SELECT password FROM users WHERE id=?", (session['user_id'],))
     user = c.fetchone()
-    conn.close()
 
-    if not user or not check_password_hash(user[0], current_password):
+    if not user or not check_password(user[0], current_password):
         flash('Contraseña incorrecta. Por favor, inténtalo de nuevo.', 'error')
-        return redirect(url_for('profile'))
+        return redirect(url_for('main.profile'))
 
     # Delete the account
     if delete_user(session['user_id']):
+        get_services().events.publish(session['user_id'], 'logout')
+        current_app.session_interface.revoke_user(session['user_id'])
         session.clear()
         flash('Tu cuenta ha sido eliminada correctamente.', 'success')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     else:
         flash('Ha ocurrido un error al eliminar la cuenta. Por favor, inténtalo de nuevo.', 'error')
-        return redirect(url_for('profile'))
+        return redirect(url_for('main.profile'))
 
 if __name__ == "__main__":
-    init_db()
-    # Configuración para producción
-    app.config['SERVER_NAME'] = None
-    app.run(debug=False, host="0.0.0.0", port=8501, threaded=True)
\ No newline at end of file
+    app = create_app()
+    with app.app_context():
+        init_db()
+    # Servidor de desarrollo; en producción se usa gunicorn con wsgi.py
+    app.run(debug=False, host="0.0.0.0", port=8501, threaded=True)
@@ -0,0 +1,106 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+from flask import Blueprint, Response, abort, current_app, redirect, request, url_for
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:     # Brotli es opcional: sin él solo se sirve gzip
+    brotli = None
+
+# Ficheros de static/ servidos con un hash de su contenido en la URL. Como la
+# URL cambia cuando cambia el fichero, el navegador puede guardarlos un año
+# sin volver a preguntar.
+IMMUTABLE = 'public, max-age=31536000, immutable'
+COMPRESSIBLE = ('.css', '.js', '.svg', '.ico', '.json', '.txt')
+MIN_COMPRESS_SIZE = 512
+DIGEST_LENGTH = 12
+
+bp = Blueprint('assets', __name__)
+
+
+class Asset:
+    def __init__(self, path):
+        stat = os.stat(path)
+        self.signature = (stat.st_mtime_ns, stat.st_size)
+        with open(path, 'rb') as f:
+            self.body = f.read()
+        self.digest = hashlib.sha256(self.body).hexdigest()[:DIGEST_LENGTH]
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        # Comprimir una sola vez por versión del fichero, no en cada petición
+        self.encoded = {}
+        if path.endswith(COMPRESSIBLE) and len(self.body) >= MIN_COMPRESS_SIZE:
+            if brotli is not None:
+                self.encoded['br'] = brotli.compress(self.body, quality=11)
+            self.encoded['gzip'] = gzip.compress(self.body, compresslevel=9, mtime=0)
+
+
+class AssetManager:
+    """
+    Hashes y versiones comprimidas de los ficheros estáticos, en memoria.
+    Se recalculan solos si el fichero cambia en disco
+    """
+
+    def __init__(self, static_folder):
+        self.static_folder = static_folder
+        self._assets = {}
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        path = safe_join(self.static_folder, filename)
+        if path is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        asset = self._assets.get(filename)
+        if asset is None or asset.signature != (stat.st_mtime_ns, stat.st_size):
+            asset = Asset(path)
+            with self._lock:
+                self._assets[filename] = asset
+        return asset
+
+
+def asset_url(filename):
+    """
+    URL de un fichero de static/ con el hash de su contenido. Para uso en
+    las plantillas: {{ asset_url('js/main.js') }}
+    """
+    asset = current_app.extensions['assets'].get(filename)
+    if asset is None:
+        return url_for('static', filename=filename)
+    return url_for('assets.asset', digest=asset.digest, filename=filename)
+
+
+@bp.route('/assets/<digest>/<path:filename>')
+def asset(digest, filename):
+    current = current_app.extensions['assets'].get(filename)
+    if current is None:
+        abort(404)
+    if digest != current.digest:
+        # Una página antigua pide una versión anterior: mandarla a la actual
+        response = redirect(url_for('assets.asset', digest=current.digest, filename=filename))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    encoding = next((name for name in ('br', 'gzip')
+                     if name in current.encoded and name in request.accept_encodings), None)
+    response = Response(current.encoded[encoding] if encoding else current.body, mimetype=current.mimetype)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if current.encoded:
+        response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.set_etag(f'{current.digest}-{encoding or "identity"}')
+    return response.make_conditional(request)
+
+
+def init_app(app):
+    app.extensions['assets'] = AssetManager(app.static_folder)
+    app.add_template_global(asset_url)
+    app.register_blueprint(bp)
@@ -0,0 +1,112 @@
+import sqlite3
+import threading
+from flask import current_app, g
+
+# Configuración de las conexiones SQLite
+BUSY_TIMEOUT = 5.0          # Segundos de espera si la base de datos está bloqueada
+MAX_IDLE_CONNECTIONS = 8    # Conexiones ociosas que se conservan por base de datos
+CACHE_SIZE_KB = 8192        # Caché de páginas por conexión
+MMAP_SIZE = 64 * 1024 * 1024
+
+
+def connect(db_path):
+    """
+    Abre una conexión configurada con WAL y los pragmas de rendimiento
+    """
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(BUSY_TIMEOUT * 1000)}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    # Borrados en cascada de canciones, favoritos y configuración de un usuario
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    return conn
+
+
+class ConnectionPool:
+    """
+    Conjunto de conexiones reutilizables a una misma base de datos.
+
+    Cada conexión la usa un único hilo a la vez: se presta con acquire()
+    y se devuelve con release() al terminar el contexto de la aplicación.
+    """
+
+    def __init__(self, db_path, max_idle=MAX_IDLE_CONNECTIONS):
+        self.db_path = db_path
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return connect(self.db_path)
+
+    def release(self, conn):
+        # Nunca devolver al pool una conexión con una transacción a medias
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if not self._closed and len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path):
+    pool = _pools.get(db_path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(db_path)
+            if pool is None:
+                pool = _pools[db_path] = ConnectionPool(db_path)
+    return pool
+
+
+def close_pool(db_path):
+    """
+    Cierra las conexiones ociosas de una base de datos. Las conexiones
+    prestadas en ese momento se cierran al devolverse.
+    """
+    with _pools_lock:
+        pool = _pools.pop(db_path, None)
+    if pool is not None:
+        pool.close()
+
+
+def get_db():
+    """
+    Devuelve la conexión del contexto de aplicación actual, tomándola del
+    pool la primera vez que se pide
+    """
+    if 'db' not in g:
+        pool = get_pool(current_app.config['DATABASE'])
+        g.db_pool = pool
+        g.db = pool.acquire()
+    return g.db
+
+
+def release_db(exception=None):
+    conn = g.pop('db', None)
+    pool = g.pop('db_pool', None)
+    if conn is not None:
+        pool.release(conn)
+
+
+def init_app(app):
+    app.teardown_appcontext(release_db)
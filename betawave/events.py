@@ -0,0 +1,132 @@
+import json
+import queue
+import threading
+
+# Eventos que se mandan a los navegadores por /api/events (server-sent events)
+DEFAULT_MAX_SUBSCRIBERS = 100
+DEFAULT_QUEUE_SIZE = 100
+
+CLOSED = object()
+
+
+class TooManySubscribersError(Exception):
+    pass
+
+
+class Subscription:
+    """
+    Cola de eventos de un navegador conectado. Si el navegador no consume y
+    la cola se llena, los eventos más viejos se descartan y se avisa con un
+    evento 'resync' para que vuelva a pedir lo que le falte
+    """
+
+    def __init__(self, bus, user_id, max_size):
+        self.bus = bus
+        self.user_id = user_id
+        self._queue = queue.Queue(maxsize=max_size)
+        self.overflowed = False
+        self.closed = False
+
+    def put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """
+        Devuelve (evento, datos), None si pasa timeout sin eventos o CLOSED
+        si el bus se ha cerrado
+        """
+        if self.closed:
+            return CLOSED
+        if self.overflowed:
+            self.overflowed = False
+            self._drain()
+            return ('resync', {})
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _drain(self):
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class EventBus:
+    """
+    Publicación y suscripción en memoria, por usuario. Solo llega a los
+    navegadores conectados a este proceso; /api/events cubre los cambios
+    hechos en otros procesos comprobando la revisión de la biblioteca
+    """
+
+    def __init__(self, max_subscribers=DEFAULT_MAX_SUBSCRIBERS, queue_size=DEFAULT_QUEUE_SIZE):
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self._subscribers = {}
+        self._count = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        with self._lock:
+            if self._closed or self._count >= self.max_subscribers:
+                raise TooManySubscribersError('Demasiadas conexiones de eventos')
+            subscription = Subscription(self, user_id, self.queue_size)
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+            self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers is None or subscription not in subscribers:
+                return
+            subscribers.discard(subscription)
+            self._count -= 1
+            if not subscribers:
+                del self._subscribers[subscription.user_id]
+
+    def has_subscribers(self, user_id):
+        return user_id in self._subscribers
+
+    def publish(self, user_id, event, data=None):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for subscription in subscribers:
+            subscription.put((event, data or {}))
+        return len(subscribers)
+
+    def close(self):
+        """
+        Termina todas las conexiones abiertas, p. ej. al parar el proceso
+        """
+        with self._lock:
+            self._closed = True
+            subscribers = [s for group in self._subscribers.values() for s in group]
+        for subscription in subscribers:
+            subscription.closed = True
+            # Despertar al que esté esperando en get()
+            subscription.put(CLOSED)
+
+    def count(self):
+        return self._count
+
+
+def format_event(event, data, retry=None):
+    """
+    Serializa un evento en el formato de text/event-stream
+    """
+    lines = []
+    if retry is not None:
+        lines.append(f'retry: {int(retry * 1000)}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+    return '\n'.join(lines) + '\n\n'
@@ -0,0 +1,72 @@
+import multiprocessing
+import os
+import tempfile
+
+# Configuración de gunicorn para Betawave. Todo se puede cambiar con
+# variables de entorno sin reconstruir la imagen.
+
+bind = os.environ.get('BIND', '0.0.0.0:8501')
+
+# Varios procesos para usar todos los núcleos, y varios hilos por proceso
+# porque las peticiones pasan casi todo el tiempo esperando a YouTube. Las
+# conexiones a /api/events también ocupan un hilo (ver EVENTS_MAX_SUBSCRIBERS)
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
+
+# Reciclar cada proceso tras un número de peticiones, con algo de azar para
+# que no se reinicien todos a la vez. Desactivado por defecto: las descargas
+# e importaciones corren en hilos del worker, y al reciclarlo solo se espera
+# JOBS_SHUTDOWN_TIMEOUT segundos a que terminen (las consultas del estado de
+# un trabajo también cuentan como peticiones)
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('WEB_MAX_REQUESTS_JITTER', 100))
+
+# Las extracciones con yt-dlp y el proxy de audio pueden tardar
+timeout = int(os.environ.get('WEB_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+# La aplicación se carga una vez en el proceso principal y los workers la
+# heredan al hacer fork, lo que reduce memoria y tiempo de arranque
+preload_app = True
+
+# Cada worker tiene sus propias métricas; se vuelcan aquí para que /metrics
+# devuelva la suma de todos, responda el que responda (ver metrics.py)
+metrics_dir = os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'betawave-metrics'))
+
+accesslog = None            # Las peticiones ya se registran en log_config.py
+errorlog = '-'
+
+
+def on_starting(server):
+    # Los contadores empiezan de cero con cada arranque del servidor
+    import metrics
+    metrics.reset_directory(metrics_dir)
+
+    # Crear o migrar la base de datos una sola vez, antes de lanzar los workers
+    from app import init_db
+    from wsgi import app
+    with app.app_context():
+        init_db()
+
+
+def post_fork(server, worker):
+    # No compartir con el proceso padre conexiones SQLite abiertas
+    import db
+    from wsgi import app
+    db.close_pool(app.config['DATABASE'])
+    app.extensions['metrics'].start()
+
+
+def worker_exit(server, worker):
+    from app import shutdown
+    from wsgi import app
+    shutdown(app)
+    app.extensions['metrics'].stop()
+
+
+def child_exit(server, worker):
+    # En el proceso principal: guardar lo que contó el worker que ha terminado
+    import metrics
+    metrics.archive_process(metrics_dir, worker.pid)
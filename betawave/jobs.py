@@ -0,0 +1,240 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from db import get_db
+
+# Estados de un trabajo
+QUEUED = 'queued'
+RUNNING = 'running'
+PROCESSING = 'processing'
+DONE = 'done'
+ERROR = 'error'
+
+FINISHED_STATES = (DONE, ERROR)
+
+SAVE_INTERVAL = 0.5         # Segundos mínimos entre escrituras del progreso
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, user_id):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.status = QUEUED
+        self.progress = 0.0
+        self.filepath = None
+        self.filename = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._queue = None
+        self._saved_at = 0.0
+
+    def save(self, force=False):
+        """
+        Publica el estado del trabajo para los demás procesos. Las llamadas
+        frecuentes (progreso) se agrupan para no escribir en cada una
+        """
+        if self._queue is None or self._queue.store is None:
+            return
+        now = time.monotonic()
+        if force or now - self._saved_at >= SAVE_INTERVAL:
+            self._saved_at = now
+            self._queue.store.save(self._queue.name, self)
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'progress': round(self.progress, 1),
+            'filename': self.filename,
+            'result': self.result,
+            'error': self.error
+        }
+
+
+class JobStore:
+    """
+    Guarda el estado de los trabajos en la tabla jobs, para que cualquier
+    proceso del servidor pueda responder por un trabajo que corre en otro
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def save(self, queue_name, job):
+        with self.app.app_context():
+            conn = get_db()
+            try:
+                conn.execute("""INSERT OR REPLACE INTO jobs
+                                (id, queue, user_id, status, progress, filepath, filename,
+                                 result, error, created_at, finished_at)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                             (job.id, queue_name, job.user_id, job.status, job.progress, job.filepath,
+                              job.filename, json.dumps(job.result), job.error, job.created_at,
+                              job.finished_at))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                logger.exception("Could not save job %s", job.id)
+
+    def load(self, queue_name, job_id):
+        with self.app.app_context():
+            row = get_db().execute("""SELECT user_id, status, progress, filepath, filename,
+                                             result, error, created_at, finished_at
+                                      FROM jobs WHERE id=? AND queue=?""", (job_id, queue_name)).fetchone()
+        if row is None:
+            return None
+        job = Job(row[0])
+        job.id = job_id
+        (job.status, job.progress, job.filepath, job.filename) = row[1:5]
+        job.result = json.loads(row[5]) if row[5] else None
+        job.error, job.created_at, job.finished_at = row[6:9]
+        return job
+
+    def delete_finished(self, queue_name, before):
+        with self.app.app_context():
+            conn = get_db()
+            conn.execute("DELETE FROM jobs WHERE queue=? AND finished_at < ?", (queue_name, before))
+            conn.commit()
+
+
+class JobQueue:
+    """
+    Cola de trabajos en segundo plano con un número limitado de hilos.
+
+    func(job, *args) hace el trabajo y puede ir actualizando job.progress y
+    job.status, llamando a job.save() para publicarlos. Los trabajos
+    terminados se olvidan pasados ttl segundos. Con un JobStore, get() encuentra también los trabajos de otros
+    procesos. Con app, cada trabajo se ejecuta dentro de su contexto.
+    on_finish(job) se llama al terminar cada trabajo, bien o con error.
+    """
+
+    def __init__(self, max_workers=2, max_pending=20, ttl=600, name='jobs', store=None, app=None,
+                 on_finish=None):
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.name = name
+        self.store = store
+        self.app = app
+        self.on_finish = on_finish
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, user_id, func, *args):
+        self.cleanup()
+        with self._lock:
+            active = sum(1 for job in self._jobs.values() if job.status not in FINISHED_STATES)
+            if active >= self.max_pending:
+                raise QueueFullError('Hay demasiados trabajos en cola')
+            job = Job(user_id)
+            job._queue = self
+            self._jobs[job.id] = job
+        job.save(force=True)
+        self._executor.submit(self._run, job, func, args)
+        return job
+
+    def _run(self, job, func, args):
+        job.status = RUNNING
+        job.save(force=True)
+        try:
+            if self.app is not None:
+                with self.app.app_context():
+                    func(job, *args)
+            else:
+                func(job, *args)
+            job.progress = 100.0
+            job.status = DONE
+        except Exception as e:
+            logger.exception("Job %s failed", job.id)
+            job.error = str(e)
+            job.status = ERROR
+        finally:
+            job.finished_at = time.time()
+            job.save(force=True)
+            self._notify(job)
+
+    def _notify(self, job):
+        if self.on_finish is None:
+            return
+        try:
+            self.on_finish(job)
+        except Exception:
+            logger.exception("on_finish failed for job %s", job.id)
+
+    def get(self, job_id, user_id=None):
+        """
+        Devuelve el trabajo, o None si no existe o pertenece a otro usuario
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.store is not None:
+            job = self.store.load(self.name, job_id)
+            if job is not None and job.status not in FINISHED_STATES and job.created_at < time.time() - self.ttl:
+                # El proceso que lo ejecutaba terminó sin llegar a cerrarlo
+                job.status = ERROR
+                job.error = 'El trabajo se interrumpió'
+        if job is None or (user_id is not None and job.user_id != user_id):
+            return None
+        return job
+
+    def cleanup(self):
+        limit = time.time() - self.ttl
+        with self._lock:
+            expired = [job for job in self._jobs.values()
+                       if job.finished_at is not None and job.finished_at < limit]
+            for job in expired:
+                del self._jobs[job.id]
+        if expired and self.store is not None:
+            self.store.delete_finished(self.name, limit)
+
+    def _unfinished(self, states):
+        with self._lock:
+            return [job for job in self._jobs.values() if job.status in states]
+
+    def _abort(self, job, error):
+        job.status = ERROR
+        job.error = error
+        job.finished_at = time.time()
+        job.save(force=True)
+        self._notify(job)
+
+    def close(self):
+        """
+        Deja de aceptar trabajos y marca como fallidos los que no llegaron a
+        empezar. Los que están en marcha siguen
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for job in self._unfinished((QUEUED,)):
+            self._abort(job, 'El servidor se está reiniciando')
+
+    def shutdown(self, timeout=0):
+        """
+        Cierra la cola y espera hasta timeout segundos a los trabajos en
+        marcha. Los que no terminen a tiempo se marcan como interrumpidos,
+        para que los demás procesos no los den por vivos hasta que caduquen
+        """
+        self.close()
+        deadline = time.monotonic() + timeout
+        while self._unfinished((RUNNING, PROCESSING)) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        for job in self._unfinished((RUNNING, PROCESSING)):
+            self._abort(job, 'El trabajo se interrumpió')
+
+    def stats(self):
+        with self._lock:
+            counts = {state: 0 for state in (QUEUED, RUNNING, PROCESSING, DONE, ERROR)}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+        return counts
@@ -0,0 +1,106 @@
+import json
+import logging
+import random
+import sys
+import time
+import uuid
+
+from flask import g, has_request_context, request
+
+# Campos estándar de LogRecord que no se copian como campos extra del JSON
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id'}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Escribe cada registro como una línea JSON. Los argumentos de extra={...}
+    se añaden como campos propios
+    """
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None)
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    Añade a cada registro el id de la petición en curso, si la hay
+    """
+
+    def filter(self, record):
+        record.request_id = g.get('request_id') if has_request_context() else None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Deja pasar solo una fracción de los registros por debajo de WARNING.
+    Los avisos y errores se escriben siempre
+    """
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or self.rate >= 1.0 or random.random() < self.rate
+
+
+def configure_logging(level='INFO', json_format=True, sample_rate=1.0, stream=None):
+    """
+    Configura el logger raíz con un único handler a stderr. Se puede llamar
+    varias veces: sustituye el handler anterior
+    """
+    handler = logging.StreamHandler(stream or sys.stderr)
+    if json_format:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'))
+    handler.addFilter(RequestIdFilter())
+    handler.addFilter(SamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    for old in [h for h in root.handlers if getattr(h, '_betawave', False)]:
+        root.removeHandler(old)
+    handler._betawave = True
+    root.addHandler(handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    # Las peticiones ya se registran aquí; el log de werkzeug sería duplicado
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+
+def init_app(app):
+    """
+    Asigna un id a cada petición (o reutiliza X-Request-ID) y registra la
+    petición al terminar, con su duración
+    """
+    logger = logging.getLogger('betawave.request')
+
+    @app.before_request
+    def assign_request_id():
+        g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex[:16]
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def log_request(response):
+        response.headers['X-Request-ID'] = g.get('request_id', '')
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('%s %s %s', request.method, request.path, response.status_code, extra={
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'duration_ms': round((time.perf_counter() - g.get('request_start', time.perf_counter())) * 1000, 2)
+            })
+        return response
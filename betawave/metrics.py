@@ -0,0 +1,415 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import fcntl
+except ImportError:     # Windows: solo servidor de desarrollo, un proceso
+    fcntl = None
+
+from flask import g, request
+
+# Límites de los histogramas de latencia, en segundos
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Segundos entre volcados de las métricas de cada worker (ver MultiProcessCollector)
+DEFAULT_FLUSH_INTERVAL = 5
+ARCHIVE_FILE = 'archive.json'
+LOCK_FILE = 'metrics.lock'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    cumulative = True
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    def collect(self):
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self, values=None):
+        values = self.collect() if values is None else values
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{_labels(self.labelnames, key)} {_number(value)}')
+        return lines
+
+
+class _Timer:
+    """
+    Mide lo que tarda un bloque y lo anota en el histograma
+    """
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self._start, **self.labels)
+        return False
+
+
+class Histogram:
+    cumulative = True
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # clave de etiquetas -> [cuentas por tramo..., suma, total]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            if index < len(self.buckets):
+                state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def timed(self, **labels):
+        """
+        Decorador equivalente a envolver toda la función en time()
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with _Timer(self, labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, **labels):
+        state = self._values.get(tuple(str(labels[name]) for name in self.labelnames))
+        return state[-1] if state else 0
+
+    def collect(self):
+        with self._lock:
+            return {key: list(state) for key, state in self._values.items()}
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self, values=None):
+        values = self.collect() if values is None else values
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for key, state in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, [("le", _number(bound))])} {cumulative}')
+            lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, [("le", "+Inf")])} {state[-1]}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {_number(state[-2])}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {state[-1]}')
+        return lines
+
+
+class Callback:
+    """
+    Métrica que se calcula al exportar, a partir de otros objetos (cachés,
+    colas...). func devuelve un número, o {tupla de etiquetas: número}.
+
+    Con varios procesos los valores de cada uno se suman. combine(valores)
+    sirve para las que no se pueden sumar, como un porcentaje: recibe los
+    valores ya sumados de todas las métricas y calcula el suyo a partir de
+    ellos
+    """
+
+    def __init__(self, name, documentation, func, labelnames=(), kind='gauge', combine=None):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+        self.combine = combine
+
+    @property
+    def cumulative(self):
+        return self.kind == 'counter'
+
+    def collect(self):
+        values = self.func()
+        return values if isinstance(values, dict) else {(): values}
+
+    def reset(self):
+        pass
+
+    def render(self, values=None):
+        values = self.collect() if values is None else values
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{_labels(self.labelnames, key)} {_number(value)}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        # Varias apps en un mismo proceso comparten las métricas ya creadas
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError(f'Metric {metric.name} already registered')
+                return existing
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name, documentation, func, labelnames=(), kind='gauge', combine=None):
+        return self._register(Callback(name, documentation, func, labelnames, kind, combine))
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def collect(self):
+        return {metric.name: metric.collect() for metric in self.metrics()}
+
+    def reset(self):
+        """
+        Pone a cero contadores e histogramas, p. ej. en un worker recién
+        creado con fork, que hereda los del proceso principal
+        """
+        for metric in self.metrics():
+            metric.reset()
+
+    def render(self, samples=None):
+        """
+        Devuelve todas las métricas en el formato de texto de Prometheus.
+        samples ({nombre: valores}) sustituye a los valores del proceso
+        """
+        lines = []
+        for metric in self.metrics():
+            lines.extend(metric.render(None if samples is None else samples.get(metric.name, {})))
+        return '\n'.join(lines) + '\n'
+
+
+def _add(total, values):
+    for key, value in values.items():
+        if isinstance(value, list):
+            current = total.get(key)
+            total[key] = value if current is None else [a + b for a, b in zip(current, value)]
+        else:
+            total[key] = total.get(key, 0) + value
+
+
+def _dump(samples):
+    # JSON no admite tuplas como claves
+    return {name: {'cumulative': cumulative, 'values': [[list(key), value] for key, value in values.items()]}
+            for name, (cumulative, values) in samples.items()}
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {name: (entry['cumulative'], {tuple(key): value for key, value in entry['values']})
+            for name, entry in data.items()}
+
+
+def _write(path, samples):
+    # Escribir aparte y renombrar: quien lea ve el fichero antiguo o el nuevo entero
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(_dump(samples), f)
+    os.replace(tmp, path)
+
+
+@contextmanager
+def _locked(directory, exclusive):
+    with open(os.path.join(directory, LOCK_FILE), 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _process_file(directory, pid):
+    return os.path.join(directory, f'{pid}.json')
+
+
+class MultiProcessCollector:
+    """
+    Junta las métricas de todos los workers de gunicorn, que tienen cada uno
+    su registro. Cada worker vuelca sus valores cada interval segundos en
+    directory/<pid>.json, y /metrics suma los de todos los ficheros después
+    de volcar los del worker que responde. Lo acumulado por los workers que
+    ya han terminado pasa a archive.json (ver archive_process), así que los
+    contadores no bajan al reciclar un worker
+    """
+
+    def __init__(self, registry, directory, interval=DEFAULT_FLUSH_INTERVAL):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Se llama en cada worker después del fork
+        """
+        self.registry.reset()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def flush(self):
+        samples = {metric.name: (metric.cumulative, metric.collect()) for metric in self.registry.metrics()}
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            _write(_process_file(self.directory, os.getpid()), samples)
+
+    def collect(self):
+        """
+        Valores sumados de todos los procesos: {nombre: {etiquetas: valor}}
+        """
+        self.flush()
+        with _locked(self.directory, exclusive=False):
+            files = [_load(os.path.join(self.directory, name)) for name in os.listdir(self.directory)
+                     if name.endswith('.json')]
+        totals = {}
+        for samples in files:
+            for name, (_, values) in samples.items():
+                _add(totals.setdefault(name, {}), values)
+        for metric in self.registry.metrics():
+            combine = getattr(metric, 'combine', None)
+            if combine is not None:
+                totals[metric.name] = combine(totals)
+        return totals
+
+    def render(self):
+        return self.registry.render(self.collect())
+
+
+def archive_process(directory, pid):
+    """
+    Pasa a archive.json los contadores de un worker que ha terminado y borra
+    su fichero. Lo llama el proceso principal de gunicorn (child_exit). Los
+    valores instantáneos (gauges) del worker se descartan
+    """
+    path = _process_file(directory, pid)
+    if not os.path.exists(path):
+        return
+    with _locked(directory, exclusive=True):
+        archive_path = os.path.join(directory, ARCHIVE_FILE)
+        archive = _load(archive_path)
+        for name, (cumulative, values) in _load(path).items():
+            if cumulative:
+                _add(archive.setdefault(name, (True, {}))[1], values)
+        _write(archive_path, archive)
+        os.remove(path)
+
+
+def reset_directory(directory):
+    """
+    Vacía el directorio de métricas al arrancar el servidor
+    """
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith('.json') or name.endswith('.tmp'):
+            os.remove(os.path.join(directory, name))
+
+
+def init_app(app, registry):
+    """
+    Registra la latencia y el número de peticiones por endpoint de Flask
+    """
+    latency = registry.histogram('betawave_request_duration_seconds',
+                                 'Request latency by Flask endpoint', ['endpoint', 'method'])
+    requests = registry.counter('betawave_requests_total',
+                                'Requests by Flask endpoint and status', ['endpoint', 'method', 'status'])
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            # request.endpoint evita una serie por cada id en la URL
+            endpoint = request.endpoint or 'unknown'
+            latency.observe(time.perf_counter() - start, endpoint=endpoint, method=request.method)
+            requests.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        return response
@@ -0,0 +1,409 @@
+import logging
+import sqlite3
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Cada migración se aplica una sola vez, en orden, y deja PRAGMA user_version
+# con su número. Para cambiar el esquema se añade una función nueva al final
+# de MIGRATIONS; nunca se modifica una que ya se haya publicado.
+
+
+def _columns(c, table):
+    c.execute(f"PRAGMA table_info({table})")
+    return [column[1] for column in c.fetchall()]
+
+
+def create_base_schema(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        email TEXT,
+        role TEXT DEFAULT 'user',
+        created_at DATETIME
+    )''')
+
+    # Bases de datos antiguas creadas sin role ni created_at
+    columns = _columns(c, 'users')
+    if 'role' not in columns:
+        c.execute("ALTER TABLE users ADD COLUMN role TEXT DEFAULT 'user'")
+    if 'created_at' not in columns:
+        c.execute("ALTER TABLE users ADD COLUMN created_at DATETIME")
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        c.execute("UPDATE users SET created_at = ? WHERE created_at IS NULL", (current_time,))
+
+    c.execute('''CREATE TABLE IF NOT EXISTS songs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  name TEXT NOT NULL,
+                  artist TEXT,
+                  url TEXT NOT NULL,
+                  user_id INTEGER NOT NULL,
+                  FOREIGN KEY(user_id) REFERENCES users(id))''')
+    if 'artist' not in _columns(c, 'songs'):
+        c.execute("ALTER TABLE songs ADD COLUMN artist TEXT")
+
+    c.execute('''CREATE TABLE IF NOT EXISTS favorites
+                 (user_id INTEGER NOT NULL,
+                  song_id INTEGER NOT NULL,
+                  PRIMARY KEY (user_id, song_id),
+                  FOREIGN KEY(user_id) REFERENCES users(id),
+                  FOREIGN KEY(song_id) REFERENCES songs(id))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS user_config
+                 (user_id INTEGER PRIMARY KEY,
+                  dark_mode BOOLEAN DEFAULT 0,
+                  default_volume INTEGER DEFAULT 50,
+                  FOREIGN KEY(user_id) REFERENCES users(id))''')
+
+
+def create_songs_fts(c):
+    # Índice de texto completo sin acentos y con prefijos de 2 y 3 letras
+    try:
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts5(
+                         name, artist,
+                         content='songs', content_rowid='id',
+                         tokenize='unicode61 remove_diacritics 2',
+                         prefix='2 3')''')
+    except sqlite3.OperationalError as e:
+        logger.warning("FTS5 not available, search will use LIKE: %s", e)
+        return
+    c.execute('''CREATE TRIGGER IF NOT EXISTS songs_fts_ai AFTER INSERT ON songs BEGIN
+                     INSERT INTO songs_fts(rowid, name, artist) VALUES (new.id, new.name, new.artist);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS songs_fts_ad AFTER DELETE ON songs BEGIN
+                     INSERT INTO songs_fts(songs_fts, rowid, name, artist)
+                     VALUES ('delete', old.id, old.name, old.artist);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS songs_fts_au AFTER UPDATE OF name, artist ON songs BEGIN
+                     INSERT INTO songs_fts(songs_fts, rowid, name, artist)
+                     VALUES ('delete', old.id, old.name, old.artist);
+                     INSERT INTO songs_fts(rowid, name, artist) VALUES (new.id, new.name, new.artist);
+                 END''')
+    # Indexar las canciones que ya existían
+    c.execute("INSERT INTO songs_fts(songs_fts) VALUES ('rebuild')")
+
+
+def add_secondary_indexes(c):
+    # Antes del índice único, fusionar canciones repetidas de un mismo usuario
+    # conservando la más antigua y moviendo sus favoritos a ella
+    c.execute('''CREATE TEMP TABLE duplicate_songs AS
+                 SELECT s.id AS id, k.keep_id AS keep_id
+                 FROM songs s
+                 JOIN (SELECT user_id, url, MIN(id) AS keep_id
+                       FROM songs GROUP BY user_id, url HAVING COUNT(*) > 1) k
+                   ON k.user_id = s.user_id AND k.url = s.url
+                 WHERE s.id != k.keep_id''')
+    c.execute('''INSERT OR IGNORE INTO favorites (user_id, song_id)
+                 SELECT f.user_id, d.keep_id
+                 FROM favorites f JOIN duplicate_songs d ON d.id = f.song_id''')
+    c.execute("DELETE FROM favorites WHERE song_id IN (SELECT id FROM duplicate_songs)")
+    c.execute("DELETE FROM songs WHERE id IN (SELECT id FROM duplicate_songs)")
+    c.execute("DROP TABLE duplicate_songs")
+
+    # songs(user_id) lleva implícito el rowid: sirve para paginar por (user_id, id)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_songs_user ON songs(user_id)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_songs_user_url ON songs(user_id, url)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_favorites_song ON favorites(song_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)")
+
+
+def create_video_metadata(c):
+    # Metadatos de YouTube compartidos por todos los usuarios, por id de vídeo
+    c.execute('''CREATE TABLE IF NOT EXISTS video_metadata
+                 (video_id TEXT PRIMARY KEY,
+                  title TEXT NOT NULL,
+                  artist TEXT,
+                  duration INTEGER,
+                  thumbnail TEXT,
+                  fetched_at INTEGER NOT NULL)''')
+
+
+def create_jobs_table(c):
+    # Estado de los trabajos en segundo plano, visible desde todos los procesos
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs
+                 (id TEXT PRIMARY KEY,
+                  queue TEXT NOT NULL,
+                  user_id INTEGER NOT NULL,
+                  status TEXT NOT NULL,
+                  progress REAL DEFAULT 0,
+                  filepath TEXT,
+                  filename TEXT,
+                  result TEXT,
+                  error TEXT,
+                  created_at REAL NOT NULL,
+                  finished_at REAL)''')
+
+
+def add_library_revisions(c):
+    # Revisión de la biblioteca de cada usuario: sube con cada cambio en sus
+    # canciones o favoritos, dentro de la misma transacción que el cambio
+    if 'library_revision' not in _columns(c, 'users'):
+        c.execute("ALTER TABLE users ADD COLUMN library_revision INTEGER NOT NULL DEFAULT 0")
+    bump = "UPDATE users SET library_revision = library_revision + 1 WHERE id = {}.user_id;"
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS songs_revision_ai AFTER INSERT ON songs BEGIN
+                      {bump.format('new')}
+                  END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS songs_revision_ad AFTER DELETE ON songs BEGIN
+                      {bump.format('old')}
+                  END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS songs_revision_au AFTER UPDATE OF name, artist, url ON songs BEGIN
+                      {bump.format('new')}
+                  END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS favorites_revision_ai AFTER INSERT ON favorites BEGIN
+                      {bump.format('new')}
+                  END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS favorites_revision_ad AFTER DELETE ON favorites BEGIN
+                      {bump.format('old')}
+                  END''')
+
+
+def create_library_changes(c):
+    # Registro de cambios por revisión, para que el cliente pida solo lo que
+    # ha cambiado desde la última vez. Los triggers de la migración 6 se
+    # rehacen para que la revisión y el cambio se escriban a la vez
+    c.execute('''CREATE TABLE IF NOT EXISTS library_changes
+                 (user_id INTEGER NOT NULL,
+                  revision INTEGER NOT NULL,
+                  song_id INTEGER NOT NULL,
+                  created_at INTEGER NOT NULL,
+                  PRIMARY KEY (user_id, revision)) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_library_changes_created ON library_changes(created_at)")
+
+    def record(row, song_id):
+        return f'''UPDATE users SET library_revision = library_revision + 1 WHERE id = {row}.user_id;
+                  INSERT INTO library_changes (user_id, revision, song_id, created_at)
+                  SELECT id, library_revision, {row}.{song_id}, CAST(strftime('%s', 'now') AS INTEGER)
+                  FROM users WHERE id = {row}.user_id;'''
+
+    triggers = [
+        ('songs_revision_ai', 'AFTER INSERT ON songs', record('new', 'id')),
+        ('songs_revision_ad', 'AFTER DELETE ON songs', record('old', 'id')),
+        ('songs_revision_au', 'AFTER UPDATE OF name, artist, url ON songs', record('new', 'id')),
+        ('favorites_revision_ai', 'AFTER INSERT ON favorites', record('new', 'song_id')),
+        ('favorites_revision_ad', 'AFTER DELETE ON favorites', record('old', 'song_id')),
+    ]
+    for name, event, body in triggers:
+        c.execute(f"DROP TRIGGER IF EXISTS {name}")
+        c.execute(f"CREATE TRIGGER {name} {event} BEGIN {body} END")
+    c.execute('''CREATE TRIGGER IF NOT EXISTS users_changes_ad AFTER DELETE ON users BEGIN
+                     DELETE FROM library_changes WHERE user_id = old.id;
+                 END''')
+
+
+def create_user_stats(c):
+    # Contadores por usuario para el perfil, mantenidos por triggers en la
+    # misma transacción que cada cambio en vez de contar en cada visita
+    c.execute('''CREATE TABLE IF NOT EXISTS user_stats
+                 (user_id INTEGER PRIMARY KEY,
+                  songs_count INTEGER NOT NULL DEFAULT 0,
+                  favorites_count INTEGER NOT NULL DEFAULT 0)''')
+    c.execute('''INSERT OR REPLACE INTO user_stats (user_id, songs_count, favorites_count)
+                 SELECT u.id,
+                        (SELECT COUNT(*) FROM songs s WHERE s.user_id = u.id),
+                        (SELECT COUNT(*) FROM favorites f WHERE f.user_id = u.id)
+                 FROM users u''')
+
+    update = "UPDATE user_stats SET {column} = {column} {sign} 1 WHERE user_id = {row}.user_id;"
+    triggers = [
+        ('songs_stats_ai', 'AFTER INSERT ON songs', update.format(column='songs_count', sign='+', row='new')),
+        ('songs_stats_ad', 'AFTER DELETE ON songs', update.format(column='songs_count', sign='-', row='old')),
+        ('favorites_stats_ai', 'AFTER INSERT ON favorites',
+         update.format(column='favorites_count', sign='+', row='new')),
+        ('favorites_stats_ad', 'AFTER DELETE ON favorites',
+         update.format(column='favorites_count', sign='-', row='old')),
+        ('users_stats_ai', 'AFTER INSERT ON users', "INSERT OR IGNORE INTO user_stats (user_id) VALUES (new.id);"),
+        ('users_stats_ad', 'AFTER DELETE ON users', "DELETE FROM user_stats WHERE user_id = old.id;"),
+    ]
+    for name, event, body in triggers:
+        c.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END")
+
+
+def add_admin_indexes(c):
+    # Listado de usuarios del panel: búsqueda por prefijo del nombre sin
+    # distinguir mayúsculas y orden por número de canciones o favoritos
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users(username COLLATE NOCASE)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_user_stats_songs ON user_stats(songs_count)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_user_stats_favorites ON user_stats(favorites_count)")
+
+
+def _rebuild_table(c, table, create_sql, columns, where=''):
+    """
+    Recrea una tabla con otra definición conservando filas, índices,
+    triggers y el contador AUTOINCREMENT. Es la forma que tiene SQLite de
+    cambiar restricciones. Requiere PRAGMA foreign_keys=OFF (ver migrate())
+    """
+    c.execute("SELECT sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') "
+              "AND sql IS NOT NULL", (table,))
+    dependents = [row[0] for row in c.fetchall()]
+    sequence = None
+    if _has_table(c, 'sqlite_sequence'):
+        c.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,))
+        sequence = c.fetchone()
+
+    c.execute(create_sql.format(table=f'{table}_new'))
+    column_list = ', '.join(columns)
+    c.execute(f"INSERT INTO {table}_new ({column_list}) SELECT {column_list} FROM {table} {where}")
+    c.execute(f"DROP TABLE {table}")
+    c.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    for sql in dependents:
+        c.execute(sql)
+    if sequence is not None:
+        c.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (sequence[0], table))
+
+
+def _has_table(c, name):
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+    return c.fetchone() is not None
+
+
+def add_cascading_deletes(c):
+    # Borrar un usuario o una canción arrastra sus filas dependientes, de modo
+    # que el borrado masivo de usuarios es un solo DELETE. Las filas que ya
+    # apuntaban a usuarios o canciones borrados se descartan
+    _rebuild_table(c, 'songs', '''CREATE TABLE {table}
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  name TEXT NOT NULL,
+                  artist TEXT,
+                  url TEXT NOT NULL,
+                  user_id INTEGER NOT NULL,
+                  FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE)''',
+                   ['id', 'name', 'artist', 'url', 'user_id'],
+                   'WHERE user_id IN (SELECT id FROM users)')
+    _rebuild_table(c, 'favorites', '''CREATE TABLE {table}
+                 (user_id INTEGER NOT NULL,
+                  song_id INTEGER NOT NULL,
+                  PRIMARY KEY (user_id, song_id),
+                  FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE,
+                  FOREIGN KEY(song_id) REFERENCES songs(id) ON DELETE CASCADE)''',
+                   ['user_id', 'song_id'],
+                   'WHERE user_id IN (SELECT id FROM users) AND song_id IN (SELECT id FROM songs)')
+    _rebuild_table(c, 'user_config', '''CREATE TABLE {table}
+                 (user_id INTEGER PRIMARY KEY,
+                  dark_mode BOOLEAN DEFAULT 0,
+                  default_volume INTEGER DEFAULT 50,
+                  FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE)''',
+                   ['user_id', 'dark_mode', 'default_volume'],
+                   'WHERE user_id IN (SELECT id FROM users)')
+
+    # Las filas descartadas seguían contando en el índice de búsqueda y en user_stats
+    if _has_table(c, 'songs_fts'):
+        c.execute("INSERT INTO songs_fts(songs_fts) VALUES ('rebuild')")
+    c.execute('''UPDATE user_stats SET
+                     songs_count = (SELECT COUNT(*) FROM songs s WHERE s.user_id = user_stats.user_id),
+                     favorites_count = (SELECT COUNT(*) FROM favorites f WHERE f.user_id = user_stats.user_id)''')
+
+    c.execute("PRAGMA foreign_key_check")
+    problems = c.fetchall()
+    if problems:
+        raise sqlite3.IntegrityError(f"Foreign key violations after rebuild: {problems[:5]}")
+
+
+def add_last_login(c):
+    # Fecha del último inicio de sesión, para purgar las cuentas inactivas
+    if 'last_login_at' not in _columns(c, 'users'):
+        c.execute("ALTER TABLE users ADD COLUMN last_login_at DATETIME")
+        # No se sabe cuándo entraron los usuarios existentes: se cuenta desde
+        # ahora, para que la purga de inactivos no borre cuentas en uso
+        c.execute("UPDATE users SET last_login_at = ?", (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
+
+
+def create_sessions(c):
+    # Sesiones de Flask en el servidor (ver sessions.py). Se borran con su usuario
+    c.execute('''CREATE TABLE IF NOT EXISTS sessions
+                 (id TEXT PRIMARY KEY,
+                  user_id INTEGER,
+                  data TEXT NOT NULL,
+                  expires_at INTEGER NOT NULL,
+                  FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)")
+
+
+def create_stream_urls(c):
+    # URLs de audio resueltas, compartidas entre workers (ver stream_cache.py)
+    c.execute('''CREATE TABLE IF NOT EXISTS stream_urls
+                 (song_url TEXT PRIMARY KEY,
+                  stream_url TEXT NOT NULL,
+                  expires_at REAL NOT NULL) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_stream_urls_expires ON stream_urls(expires_at)")
+
+
+def add_jobs_cascade(c):
+    # Los trabajos de un usuario se borran con él, por cualquier camino
+    # (delete_users, delete_account...)
+    _rebuild_table(c, 'jobs', '''CREATE TABLE {table}
+                 (id TEXT PRIMARY KEY,
+                  queue TEXT NOT NULL,
+                  user_id INTEGER NOT NULL,
+                  status TEXT NOT NULL,
+                  progress REAL DEFAULT 0,
+                  filepath TEXT,
+                  filename TEXT,
+                  result TEXT,
+                  error TEXT,
+                  created_at REAL NOT NULL,
+                  finished_at REAL,
+                  FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE)''',
+                   ['id', 'queue', 'user_id', 'status', 'progress', 'filepath', 'filename',
+                    'result', 'error', 'created_at', 'finished_at'],
+                   'WHERE user_id IN (SELECT id FROM users)')
+
+
+MIGRATIONS = [
+    (1, 'base schema', create_base_schema),
+    (2, 'songs full-text index', create_songs_fts),
+    (3, 'secondary indexes', add_secondary_indexes),
+    (4, 'video metadata cache', create_video_metadata),
+    (5, 'background jobs', create_jobs_table),
+    (6, 'library revisions', add_library_revisions),
+    (7, 'library change log', create_library_changes),
+    (8, 'user stats counters', create_user_stats),
+    (9, 'admin listing indexes', add_admin_indexes),
+    (10, 'cascading deletes', add_cascading_deletes),
+    (11, 'last login', add_last_login),
+    (12, 'server-side sessions', create_sessions),
+    (13, 'shared stream urls', create_stream_urls),
+    (14, 'cascade jobs', add_jobs_cascade),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """
+    Aplica las migraciones pendientes, cada una en su propia transacción.
+    Devuelve la versión final del esquema
+    """
+    # Recrear tablas con foreign_keys activo borraría en cascada sus filas
+    # dependientes. El pragma no tiene efecto dentro de una transacción
+    foreign_keys = conn.execute("PRAGMA foreign_keys").fetchone()[0]
+    conn.execute("PRAGMA foreign_keys=OFF")
+    try:
+        return _apply_migrations(conn)
+    finally:
+        conn.execute(f"PRAGMA foreign_keys={'ON' if foreign_keys else 'OFF'}")
+
+
+def _apply_migrations(conn):
+    for version, name, apply in MIGRATIONS:
+        if version <= get_version(conn):
+            continue
+        # BEGIN IMMEDIATE bloquea a otros procesos que migren a la vez
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= get_version(conn):
+                conn.rollback()
+                continue
+            logger.info("Applying migration %s: %s", version, name)
+            apply(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return get_version(conn)
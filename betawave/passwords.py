@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Método de hash por defecto, con sus parámetros explícitos para que el
+# coste no cambie al actualizar Werkzeug. Formatos admitidos:
+#   scrypt:N:r:p            (Werkzeug >= 2.3)
+#   pbkdf2:sha256:iteraciones
+DEFAULT_METHOD = 'scrypt:32768:8:1'
+DEFAULT_SALT_LENGTH = 16
+
+
+def hash_method(stored_hash):
+    """
+    Método y parámetros con los que se generó un hash: 'scrypt:32768:8:1$...'
+    """
+    return stored_hash.split('$', 1)[0] if stored_hash and '$' in stored_hash else None
+
+
+class PasswordPolicy:
+    """
+    Genera y comprueba contraseñas con un método fijo. Como mucho
+    max_concurrency hashes a la vez por proceso: en una ráfaga de inicios de
+    sesión el resto espera su turno en vez de repartirse la CPU entre todos
+    """
+
+    def __init__(self, method=DEFAULT_METHOD, salt_length=DEFAULT_SALT_LENGTH, max_concurrency=1):
+        self.method = method
+        self.salt_length = salt_length
+        self._slots = threading.BoundedSemaphore(max(1, max_concurrency))
+        self._current = None
+
+    @property
+    def current_method(self):
+        # Werkzeug completa los parámetros que falten ('pbkdf2' -> 'pbkdf2:sha256:N'),
+        # así que se toma del prefijo de un hash real
+        if self._current is None:
+            self._current = hash_method(generate_password_hash('', method=self.method, salt_length=1))
+        return self._current
+
+    def hash(self, password):
+        with self._slots:
+            return generate_password_hash(password, method=self.method, salt_length=self.salt_length)
+
+    def verify(self, stored_hash, password):
+        if not stored_hash:
+            return False
+        with self._slots:
+            return check_password_hash(stored_hash, password)
+
+    def needs_rehash(self, stored_hash):
+        return hash_method(stored_hash) != self.current_method
+
+
+def benchmark(method=DEFAULT_METHOD, seconds=2.0, threads=None):
+    """
+    Mide cuántos hashes por segundo salen con un método, en un hilo y con un
+    hilo por núcleo. Los hashes de hashlib sueltan el GIL, así que los hilos
+    escalan con los núcleos
+    """
+    threads = threads or os.cpu_count() or 1
+
+    def run(counts, index, deadline):
+        while time.perf_counter() < deadline:
+            generate_password_hash('benchmark-password', method=method)
+            counts[index] += 1
+
+    results = {'method': method}
+    for label, workers in (('single', 1), ('parallel', threads)):
+        counts = [0] * workers
+        start = time.perf_counter()
+        deadline = start + seconds
+        pool = [threading.Thread(target=run, args=(counts, i, deadline)) for i in range(workers)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        results[f'{label}_hashes_per_second'] = round(sum(counts) / elapsed, 1)
+    results['cores'] = threads
+    results['hashes_per_second_per_core'] = round(results['parallel_hashes_per_second'] / threads, 1)
+    results['ms_per_hash'] = round(1000 / results['single_hashes_per_second'], 1) \
+        if results['single_hashes_per_second'] else None
+    return results
+
+
+if __name__ == '__main__':
+    # python passwords.py [método...] para elegir PASSWORD_HASH_METHOD
+    import sys
+
+    for method in sys.argv[1:] or [DEFAULT_METHOD, 'pbkdf2:sha256:600000']:
+        result = benchmark(method)
+        print(f"{result['method']:<28} {result['ms_per_hash']:>7} ms/hash  "
+              f"{result['single_hashes_per_second']:>8}/s 1 hilo  "
+              f"{result['hashes_per_second_per_core']:>8}/s por núcleo ({result['cores']} núcleos)")
@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+DEFAULT_MAX_KEYS = 10000
+
+
+class AttemptLimiter:
+    """
+    Cuenta intentos por clave (IP, usuario...) en una ventana deslizante de
+    window segundos. Solo guarda las max_keys claves usadas más
+    recientemente. Es por proceso: con varios workers cada uno lleva su cuenta
+    """
+
+    def __init__(self, max_attempts, window, max_keys=DEFAULT_MAX_KEYS):
+        self.max_attempts = max_attempts
+        self.window = window
+        self.max_keys = max_keys
+        self._attempts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _recent(self, key, now):
+        attempts = self._attempts.get(key)
+        if attempts is None:
+            return None
+        while attempts and attempts[0] <= now - self.window:
+            attempts.popleft()
+        return attempts
+
+    def hit(self, key):
+        """
+        Anota un intento. Devuelve False si con él se supera el límite
+        """
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._recent(key, now)
+            if attempts is None:
+                attempts = self._attempts[key] = deque()
+                while len(self._attempts) > self.max_keys:
+                    self._attempts.popitem(last=False)
+            self._attempts.move_to_end(key)
+            attempts.append(now)
+            return len(attempts) <= self.max_attempts
+
+    def blocked(self, key):
+        with self._lock:
+            attempts = self._recent(key, time.monotonic())
+            return attempts is not None and len(attempts) >= self.max_attempts
+
+    def retry_after(self, key):
+        """
+        Segundos hasta que vuelva a haber sitio para un intento
+        """
+        with self._lock:
+            attempts = self._recent(key, time.monotonic())
+            if not attempts or len(attempts) < self.max_attempts:
+                return 0
+            return max(0, int(attempts[-self.max_attempts] + self.window - time.monotonic()) + 1)
+
+    def reset(self, key):
+        with self._lock:
+            self._attempts.pop(key, None)
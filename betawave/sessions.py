@@ -0,0 +1,269 @@
+import hashlib
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import g, session
+from flask.sessions import SecureCookieSessionInterface, SessionInterface, SessionMixin
+from itsdangerous import BadSignature
+from werkzeug.datastructures import CallbackDict
+
+from db import get_db
+
+# Sesiones guardadas en la tabla sessions en vez de en la cookie. La cookie
+# solo lleva un token aleatorio; en la base de datos se guarda su SHA-256.
+# Las sesiones sin usuario (p. ej. un mensaje flash antes de iniciar sesión)
+# no se guardan: van firmadas en la propia cookie, como las de Flask
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 5       # Segundos que otro proceso puede tardar en ver una revocación
+PRUNE_INTERVAL = 3600       # Segundos entre borrados de sesiones caducadas, por proceso
+
+# Claves de la sesión que salen de la tabla users cada vez que se carga, para
+# que un cambio de rol o nombre se vea sin volver a iniciar sesión
+USER_KEYS = ('user_id', 'username', 'user_role')
+
+
+def _key(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, token=None, user=None, expires_at=None, has_cookie=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.token = token
+        # El navegador mandó una cookie, aunque no fuera válida
+        self.has_cookie = has_cookie
+        self.user = user
+        self.expires_at = expires_at
+        self.modified = False
+        self.regenerate = False
+
+    def rotate(self):
+        """
+        Pide un token nuevo al guardar la sesión, p. ej. al iniciar sesión
+        """
+        self.regenerate = True
+        self.modified = True
+
+
+class SessionCache:
+    """
+    Caché LRU de sesiones ya leídas, con caducidad de ttl segundos
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, record):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, record)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def pop_users(self, user_ids):
+        user_ids = set(user_ids)
+        with self._lock:
+            for key in [key for key, (_, record) in self._entries.items()
+                        if record['user'] and record['user']['id'] in user_ids]:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SqliteSessionInterface(SessionInterface):
+    """
+    Sesiones de Flask en SQLite con una caché en memoria delante. Cada carga
+    trae también el usuario, así que borrar la fila de la sesión o del
+    usuario (en cascada) la invalida
+    """
+
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE, cache_ttl=DEFAULT_CACHE_TTL):
+        self.cache = SessionCache(cache_size, cache_ttl)
+        self._cookies = SecureCookieSessionInterface()
+        self._pruned_at = time.monotonic()
+
+    def open_session(self, app, request):
+        token = request.cookies.get(self.get_cookie_name(app))
+        if not token:
+            return ServerSession()
+        # Los tokens no llevan puntos; los datos firmados sí
+        if '.' in token:
+            return self._open_signed(app, token)
+        record = self._load(_key(token))
+        if record is None or record['expires_at'] < time.time():
+            return ServerSession(has_cookie=True)
+        data = dict(record['data'])
+        user = record['user']
+        if user:
+            data.update(user_id=user['id'], username=user['username'], user_role=user['role'])
+        return ServerSession(data, token=token, user=user, expires_at=record['expires_at'], has_cookie=True)
+
+    def _open_signed(self, app, value):
+        serializer = self._cookies.get_signing_serializer(app)
+        if serializer is None:
+            return ServerSession(has_cookie=True)
+        try:
+            data = serializer.loads(value, max_age=int(app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            return ServerSession(has_cookie=True)
+        # Una cookie firmada nunca identifica a un usuario
+        return ServerSession({k: v for k, v in data.items() if k not in USER_KEYS}, has_cookie=True)
+
+    def _load(self, key):
+        record = self.cache.get(key)
+        if record is not None:
+            return record
+        row = get_db().execute("""
+            SELECT s.data, s.expires_at, u.id, u.username, u.role
+            FROM sessions s
+            LEFT JOIN users u ON u.id = s.user_id
+            WHERE s.id = ?
+        """, (key,)).fetchone()
+        if row is None:
+            return None
+        record = {
+            'data': json.loads(row[0]),
+            'expires_at': row[1],
+            'user': {'id': row[2], 'username': row[3], 'role': row[4]} if row[2] is not None else None
+        }
+        self.cache.put(key, record)
+        return record
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        user_id = session.get('user_id')
+        if user_id is None:
+            self._save_anonymous(app, session, response)
+            return
+
+        now = int(time.time())
+        lifetime = int(app.permanent_session_lifetime.total_seconds())
+        # Token nuevo al iniciar o cambiar de sesión, contra la fijación de sesiones
+        rotate = session.regenerate or session.token is None or user_id != (session.user or {}).get('id')
+        refresh = session.expires_at is not None and session.expires_at - now < lifetime // 2
+        if not (session.modified or rotate or refresh):
+            return
+
+        if rotate and session.token:
+            self._delete(_key(session.token))
+            session.token = None
+        if session.token is None:
+            session.token = secrets.token_urlsafe(32)
+        session.expires_at = now + lifetime
+
+        key = _key(session.token)
+        data = {k: v for k, v in session.items() if k not in USER_KEYS}
+        conn = get_db()
+        # Si el usuario ya no existe la sesión se guarda como anónima
+        conn.execute("""INSERT OR REPLACE INTO sessions (id, user_id, data, expires_at)
+                        VALUES (?, (SELECT id FROM users WHERE id = ?), ?, ?)""",
+                     (key, user_id, json.dumps(data), session.expires_at))
+        if refresh:
+            # Quien sigue usando una sesión abierta cuenta como activo para la
+            # purga de inactivos, aunque no vuelva a pasar por el login
+            conn.execute("UPDATE users SET last_login_at = ? WHERE id = ?",
+                         (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), user_id))
+        conn.commit()
+        # El usuario se vuelve a leer de la base de datos en la siguiente petición
+        self.cache.pop(key)
+        self._prune()
+
+        if rotate or refresh or session.permanent:
+            response.set_cookie(name, session.token,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+        response.vary.add('Cookie')
+
+    def _save_anonymous(self, app, session, response):
+        dropped = session.token is not None
+        if dropped:
+            # Se ha cerrado la sesión o el usuario ya no existe
+            self._delete(_key(session.token))
+            session.token = None
+        if not session:
+            if session.has_cookie:
+                response.delete_cookie(self.get_cookie_name(app), domain=self.get_cookie_domain(app),
+                                       path=self.get_cookie_path(app),
+                                       secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app),
+                                       httponly=self.get_cookie_httponly(app))
+            return
+        # Sin usuario, la sesión va firmada en la cookie como en Flask
+        if session.modified or dropped:
+            session.modified = True
+            self._cookies.save_session(app, session, response)
+
+    def _prune(self):
+        if time.monotonic() - self._pruned_at < PRUNE_INTERVAL:
+            return
+        self._pruned_at = time.monotonic()
+        self.delete_expired()
+
+    def _delete(self, key):
+        conn = get_db()
+        conn.execute("DELETE FROM sessions WHERE id = ?", (key,))
+        conn.commit()
+        self.cache.pop(key)
+
+    def revoke_user(self, user_id, keep_token=None):
+        """
+        Cierra todas las sesiones de un usuario, salvo la de keep_token
+        """
+        conn = get_db()
+        conn.execute("DELETE FROM sessions WHERE user_id = ? AND id != ?",
+                     (user_id, _key(keep_token) if keep_token else ''))
+        conn.commit()
+        self.cache.pop_users([user_id])
+
+    def forget_users(self, user_ids):
+        """
+        Olvida de la caché las sesiones de unos usuarios, p. ej. tras borrarlos
+        (sus filas ya se han borrado en cascada) o cambiar su rol
+        """
+        self.cache.pop_users(user_ids)
+
+    def delete_expired(self):
+        conn = get_db()
+        conn.execute("DELETE FROM sessions WHERE expires_at < ?", (int(time.time()),))
+        conn.commit()
+
+
+def init_app(app):
+    app.session_interface = SqliteSessionInterface(app.config['SESSION_CACHE_SIZE'], app.config['SESSION_CACHE_TTL'])
+
+    @app.before_request
+    def load_user():
+        g.user = getattr(session, 'user', None)
@@ -1,5 +1,258 @@
 // Funciones para el panel de administración
 
+const SEARCH_DEBOUNCE = 300;    // Milisegundos sin teclear antes de buscar
+const PURGE_DEFAULT_DAYS = 365; // Días sin iniciar sesión propuestos al purgar
+
+document.addEventListener('DOMContentLoaded', function() {
+    const filters = document.getElementById('user-filters');
+    const usersBody = document.getElementById('users-body');
+    const pager = document.getElementById('users-pager');
+    const selectAll = document.getElementById('select-all');
+    const deleteSelectedBtn = document.getElementById('delete-selected');
+    const purgeBtn = document.getElementById('purge-inactive');
+    let searchTimeout = null;
+    let controller = null;
+
+    if (!filters || !usersBody) return;
+
+    // Estado actual del listado, el mismo que en la URL de la página
+    const params = new URLSearchParams(window.location.search);
+    const state = {
+        q: filters.elements.q.value,
+        role: filters.elements.role.value,
+        sort: filters.elements.sort.value,
+        order: filters.elements.order.value,
+        page: parseInt(params.get('page') || '1', 10)
+    };
+
+    filters.addEventListener('submit', (e) => {
+        e.preventDefault();
+        state.q = filters.elements.q.value.trim();
+        state.role = filters.elements.role.value;
+        state.page = 1;
+        loadUsers();
+    });
+
+    filters.elements.q.addEventListener('input', () => {
+        clearTimeout(searchTimeout);
+        searchTimeout = setTimeout(() => filters.requestSubmit(), SEARCH_DEBOUNCE);
+    });
+
+    filters.elements.role.addEventListener('change', () => filters.requestSubmit());
+
+    document.querySelectorAll('.sort-link').forEach(link => {
+        link.addEventListener('click', (e) => {
+            e.preventDefault();
+            const sort = link.dataset.sort;
+            if (state.sort === sort) {
+                state.order = state.order === 'desc' ? 'asc' : 'desc';
+            } else {
+                state.sort = sort;
+                state.order = sort === 'username' ? 'asc' : 'desc';
+            }
+            state.page = 1;
+            loadUsers();
+        });
+    });
+
+    pager.addEventListener('click', (e) => {
+        const link = e.target.closest('a[data-page]');
+        if (!link) return;
+        e.preventDefault();
+        state.page = parseInt(link.dataset.page, 10);
+        loadUsers();
+    });
+
+    usersBody.addEventListener('click', (e) => {
+        const button = e.target.closest('.btn-delete');
+        if (button) {
+            deleteUser(button.dataset.userId, button.dataset.username);
+        }
+    });
+
+    usersBody.addEventListener('change', updateSelection);
+
+    selectAll.addEventListener('change', () => {
+        usersBody.querySelectorAll('.select-user').forEach(box => {
+            box.checked = selectAll.checked;
+        });
+        updateSelection();
+    });
+
+    deleteSelectedBtn.addEventListener('click', () => {
+        const userIds = selectedUserIds();
+        if (userIds.length === 0) return;
+        if (!confirm(`¿Eliminar ${userIds.length} usuarios con todas sus canciones?`)) return;
+
+        postJson('/admin/delete_users', { userIds })
+            .then(data => {
+                alert(`Eliminados ${data.deleted} usuarios`);
+                loadUsers();
+            })
+            .catch(error => alert(error.message));
+    });
+
+    purgeBtn.addEventListener('click', () => {
+        const answer = prompt('Eliminar usuarios sin iniciar sesión desde hace (días):', PURGE_DEFAULT_DAYS);
+        const days = parseInt(answer, 10);
+        if (!answer || !(days > 0)) return;
+
+        // Contar primero para confirmar con el número real
+        postJson('/admin/purge_inactive', { days, dry_run: true })
+            .then(data => {
+                if (data.matched === 0) {
+                    alert('No hay usuarios inactivos');
+                    return;
+                }
+                if (!confirm(`Se eliminarán ${data.matched} usuarios inactivos. ¿Continuar?`)) return;
+                return postJson('/admin/purge_inactive', { days }).then(result => {
+                    alert(`Eliminados ${result.deleted} usuarios`);
+                    loadUsers();
+                });
+            })
+            .catch(error => alert(error.message));
+    });
+
+    function selectedUserIds() {
+        return Array.from(usersBody.querySelectorAll('.select-user:checked')).map(box => parseInt(box.value, 10));
+    }
+
+    function updateSelection() {
+        const boxes = usersBody.querySelectorAll('.select-user');
+        const selected = selectedUserIds().length;
+        deleteSelectedBtn.disabled = selected === 0;
+        selectAll.checked = boxes.length > 0 && selected === boxes.length;
+    }
+
+    function postJson(url, body) {
+        return fetch(url, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify(body)
+        })
+        .then(response => response.json().then(data => {
+            if (!response.ok || !data.success) throw new Error(data.error || 'Error en la operación');
+            return data;
+        }));
+    }
+
+    // Volver a pedir la página actual, p. ej. después de borrar un usuario
+    window.reloadUsers = loadUsers;
+
+    function queryString() {
+        const query = new URLSearchParams();
+        Object.entries(state).forEach(([key, value]) => {
+            if (value) query.set(key, value);
+        });
+        return query.toString();
+    }
+
+    function loadUsers() {
+        // Cancelar la petición anterior si aún no ha terminado
+        if (controller) controller.abort();
+        controller = new AbortController();
+
+        const query = queryString();
+        fetch(`/admin/api/users?${query}`, { signal: controller.signal })
+            .then(response => response.json().then(data => {
+                if (!response.ok) throw new Error(data.error || 'Error al cargar usuarios');
+                return data;
+            }))
+            .then(data => {
+                // Si se ha borrado el último usuario de la página, ir a la anterior
+                if (data.users.length === 0 && data.page > 1) {
+                    state.page = data.pages;
+                    loadUsers();
+                    return;
+                }
+                renderUsers(data.users);
+                renderPager(data);
+                updateSortLinks();
+                updateSelection();
+                history.replaceState(null, '', `/admin?${query}`);
+            })
+            .catch(error => {
+                if (error.name === 'AbortError') return;
+                console.error('Error:', error);
+                alert(error.message);
+            });
+    }
+
+    function renderUsers(users) {
+        usersBody.innerHTML = '';
+        if (users.length === 0) {
+            const row = usersBody.insertRow();
+            const cell = row.insertCell();
+            cell.colSpan = 8;
+            cell.className = 'empty-row';
+            cell.textContent = 'No hay usuarios que coincidan';
+            return;
+        }
+
+        users.forEach(user => {
+            const row = usersBody.insertRow();
+            const select = row.insertCell();
+            select.className = 'select-cell';
+            if (user.role !== 'admin') {
+                const box = document.createElement('input');
+                box.type = 'checkbox';
+                box.className = 'select-user';
+                box.value = user.id;
+                select.appendChild(box);
+            }
+            [user.username, user.email || '', user.created_at, user.role, user.songs_count, user.favorites_count]
+                .forEach(value => {
+                    row.insertCell().textContent = value;
+                });
+            const actions = row.insertCell();
+            actions.className = 'actions';
+            if (user.role !== 'admin') {
+                const button = document.createElement('button');
+                button.className = 'btn-delete';
+                button.dataset.userId = user.id;
+                button.dataset.username = user.username;
+                button.innerHTML = '<i class="fas fa-trash"></i>';
+                actions.appendChild(button);
+            }
+        });
+    }
+
+    function renderPager(data) {
+        pager.innerHTML = '';
+        if (data.page > 1) {
+            pager.appendChild(pageLink(data.page - 1, '« Anterior'));
+        }
+        const info = document.createElement('span');
+        info.className = 'pager-info';
+        info.textContent = `Página ${data.page} de ${data.pages} · ${data.total} usuarios`;
+        pager.appendChild(info);
+        if (data.page < data.pages) {
+            pager.appendChild(pageLink(data.page + 1, 'Siguiente »'));
+        }
+    }
+
+    function pageLink(page, label) {
+        const link = document.createElement('a');
+        link.href = '#';
+        link.dataset.page = page;
+        link.textContent = label;
+        return link;
+    }
+
+    function updateSortLinks() {
+        filters.elements.sort.value = state.sort;
+        filters.elements.order.value = state.order;
+        document.querySelectorAll('.sort-link').forEach(link => {
+            const active = link.dataset.sort === state.sort;
+            link.classList.toggle('active', active);
+            link.classList.toggle('asc', active && state.order === 'asc');
+            link.classList.toggle('desc', active && state.order === 'desc');
+        });
+    }
+});
+
 function deleteUser(userId, username) {
     if (confirm(`¿Estás seguro de que deseas eliminar al usuario ${username}?`)) {
         fetch('/admin/delete_user', {
@@ -12,7 +265,11 @@ function deleteUser(userId, username) {
         .then(response => response.json())
         .then(data => {
             if (data.success) {
-                location.reload();
+                if (window.reloadUsers) {
+                    window.reloadUsers();
+                } else {
+                    location.reload();
+                }
             } else {
                 alert(data.error || 'Error al eliminar usuario');
             }
@@ -23,5 +280,3 @@ function deleteUser(userId, username) {
         });
     }
 }
-
-
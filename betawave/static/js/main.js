@@ -4,6 +4,11 @@ document.addEventListener('DOMContentLoaded', function() {
     const SEEK_STEP = 5;                // Seconds to seek forward/backward
     const UPDATE_INTERVAL = 100;        // Milliseconds between progress updates
     const TRANSITION_DURATION = 300;     // Milliseconds for animations
+    const PREFETCH_COUNT = 2;           // Next songs to resolve in the background
+    const SEARCH_DEBOUNCE = 250;        // Milliseconds to wait after typing before searching
+    const PAGE_SIZE = 50;               // Songs requested per page
+    const JOB_POLL_INTERVAL = 1000;     // Milliseconds between background job status checks
+    const EVENTS_RETRY_DELAY = 5000;    // Milliseconds before reopening a rejected event stream
     
     // Elements
     const audioPlayer = document.getElementById('audio-player');
@@ -32,10 +37,24 @@ document.addEventListener('DOMContentLoaded', function() {
     let currentSongId = null;
     let currentPlaylist = [];
     let isPlayingFavorites = false;
+    let searchTimeout = null;
+    let searchController = null;
+    
+    // Pagination state for each list (cursor of the next page)
+    const pagination = {
+        songs: { url: '/api/songs', container: songList, cursor: null, loading: false, sentinel: null, revision: null },
+        favorites: { url: '/api/favorites', container: favoritesList, cursor: null, loading: false, sentinel: null, revision: null }
+    };
+    let syncPromise = null;
+    
+    // Trabajos en espera: job_id -> función que consulta su estado
+    const jobWaiters = new Map();
     
     // Load initial data
+    setupInfiniteScroll();
     loadSongs();
     loadFavorites();
+    connectEvents();
       // Event listeners
     addSongBtn.addEventListener('click', addSong);
     favoriteBtn.addEventListener('click', toggleCurrentFavorite);
@@ -200,13 +219,21 @@ document.addEventListener('DOMContentLoaded', function() {
     }
     
     function handleSearch(e) {
-        const searchTerm = e.target.value.toLowerCase();
+        const searchTerm = e.target.value.trim();
+        clearTimeout(searchTimeout);
         
-        // Determine which section is active
-        const activeSection = favoritesSection.style.display === 'block' ? 
-            favoritesList : songList;
+        // Los favoritos ya están cargados: basta con filtrar las tarjetas
+        if (favoritesSection.style.display === 'block') {
+            filterSongCards(favoritesList, searchTerm.toLowerCase());
+            return;
+        }
         
-        const songCards = activeSection.querySelectorAll('.song-card');
+        // Esperar a que el usuario deje de escribir antes de consultar al servidor
+        searchTimeout = setTimeout(() => searchSongs(searchTerm), SEARCH_DEBOUNCE);
+    }
+    
+    function filterSongCards(container, searchTerm) {
+        const songCards = container.querySelectorAll('.song-card');
         
         songCards.forEach(card => {
             const title = card.querySelector('.song-title').textContent.toLowerCase();
@@ -220,18 +247,67 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
     
+    function searchSongs(searchTerm) {
+        // Cancelar la búsqueda anterior si aún no ha terminado
+        if (searchController) {
+            searchController.abort();
+        }
+        
+        if (!searchTerm) {
+            loadSongs();
+            return;
+        }
+        
+        searchController = new AbortController();
+        fetch('/api/search', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ search_term: searchTerm }),
+            signal: searchController.signal
+        })
+        .then(response => {
+            if (!response.ok) {
+                throw new Error('Error al buscar canciones');
+            }
+            return response.json();
+        })
+        .then(songs => {
+            // Los resultados de búsqueda no usan el scroll infinito de la lista
+            pagination.songs.cursor = null;
+            renderSongs(songs, songList, false);
+            updateCurrentPlaylist();
+        })
+        .catch(error => {
+            if (error.name === 'AbortError') return;
+            console.error('Error searching songs:', error);
+            showAlert('Error al buscar canciones', 'error');
+        });
+    }
+    
+    function fetchPage(url, cursor) {
+        const params = new URLSearchParams({ limit: PAGE_SIZE });
+        if (cursor) params.set('after', cursor);
+        
+        return fetch(`${url}?${params}`).then(response => {
+            if (!response.ok) {
+                throw new Error('Error al cargar la lista');
+            }
+            const nextCursor = response.headers.get('X-Next-Cursor');
+            const revision = parseInt(response.headers.get('X-Library-Revision'), 10);
+            return response.json().then(items => ({ items, nextCursor, revision }));
+        });
+    }
+    
     function loadSongs() {
         songList.innerHTML = '<div class="loading-message"><i class="fas fa-spinner fa-spin"></i> Cargando canciones...</div>';
         
-        fetch('/api/songs')
-            .then(response => {
-                if (!response.ok) {
-                    throw new Error('Error al cargar las canciones');
-                }
-                return response.json();
-            })
-            .then(songs => {
-                renderSongs(songs, songList, false);
+        return fetchPage('/api/songs', null)
+            .then(({ items, nextCursor, revision }) => {
+                pagination.songs.cursor = nextCursor;
+                pagination.songs.revision = isNaN(revision) ? null : revision;
+                renderSongs(items, songList, false);
                 // Actualizar la playlist después de cargar las canciones
                 updateCurrentPlaylist();
             })
@@ -243,10 +319,11 @@ document.addEventListener('DOMContentLoaded', function() {
     }
     
     function loadFavorites() {
-        fetch('/api/favorites')
-            .then(response => response.json())
-            .then(favorites => {
-                renderSongs(favorites, favoritesList, true);
+        return fetchPage('/api/favorites', null)
+            .then(({ items, nextCursor, revision }) => {
+                pagination.favorites.cursor = nextCursor;
+                pagination.favorites.revision = isNaN(revision) ? null : revision;
+                renderSongs(items, favoritesList, true);
                 // Actualizar la playlist después de cargar los favoritos
                 updateCurrentPlaylist();
             })
@@ -256,10 +333,174 @@ document.addEventListener('DOMContentLoaded', function() {
             });
     }
     
-    function renderSongs(songs, container, isFavoriteList) {
-        container.innerHTML = '';
+    // Trae solo lo que ha cambiado en la biblioteca desde la última carga y
+    // lo aplica sobre las listas ya pintadas (ver /api/changes)
+    function syncLibrary() {
+        if (syncPromise) {
+            return syncPromise.then(syncLibrary);
+        }
+        
+        const revisions = [pagination.songs.revision, pagination.favorites.revision];
+        if (revisions.includes(null)) {
+            return Promise.all([loadSongs(), loadFavorites()]);
+        }
         
-        if (songs.length === 0) {
+        syncPromise = fetch(`/api/changes?since=${Math.min(...revisions)}`)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error('Error al sincronizar la biblioteca');
+                }
+                return response.json();
+            })
+            .then(changes => {
+                if (changes.reset) {
+                    return Promise.all([loadSongs(), loadFavorites()]);
+                }
+                applyChanges(changes);
+                pagination.songs.revision = changes.revision;
+                pagination.favorites.revision = changes.revision;
+                updateCurrentPlaylist();
+            })
+            .catch(error => {
+                console.error('Error syncing library:', error);
+                return Promise.all([loadSongs(), loadFavorites()]);
+            })
+            .finally(() => {
+                syncPromise = null;
+            });
+        return syncPromise;
+    }
+    
+    function applyChanges(changes) {
+        // Con una búsqueda activa la lista de canciones no es la biblioteca
+        const searching = searchInput.value.trim() !== '';
+        
+        changes.deleted.forEach(songId => {
+            removeSongCard(songList, songId);
+            removeSongCard(favoritesList, songId);
+        });
+        changes.songs.forEach(song => {
+            if (!searching) {
+                placeSongCard('songs', song);
+            }
+            if (song.is_favorite) {
+                placeSongCard('favorites', song);
+            } else {
+                removeSongCard(favoritesList, song.id);
+            }
+        });
+    }
+    
+    function removeSongCard(container, songId) {
+        const card = container.querySelector(`.song-card[data-song-id="${songId}"]`);
+        if (!card) return;
+        card.remove();
+        if (!container.querySelector('.song-card')) {
+            renderSongs([], container, container === favoritesList);
+        }
+    }
+    
+    // Inserta o sustituye la tarjeta manteniendo el orden por id. Las que caen
+    // después de la última página cargada llegarán con el scroll infinito
+    function placeSongCard(key, song) {
+        const state = pagination[key];
+        if (state.cursor && song.id > parseInt(state.cursor, 10)) return;
+        
+        const card = createSongCard(song, key === 'favorites');
+        const existing = state.container.querySelector(`.song-card[data-song-id="${song.id}"]`);
+        if (existing) {
+            existing.replaceWith(card);
+            return;
+        }
+        state.container.querySelectorAll('.empty-message').forEach(message => message.remove());
+        const next = Array.from(state.container.querySelectorAll('.song-card'))
+            .find(other => parseInt(other.dataset.songId, 10) > song.id);
+        state.container.insertBefore(card, next || null);
+    }
+    
+    // Avisos del servidor (ver /api/events): cambios hechos desde otra
+    // pestaña o dispositivo y trabajos terminados, sin consultar en bucle
+    function connectEvents() {
+        if (!window.EventSource) return;
+        
+        const source = new EventSource('/api/events');
+        const onRevision = event => {
+            const { revision } = JSON.parse(event.data);
+            const known = [pagination.songs.revision, pagination.favorites.revision];
+            // Mientras se cargan las listas no hay nada que sincronizar
+            if (!known.includes(null) && revision !== Math.min(...known)) {
+                syncLibrary();
+            }
+        };
+        
+        source.addEventListener('hello', onRevision);
+        source.addEventListener('library', onRevision);
+        source.addEventListener('resync', () => syncLibrary());
+        source.addEventListener('job', event => {
+            const job = JSON.parse(event.data);
+            const poll = jobWaiters.get(job.job_id);
+            if (poll) poll();
+        });
+        source.addEventListener('logout', () => {
+            source.close();
+            window.location.href = '/login';
+        });
+        source.onerror = () => {
+            // El navegador reintenta solo salvo si el servidor rechazó la conexión
+            if (source.readyState === EventSource.CLOSED) {
+                setTimeout(connectEvents, EVENTS_RETRY_DELAY);
+            }
+        };
+    }
+    
+    // Carga la siguiente página de una lista cuando se llega a su final
+    function loadMore(key) {
+        const state = pagination[key];
+        if (!state.cursor || state.loading) return;
+        
+        state.loading = true;
+        fetchPage(state.url, state.cursor)
+            .then(({ items, nextCursor }) => {
+                state.cursor = nextCursor;
+                renderSongs(items, state.container, key === 'favorites', true);
+                updateCurrentPlaylist();
+            })
+            .catch(error => console.error('Error loading more songs:', error))
+            .finally(() => {
+                state.loading = false;
+                // Si la lista aún no llena la pantalla, seguir cargando
+                if (isVisible(state.sentinel)) loadMore(key);
+            });
+    }
+    
+    function isVisible(element) {
+        return element.offsetParent !== null &&
+            element.getBoundingClientRect().top < window.innerHeight;
+    }
+    
+    function setupInfiniteScroll() {
+        const observer = new IntersectionObserver(entries => {
+            entries.forEach(entry => {
+                if (entry.isIntersecting) loadMore(entry.target.dataset.list);
+            });
+        });
+        
+        Object.entries(pagination).forEach(([key, state]) => {
+            const sentinel = document.createElement('div');
+            sentinel.className = 'list-sentinel';
+            sentinel.dataset.list = key;
+            state.container.insertAdjacentElement('afterend', sentinel);
+            state.sentinel = sentinel;
+            observer.observe(sentinel);
+        });
+    }
+    
+    function renderSongs(songs, container, isFavoriteList, append = false) {
+        if (!append) {
+            container.innerHTML = '';
+        }
+        
+        if (songs.length === 0 && !append) {
             const emptyMessage = document.createElement('div');
             emptyMessage.className = 'empty-message';
             emptyMessage.textContent = isFavoriteList ? 
@@ -269,81 +510,116 @@ document.addEventListener('DOMContentLoaded', function() {
             return;
         }
         
+        const pendingStatus = [];
+        
         songs.forEach(song => {
-            const songCard = document.createElement('div');
-            songCard.className = 'song-card';
-            songCard.dataset.songId = song.id;
-            
-            // Extract video ID from YouTube URL for thumbnail
-            let videoId = null;
-            try {
-                const url = new URL(song.url);
-                videoId = url.searchParams.get('v') || url.pathname.split('/').pop();
-            } catch (e) {
-                console.error('Error parsing URL:', e);
+            // El estado de favorito llega con la canción; si falta se pide en bloque
+            if (song.is_favorite === undefined && !isFavoriteList) {
+                pendingStatus.push(song.id);
             }
-            
-            const coverUrl = videoId ? 
-                `https://img.youtube.com/vi/${videoId}/mqdefault.jpg` : 
-                'https://via.placeholder.com/300';
-            
-            songCard.innerHTML = `
-                <div class="song-cover">
-                    <img src="${coverUrl}" alt="Portada de canción">
-                </div>                <div class="song-title">${song.name}</div>
-                <div class="song-artist">${song.artist || 'Artista Desconocido'}</div>
-                <div class="song-actions">
-                    <button class="song-action-btn favorite-btn" data-song-id="${song.id}">
-                        <i class="far fa-heart"></i>
-                    </button>
-                    <button class="song-action-btn download-btn" data-song-id="${song.id}">
-                        <i class="fas fa-download"></i>
-                    </button>
-                    ${!isFavoriteList ? `
-                    <button class="song-action-btn delete-btn" data-song-id="${song.id}">
-                        <i class="fas fa-trash"></i>
-                    </button>
-                    ` : ''}
-                </div>
-            `;
-            
-            // Add event listeners to action buttons
-            const favoriteBtn = songCard.querySelector('.favorite-btn');
-            const downloadBtn = songCard.querySelector('.download-btn');
-            const deleteBtn = songCard.querySelector('.delete-btn');
-            
-            favoriteBtn.addEventListener('click', (e) => {
-                e.stopPropagation();
-                toggleFavorite(song.id, favoriteBtn);
-            });
-            
-            downloadBtn.addEventListener('click', (e) => {
+            container.appendChild(createSongCard(song, isFavoriteList));
+        });
+        
+        if (pendingStatus.length > 0) {
+            loadFavoriteStatuses(pendingStatus, container);
+        }
+    }
+    
+    function createSongCard(song, isFavoriteList) {
+        const songCard = document.createElement('div');
+        songCard.className = 'song-card';
+        songCard.dataset.songId = song.id;
+        
+        // Extract video ID from YouTube URL for thumbnail
+        let videoId = null;
+        try {
+            const url = new URL(song.url);
+            videoId = url.searchParams.get('v') || url.pathname.split('/').pop();
+        } catch (e) {
+            console.error('Error parsing URL:', e);
+        }
+        
+        const coverUrl = videoId ? 
+            `https://img.youtube.com/vi/${videoId}/mqdefault.jpg` : 
+            'https://via.placeholder.com/300';
+        
+        songCard.innerHTML = `
+            <div class="song-cover">
+                <img src="${coverUrl}" alt="Portada de canción">
+            </div>                <div class="song-title">${song.name}</div>
+            <div class="song-artist">${song.artist || 'Artista Desconocido'}</div>
+            <div class="song-actions">
+                <button class="song-action-btn favorite-btn" data-song-id="${song.id}">
+                    <i class="far fa-heart"></i>
+                </button>
+                <button class="song-action-btn download-btn" data-song-id="${song.id}">
+                    <i class="fas fa-download"></i>
+                </button>
+                ${!isFavoriteList ? `
+                <button class="song-action-btn delete-btn" data-song-id="${song.id}">
+                    <i class="fas fa-trash"></i>
+                </button>
+                ` : ''}
+            </div>
+        `;
+        
+        // Add event listeners to action buttons
+        const favoriteBtn = songCard.querySelector('.favorite-btn');
+        const downloadBtn = songCard.querySelector('.download-btn');
+        const deleteBtn = songCard.querySelector('.delete-btn');
+        
+        favoriteBtn.addEventListener('click', (e) => {
+            e.stopPropagation();
+            toggleFavorite(song.id, favoriteBtn);
+        });
+        
+        downloadBtn.addEventListener('click', (e) => {
+            e.stopPropagation();
+            showDownloadMenu(song.id, e);
+        });
+        
+        if (deleteBtn) {
+            deleteBtn.addEventListener('click', (e) => {
                 e.stopPropagation();
-                showDownloadMenu(song.id, e);
+                deleteSong(song.id);
             });
-            
-            if (deleteBtn) {
-                deleteBtn.addEventListener('click', (e) => {
-                    e.stopPropagation();
-                    deleteSong(song.id);
-                });
-            }
-            
-            // Check if song is favorite and update button
-            checkFavoriteStatus(song.id).then(isFavorite => {
-                if (isFavorite) {
-                    favoriteBtn.innerHTML = '<i class="fas fa-heart"></i>';
-                    favoriteBtn.classList.add('active');
-                }
-            });
-              // Play song when card is clicked
-            songCard.addEventListener('click', () => {
-                console.log('Playing song:', { id: song.id, name: song.name, artist: song.artist });
-                playSong(song.id, song.name, coverUrl, song.artist);
-            });
-            
-            container.appendChild(songCard);
+        }
+        
+        if (song.is_favorite || isFavoriteList) {
+            markFavoriteButton(favoriteBtn, true);
+        }
+          // Play song when card is clicked
+        songCard.addEventListener('click', () => {
+            console.log('Playing song:', { id: song.id, name: song.name, artist: song.artist });
+            playSong(song.id, song.name, coverUrl, song.artist);
         });
+        
+        return songCard;
+    }
+    
+    function markFavoriteButton(button, isFavorite) {
+        button.innerHTML = isFavorite ? 
+            '<i class="fas fa-heart"></i>' : 
+            '<i class="far fa-heart"></i>';
+        button.classList.toggle('active', isFavorite);
+    }
+    
+    function loadFavoriteStatuses(songIds, container) {
+        fetch('/api/favorites/status', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ song_ids: songIds })
+        })
+        .then(response => response.json())
+        .then(data => {
+            Object.entries(data.statuses || {}).forEach(([songId, isFavorite]) => {
+                const button = container.querySelector(`.favorite-btn[data-song-id="${songId}"]`);
+                if (button) markFavoriteButton(button, isFavorite);
+            });
+        })
+        .catch(error => console.error('Error loading favorite statuses:', error));
     }      function updateCurrentPlaylist() {
         const activeSection = favoritesSection.style.display === 'block' ? favoritesList : songList;
         const songCards = Array.from(activeSection.querySelectorAll('.song-card')).filter(
@@ -432,6 +708,9 @@ document.addEventListener('DOMContentLoaded', function() {
                 if (data.title) nowPlayingTitle.textContent = data.title;
                 // Priorizar el artista de la base de datos
                 nowPlayingArtist.textContent = data.artist || artist || 'Artista Desconocido';
+                // Portada y duración guardadas en el servidor, si las hay
+                if (data.thumbnail) nowPlayingCover.src = data.thumbnail;
+                if (data.duration) durationEl.textContent = formatTime(data.duration);
                 
                 audioPlayer.src = data.audio_stream_url;
                 audioPlayer.currentTime = 0;
@@ -442,6 +721,7 @@ document.addEventListener('DOMContentLoaded', function() {
         })
         .then(() => {
             updateFavoriteButton(songId);
+            prefetchUpcoming(songId);
         })
         .catch(error => {
             console.error('Error:', error);
@@ -451,7 +731,29 @@ document.addEventListener('DOMContentLoaded', function() {
                 showAlert('Error: ' + (error.message || 'No se pudo reproducir la canción'), 'error');
             }
         });
-    }    function addSong() {
+    }
+
+    // Pedir al servidor que resuelva ya las siguientes canciones de la lista
+    function prefetchUpcoming(songId) {
+        if (!currentPlaylist || currentPlaylist.length < 2) return;
+
+        const currentIndex = currentPlaylist.findIndex(song => String(song.id) === String(songId));
+        const upcoming = [];
+        for (let i = 1; i <= PREFETCH_COUNT && i < currentPlaylist.length; i++) {
+            upcoming.push(currentPlaylist[(currentIndex + i) % currentPlaylist.length].id);
+        }
+
+        fetch('/api/prefetch', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ song_ids: upcoming })
+        })
+        .catch(error => console.error('Error prefetching songs:', error));
+    }
+
+    function addSong() {
         const songUrl = document.getElementById('song-url').value;
         
         if (!songUrl) {
@@ -465,6 +767,11 @@ document.addEventListener('DOMContentLoaded', function() {
             return;
         }
         
+        if (isPlaylistUrl(songUrl)) {
+            importPlaylist(songUrl);
+            return;
+        }
+        
         showAlert('Procesando la canción...', 'info');
         
         fetch('/api/add_song', {
@@ -485,7 +792,7 @@ document.addEventListener('DOMContentLoaded', function() {
             if (ok && data.success) {
                 showAlert('Canción añadida correctamente!', 'success');
                 document.getElementById('song-url').value = '';
-                loadSongs();
+                syncLibrary();
             } else {
                 throw new Error(data.error || 'No se pudo añadir la canción');
             }
@@ -496,6 +803,47 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
     
+    function isPlaylistUrl(url) {
+        try {
+            const params = new URL(url).searchParams;
+            return params.has('list') && !params.has('v');
+        } catch (e) {
+            return false;
+        }
+    }
+    
+    function importPlaylist(playlistUrl) {
+        const progress = showProgress('Importando la playlist...');
+        
+        fetch('/api/import', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ playlist_url: playlistUrl })
+        })
+        .then(response => response.json().then(data => {
+            if (!response.ok) {
+                throw new Error(data.error || 'No se pudo importar la playlist');
+            }
+            return waitForJob(`/api/import/${data.job_id}`, job => {
+                const result = job.result || {};
+                progress.update(`Importando la playlist... ${result.processed || 0} de ${result.total || '?'} canciones`);
+            });
+        }))
+        .finally(() => progress.close())
+        .then(job => {
+            const result = job.result || {};
+            showAlert(`Importadas ${result.imported || 0} de ${result.total || 0} canciones`, 'success');
+            document.getElementById('song-url').value = '';
+            syncLibrary();
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            showAlert(error.message || 'Error al importar la playlist', 'error');
+        });
+    }
+    
     function isValidYouTubeUrl(url) {
         const pattern = /^(https?:\/\/)?(www\.)?(youtube\.com|youtu\.?be)\/.+$/;
         return pattern.test(url);
@@ -524,8 +872,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
         // Update UI state after deletion
         const updateUIState = async () => {
-            await loadSongs();
-            await loadFavorites();
+            await syncLibrary();
             await updateCurrentPlaylist();
             
             if (wasPlaying) {
@@ -611,8 +958,8 @@ document.addEventListener('DOMContentLoaded', function() {
                     updateFavoriteButton(songId);
                 }
                 
-                // Reload favorites list
-                loadFavorites();
+                // Traer solo el cambio, no la lista entera
+                syncLibrary();
             }
         })
         .catch(error => {
@@ -711,7 +1058,8 @@ document.addEventListener('DOMContentLoaded', function() {
     }
     
     function downloadSong(songId, format) {
-        showAlert(`Preparando descarga en formato ${format.toUpperCase()}...`, 'info');
+        const label = `Preparando descarga en formato ${format.toUpperCase()}...`;
+        const progress = showProgress(label);
         
         fetch('/api/download', {
             method: 'POST',
@@ -723,28 +1071,81 @@ document.addEventListener('DOMContentLoaded', function() {
                 format: format
             })
         })
-        .then(response => {
+        .then(response => response.json().then(data => {
             if (!response.ok) {
-                throw new Error('Error en la descarga');
+                throw new Error(data.error || 'Error en la descarga');
             }
-            return response.blob();
-        })
-        .then(blob => {
-            const url = URL.createObjectURL(blob);
+            return waitForJob(`/api/download/${data.job_id}`, job => {
+                progress.update(job.status === 'processing'
+                    ? 'Convirtiendo el audio...'
+                    : `${label} ${Math.round(job.progress || 0)}%`);
+            });
+        }))
+        .finally(() => progress.close())
+        .then(job => {
+            // El navegador descarga el fichero directamente, sin pasar por un blob
             const a = document.createElement('a');
-            a.href = url;
-            a.download = `cancion_${songId}.${format}`;
+            a.href = `/api/download/${job.job_id}/file`;
+            a.download = job.filename || `cancion_${songId}.${format}`;
             document.body.appendChild(a);
             a.click();
             document.body.removeChild(a);
-            URL.revokeObjectURL(url);
         })
         .catch(error => {
             console.error('Error:', error);
-            showAlert('Error al descargar la canción', 'error');
+            showAlert(error.message || 'Error al descargar la canción', 'error');
+        });
+    }
+    
+    // Consulta el estado de un trabajo en segundo plano hasta que termine
+    function waitForJob(statusUrl, onProgress) {
+        const jobId = statusUrl.split('/').pop();
+        return new Promise((resolve, reject) => {
+            let timer = null;
+            const finish = (callback, value) => {
+                jobWaiters.delete(jobId);
+                callback(value);
+            };
+            const poll = () => {
+                clearTimeout(timer);
+                fetch(statusUrl)
+                    .then(response => response.json())
+                    .then(job => {
+                        if (job.status === 'done') {
+                            finish(resolve, job);
+                        } else if (job.status === 'error' || job.error) {
+                            finish(reject, new Error(job.error || 'Error en el trabajo'));
+                        } else {
+                            if (onProgress) onProgress(job);
+                            timer = setTimeout(poll, JOB_POLL_INTERVAL);
+                        }
+                    })
+                    .catch(error => finish(reject, error));
+            };
+            // El evento 'job' adelanta la consulta en cuanto el trabajo termina
+            jobWaiters.set(jobId, poll);
+            poll();
         });
     }
     
+    // Aviso que se queda visible mientras dura un trabajo, con su progreso
+    function showProgress(message) {
+        const alert = document.createElement('div');
+        alert.className = 'alert alert-info';
+        alert.textContent = message;
+        
+        const mainContent = document.querySelector('.main-content');
+        mainContent.insertBefore(alert, mainContent.firstChild);
+        
+        return {
+            update: text => { alert.textContent = text; },
+            close: () => {
+                alert.style.opacity = '0';
+                setTimeout(() => alert.remove(), 300);
+            }
+        };
+    }
+    
     function showAlert(message, type) {
         const alert = document.createElement('div');
         alert.className = `alert alert-${type}`;
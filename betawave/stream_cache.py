@@ -0,0 +1,171 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+from db import get_db
+
+# Configuración por defecto de la caché
+DEFAULT_MAX_ENTRIES = 512
+DEFAULT_TTL = 3600          # Segundos que se guarda una URL sin "expire="
+EXPIRY_MARGIN = 300         # Margen para que la URL no caduque a mitad de canción
+
+logger = logging.getLogger(__name__)
+
+
+def parse_expire(stream_url):
+    """
+    Devuelve el timestamp "expire=" de una URL de googlevideo, o None
+    """
+    try:
+        values = parse_qs(urlparse(stream_url).query).get('expire')
+        return int(values[0]) if values else None
+    except (ValueError, TypeError):
+        return None
+
+
+class StreamStore:
+    """
+    Guarda las URLs resueltas en la tabla stream_urls, para que un worker
+    aproveche lo que ya resolvió otro (p. ej. la precarga y luego /api/play)
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def load(self, song_url):
+        with self.app.app_context():
+            row = get_db().execute("SELECT stream_url, expires_at FROM stream_urls WHERE song_url=?",
+                                   (song_url,)).fetchone()
+        return tuple(row) if row else None
+
+    def save(self, song_url, stream_url, expires_at):
+        with self.app.app_context():
+            conn = get_db()
+            try:
+                conn.execute("INSERT OR REPLACE INTO stream_urls (song_url, stream_url, expires_at) VALUES (?, ?, ?)",
+                             (song_url, stream_url, expires_at))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                logger.exception("Could not save stream URL for %s", song_url)
+
+    def delete(self, song_url):
+        with self.app.app_context():
+            conn = get_db()
+            try:
+                conn.execute("DELETE FROM stream_urls WHERE song_url=?", (song_url,))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                logger.exception("Could not delete stream URL for %s", song_url)
+
+
+class StreamCache:
+    """
+    Caché LRU con caducidad de las URLs de audio resueltas por yt-dlp,
+    indexada por la URL de la canción. Con un StreamStore, lo que no está en
+    memoria se busca también en lo resuelto por los demás procesos
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, margin=EXPIRY_MARGIN, store=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.margin = margin
+        self.store = store
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.shared_hits = 0
+
+    def _get_local(self, song_url, now):
+        entry = self._entries.get(song_url)
+        if entry is not None:
+            if entry[1] > now:
+                self._entries.move_to_end(song_url)
+                return entry[0]
+            del self._entries[song_url]
+        return None
+
+    def _load_shared(self, song_url, now):
+        if self.store is None:
+            return None
+        entry = self.store.load(song_url)
+        if entry is None or entry[1] <= now:
+            return None
+        self._store_local(song_url, *entry)
+        return entry[0]
+
+    def get(self, song_url):
+        now = time.time()
+        with self._lock:
+            stream_url = self._get_local(song_url, now)
+            if stream_url is not None:
+                self.hits += 1
+                return stream_url
+        stream_url = self._load_shared(song_url, now)
+        with self._lock:
+            if stream_url is not None:
+                self.hits += 1
+                self.shared_hits += 1
+            else:
+                self.misses += 1
+        return stream_url
+
+    def contains(self, song_url):
+        """
+        Indica si hay una URL vigente sin alterar los contadores
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(song_url)
+            if entry is not None and entry[1] > now:
+                return True
+        return self._load_shared(song_url, now) is not None
+
+    def _store_local(self, song_url, stream_url, expires_at):
+        with self._lock:
+            self._entries[song_url] = (stream_url, expires_at)
+            self._entries.move_to_end(song_url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def put(self, song_url, stream_url):
+        now = time.time()
+        expires_at = now + self.ttl
+        expire = parse_expire(stream_url)
+        if expire is not None:
+            expires_at = min(expires_at, expire - self.margin)
+        if expires_at <= now:
+            return
+        self._store_local(song_url, stream_url, expires_at)
+        if self.store is not None:
+            self.store.save(song_url, stream_url, expires_at)
+
+    def invalidate(self, song_url):
+        with self._lock:
+            self._entries.pop(song_url, None)
+        if self.store is not None:
+            self.store.delete(song_url)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = self.shared_hits = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'shared_hits': self.shared_hits,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
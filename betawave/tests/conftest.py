@@ -5,16 +5,25 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import tempfile
 import sqlite3
-from app import app, init_db, add_user, verify_user
+from app import create_app, init_db, add_user, verify_user
+
+TEST_DB = os.path.join(tempfile.gettempdir(), 'test_music.db')
 
 @pytest.fixture(scope="session")
 def app_configured():
     """Fixture para configurar la aplicación Flask"""
-    app.config.update({
+    return create_app({
         'TESTING': True,
-        'WTF_CSRF_ENABLED': False
+        'WTF_CSRF_ENABLED': False,
+        'DATABASE': TEST_DB,
+        'DOWNLOAD_CACHE_DIR': os.path.join(tempfile.gettempdir(), 'test_download_cache'),
+        'LOG_LEVEL': 'WARNING'
     })
-    return app
+
+@pytest.fixture(scope="session")
+def app(app_configured):
+    """La aplicación de pruebas, para los tests que la usan directamente"""
+    return app_configured
 
 @pytest.fixture(scope="function")
 def app_context(app_configured):
@@ -23,16 +32,16 @@ def app_context(app_configured):
         yield ctx
 
 @pytest.fixture(scope="function")
-def test_db(app_context):
+def test_db(app_context, app_configured):
     """Fixture para la base de datos de prueba"""
-    db_path = os.path.join(tempfile.gettempdir(), 'test_music.db')
+    db_path = TEST_DB
     
     # Limpiar base de datos anterior si existe
     if os.path.exists(db_path):
         os.unlink(db_path)
     
     # Configurar la base de datos de prueba
-    app.config['DATABASE'] = db_path
+    app_configured.config['DATABASE'] = db_path
     
     # Inicializar la base de datos
     init_db()
@@ -9,7 +9,7 @@ from flask import url_for, session
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from app import (
-    app, init_db, add_user, verify_user,
+    init_db, add_user, verify_user,
     add_song, get_songs, delete_song,
     add_favorite, remove_favorite, get_favorites,
     search_songs
@@ -18,7 +18,7 @@ from app import (
 # Las fixtures ahora están en conftest.py
 
 @pytest.fixture
-def client(test_db):
+def client(app, test_db):
     """Fixture para el cliente de pruebas"""
     with app.test_client() as client:
         yield client
@@ -65,7 +65,7 @@ def test_user_login(client):
     }, follow_redirects=True)
     assert response.status_code == 200
 
-def test_add_user_function():
+def test_add_user_function(app):
     """Prueba la función add_user directamente"""
     test_db = os.path.join(tempfile.gettempdir(), 'test_music.db')
     if os.path.exists(test_db):
@@ -105,7 +105,7 @@ def test_add_user_function():
             if os.path.exists(test_db):
                 os.remove(test_db)
 
-def test_verify_user_function():
+def test_verify_user_function(app):
     """Prueba la función verify_user directamente"""
     test_db = os.path.join(tempfile.gettempdir(), 'test_music.db')
     if os.path.exists(test_db):
@@ -126,7 +126,7 @@ def test_verify_user_function():
         assert verify_user('testuser', 'wrongpass') is None
         assert verify_user('wronguser', 'testpass') is None
 
-def test_song_management():
+def test_song_management(app):
     """Prueba la gestión de canciones (agregar, obtener y eliminar)"""
     test_db = os.path.join(tempfile.gettempdir(), 'test_music.db')
     if os.path.exists(test_db):
@@ -165,7 +165,7 @@ def test_song_management():
             if os.path.exists(test_db):
                 os.remove(test_db)
 
-def test_favorites_management():
+def test_favorites_management(app):
     """Prueba la gestión de favoritos (agregar, obtener y eliminar)"""
     test_db = os.path.join(tempfile.gettempdir(), 'test_music.db')
     if os.path.exists(test_db):
@@ -377,7 +377,7 @@ def test_user_config(client):
     assert response.status_code == 200, "Debería poder acceder a la configuración"
     assert b'value="75"' in response.data, "El volumen debería haberse actualizado"
 
-def test_profile_management(client, test_db, app_context):
+def test_profile_management(app, client, test_db, app_context):
     """Prueba la gestión del perfil de usuario"""
     
     print(f"\n[test_profile_management] Using test DB: {test_db}")
@@ -476,7 +476,7 @@ def test_song_api(client, test_db, app_context):
     artist_songs = [s for s in results if s['artist'] == 'Artist 2']
     assert len(artist_songs) == 1, "Debería encontrar 1 canción del artista"
 
-def test_admin_functions(client, test_db, app_context):
+def test_admin_functions(app, client, test_db, app_context):
     """Prueba las funciones del panel de administración"""
     # Asegurarse que el admin existe y tiene el rol correcto
     with app.app_context():
@@ -530,3 +530,1069 @@ def test_admin_functions(client, test_db, app_context):
         count = c.fetchone()[0]
         conn.close()
         assert count == 0, "El usuario debería haberse eliminado de la base de datos"
+
+def test_connection_pool(app, test_db):
+    """Prueba que las conexiones se reutilizan y usan el modo WAL"""
+    from db import get_db
+
+    with app.app_context():
+        conn = get_db()
+        assert get_db() is conn, "La conexión debería reutilizarse dentro del mismo contexto"
+        mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        assert mode == 'wal', "La base de datos debería usar el modo WAL"
+
+    # Al cerrar el contexto la conexión vuelve al pool y se reutiliza
+    with app.app_context():
+        assert get_db() is conn, "La conexión debería devolverse al pool"
+
+def test_stream_cache():
+    """Prueba la caducidad, el LRU y los contadores de la caché de streams"""
+    import time
+    from stream_cache import StreamCache
+
+    cache = StreamCache(max_entries=2, ttl=3600, margin=60)
+
+    # Una URL que caduca dentro del margen no se guarda
+    cache.put('song1', f'https://rr1.googlevideo.com/videoplayback?expire={int(time.time()) + 30}')
+    assert cache.get('song1') is None, "No debería guardarse una URL a punto de caducar"
+
+    cache.put('song1', f'https://rr1.googlevideo.com/videoplayback?expire={int(time.time()) + 7200}')
+    cache.put('song2', 'https://example.com/2')
+    assert cache.get('song1') is not None, "Debería encontrarse la URL en caché"
+
+    # song2 es la menos usada y debe salir al superar el tamaño máximo
+    cache.put('song3', 'https://example.com/3')
+    assert cache.get('song2') is None, "La entrada menos usada debería haberse expulsado"
+    assert cache.get('song3') == 'https://example.com/3'
+
+    stats = cache.stats()
+    assert stats['hits'] == 2 and stats['misses'] == 2, "Los contadores deberían reflejar aciertos y fallos"
+    assert stats['evictions'] == 1
+
+def test_stream_cache_shared_between_workers(app, test_db):
+    """Prueba que una URL resuelta en un proceso la aprovechan los demás"""
+    from stream_cache import StreamCache, StreamStore
+
+    # Dos cachés con el mismo almacén simulan dos workers de gunicorn
+    worker_a = StreamCache(store=StreamStore(app))
+    worker_b = StreamCache(store=StreamStore(app))
+    worker_a.put('song', 'https://example.com/audio')
+    assert worker_b.get('song') == 'https://example.com/audio', "La URL debería verse desde otro proceso"
+    assert worker_b.stats()['shared_hits'] == 1
+    assert StreamCache(store=StreamStore(app)).contains('song'), "La precarga no debería repetirse en otro proceso"
+
+    worker_a.invalidate('song')
+    assert StreamCache(store=StreamStore(app)).get('song') is None, "La URL invalidada no debería compartirse"
+
+def test_play_uses_stream_cache(app, client):
+    """Prueba que /api/play responde desde la caché sin llamar a yt-dlp"""
+    stream_cache = app.extensions['betawave'].stream_cache
+
+    user = login_test_user(client)
+    song_url = "https://www.youtube.com/watch?v=cached"
+    song_id = add_song("Cached Song", "Artist", song_url, user['id'])
+    stream_cache.put(song_url, 'https://example.com/audio')
+
+    hits = stream_cache.hits
+    response = client.post('/api/play', json={'song_id': song_id})
+    assert response.status_code == 200, "Debería poder reproducir la canción"
+    assert response.get_json()['audio_stream_url'] == f'/api/stream/{song_id}', "Debería apuntar al proxy de audio"
+    assert stream_cache.hits == hits + 1, "La URL debería salir de la caché"
+    stream_cache.invalidate(song_url)
+
+def test_prefetch_api(app, client, monkeypatch):
+    """Prueba que /api/prefetch resuelve en segundo plano las canciones del usuario"""
+    import time
+    import app as app_module
+    stream_cache = app.extensions['betawave'].stream_cache
+
+    resolved = []
+    def fake_resolve(song_url):
+        resolved.append(song_url)
+        stream_cache.put(song_url, 'https://example.com/audio')
+    monkeypatch.setattr(app_module, 'resolve_stream_url', fake_resolve)
+
+    user = login_test_user(client)
+    song_ids = [
+        add_song(f"Song {i}", "Artist", f"https://www.youtube.com/watch?v=prefetch{i}", user['id'])
+        for i in range(2)
+    ]
+
+    response = client.post('/api/prefetch', json={'song_ids': song_ids + [9999]})
+    assert response.status_code == 202, "La precarga debería aceptarse"
+    assert response.get_json()['scheduled'] == 2, "Solo deberían precargarse las canciones del usuario"
+
+    app.extensions['betawave'].prefetch_executor.submit(lambda: None).result(timeout=5)
+    for _ in range(50):
+        if len(resolved) == 2:
+            break
+        time.sleep(0.05)
+    assert len(resolved) == 2, "Las canciones deberían haberse resuelto en segundo plano"
+
+    # Las canciones ya en caché no se vuelven a resolver
+    response = client.post('/api/prefetch', json={'song_ids': song_ids})
+    assert response.get_json()['scheduled'] == 0, "No debería precargarse lo que ya está en caché"
+    for i in range(2):
+        stream_cache.invalidate(f"https://www.youtube.com/watch?v=prefetch{i}")
+
+def test_favorite_status_bulk(client):
+    """Prueba el estado de favorito en /api/songs y el endpoint de consulta en bloque"""
+    user = login_test_user(client)
+    fav_id = add_song("Fav Song", "Artist", "http://example.com/fav.mp3", user['id'])
+    other_id = add_song("Other Song", "Artist", "http://example.com/other.mp3", user['id'])
+    add_favorite(user['id'], fav_id)
+
+    songs = {song['id']: song for song in client.get('/api/songs').get_json()}
+    assert songs[fav_id]['is_favorite'] == True, "La canción favorita debería venir marcada"
+    assert songs[other_id]['is_favorite'] == False, "La otra canción no debería ser favorita"
+
+    response = client.post('/api/favorites/status', json={'song_ids': [fav_id, other_id]})
+    assert response.status_code == 200, "Debería poder consultar varios favoritos"
+    statuses = response.get_json()['statuses']
+    assert statuses == {str(fav_id): True, str(other_id): False}
+
+def test_full_text_search(client):
+    """Prueba la búsqueda por prefijos, sin acentos y paginada"""
+    user = login_test_user(client)
+    add_song("Canción Pública", "Beyoncé", "http://example.com/a.mp3", user['id'])
+    add_song("Another Track", "Artist", "http://example.com/b.mp3", user['id'])
+    add_song("Cancion Dos", "Artist", "http://example.com/c.mp3", user['id'])
+
+    results = search_songs(user['id'], 'beyon')
+    assert [s['name'] for s in results] == ["Canción Pública"], "Debería encontrar por prefijo y sin acentos"
+
+    results = search_songs(user['id'], 'cancion')
+    assert len(results) == 2, "Debería ignorar los acentos"
+
+    response = client.post('/api/search', json={'search_term': 'cancion', 'limit': 1})
+    assert response.status_code == 200, "Debería poder buscar con paginación"
+    assert len(response.get_json()) == 1, "Debería devolver una sola canción"
+    assert response.headers.get('X-Next-Offset') == '1', "Debería indicar la siguiente página"
+    for limit in (0, -1, -5):
+        response = client.post('/api/search', json={'search_term': 'cancion', 'limit': limit})
+        assert len(response.get_json()) == 1, "Un límite menor que 1 debería tratarse como 1"
+        assert response.headers.get('X-Next-Offset') == '1', "La siguiente página siempre debería avanzar"
+    response = client.post('/api/search', json={'search_term': 'cancion', 'offset': -1})
+    assert response.status_code == 400, "Un offset negativo debería rechazarse"
+
+    # El índice se mantiene al borrar canciones
+    song_id = search_songs(user['id'], 'another')[0]['id']
+    delete_song(song_id, user['id'])
+    assert search_songs(user['id'], 'another') == [], "La canción borrada no debería aparecer"
+
+def test_song_list_pagination(client):
+    """Prueba la paginación por cursor de /api/songs y /api/favorites"""
+    user = login_test_user(client)
+    song_ids = [
+        add_song(f"Song {i}", "Artist", f"http://example.com/{i}.mp3", user['id'])
+        for i in range(5)
+    ]
+    for song_id in song_ids:
+        add_favorite(user['id'], song_id)
+
+    for url in ('/api/songs', '/api/favorites'):
+        received = []
+        cursor = None
+        while True:
+            query = f'{url}?limit=2' + (f'&after={cursor}' if cursor else '')
+            response = client.get(query)
+            assert response.status_code == 200, "Debería poder obtener la página"
+            page = response.get_json()
+            assert len(page) <= 2, "La página no debería superar el límite"
+            received.extend(song['id'] for song in page)
+            cursor = response.headers.get('X-Next-Cursor')
+            if not cursor:
+                break
+        assert received == song_ids, f"{url} debería devolver todas las canciones en orden"
+
+def test_schema_migrations(app):
+    """Prueba que init_db migra en el sitio una base de datos antigua"""
+    import migrations
+
+    test_db = os.path.join(tempfile.gettempdir(), 'test_legacy_music.db')
+    if os.path.exists(test_db):
+        os.remove(test_db)
+
+    # Esquema antiguo: sin role, created_at ni índices y con una canción repetida
+    conn = sqlite3.connect(test_db)
+    conn.executescript('''
+        CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE NOT NULL,
+                            password TEXT NOT NULL, email TEXT);
+        CREATE TABLE songs (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, artist TEXT,
+                            url TEXT NOT NULL, user_id INTEGER NOT NULL);
+        CREATE TABLE favorites (user_id INTEGER NOT NULL, song_id INTEGER NOT NULL,
+                                PRIMARY KEY (user_id, song_id));
+        INSERT INTO users (username, password) VALUES ('olduser', 'x');
+        INSERT INTO songs (name, artist, url, user_id) VALUES ('Song', 'Artist', 'http://example.com/1', 1);
+        INSERT INTO songs (name, artist, url, user_id) VALUES ('Song', 'Artist', 'http://example.com/1', 1);
+        INSERT INTO favorites VALUES (1, 2);
+    ''')
+    conn.close()
+
+    try:
+        with app.app_context():
+            app.config['DATABASE'] = test_db
+            init_db()
+
+        conn = sqlite3.connect(test_db)
+        c = conn.cursor()
+        c.execute("PRAGMA user_version")
+        assert c.fetchone()[0] == migrations.SCHEMA_VERSION, "El esquema debería estar en la última versión"
+        c.execute("PRAGMA table_info(users)")
+        assert {'role', 'created_at'} <= {row[1] for row in c.fetchall()}, "Deberían añadirse las columnas nuevas"
+        c.execute("SELECT last_login_at IS NOT NULL FROM users WHERE username = 'olduser'")
+        assert c.fetchone()[0], "Los usuarios existentes no deberían parecer inactivos tras migrar"
+        c.execute("SELECT name FROM sqlite_master WHERE type='index' AND name LIKE 'idx_%'")
+        indexes = {row[0] for row in c.fetchall()}
+        assert indexes == {'idx_songs_user', 'idx_songs_user_url', 'idx_favorites_song', 'idx_users_created_at',
+                           'idx_library_changes_created', 'idx_users_username_nocase', 'idx_user_stats_songs',
+                           'idx_user_stats_favorites', 'idx_sessions_user', 'idx_sessions_expires',
+                           'idx_stream_urls_expires'}
+        c.execute("SELECT id FROM songs")
+        assert c.fetchall() == [(1,)], "La canción repetida debería fusionarse con la original"
+        c.execute("SELECT song_id FROM favorites")
+        assert c.fetchall() == [(1,)], "El favorito debería apuntar a la canción conservada"
+        c.execute("EXPLAIN QUERY PLAN SELECT 1 FROM favorites WHERE song_id = 1")
+        assert 'idx_favorites_song' in str(c.fetchall()), "El borrado por canción debería usar el índice"
+        conn.close()
+
+        # Volver a ejecutar init_db no debe aplicar nada de nuevo
+        with app.app_context():
+            init_db()
+    finally:
+        if os.path.exists(test_db):
+            os.remove(test_db)
+
+def test_download_jobs(client, monkeypatch, tmp_path):
+    """Prueba el flujo de descarga en segundo plano: trabajo, estado y fichero"""
+    import time
+    import app as app_module
+
+    def fake_download(job, song_url, format_type):
+        job.filepath = str(tmp_path / f'song.{format_type}')
+        job.filename = f'Test Song.{format_type}'
+        with open(job.filepath, 'wb') as f:
+            f.write(b'audio')
+    monkeypatch.setattr(app_module, 'run_download', fake_download)
+
+    user = login_test_user(client)
+    song_id = add_song("Test Song", "Artist", "https://www.youtube.com/watch?v=download", user['id'])
+
+    response = client.post('/api/download', json={'song_id': song_id, 'format': 'mp3'})
+    assert response.status_code == 202, "La descarga debería encolarse"
+    job_id = response.get_json()['job_id']
+
+    for _ in range(50):
+        status = client.get(f'/api/download/{job_id}').get_json()
+        if status['status'] == 'done':
+            break
+        time.sleep(0.05)
+    assert status['status'] == 'done', "La descarga debería terminar"
+    assert status['progress'] == 100
+
+    response = client.get(f'/api/download/{job_id}/file')
+    assert response.status_code == 200, "Debería poder obtenerse el fichero"
+    assert response.data == b'audio'
+    response.close()
+
+    # Otro usuario no puede ver el trabajo
+    add_user('otheruser', 'otherpass')
+    with client.session_transaction() as sess:
+        sess['user_id'] = verify_user('otheruser', 'otherpass')['id']
+    assert client.get(f'/api/download/{job_id}').status_code == 404
+
+def test_download_extension_differs_from_codec(app, app_context, monkeypatch):
+    """Prueba las descargas cuyo fichero no lleva el nombre del códec (aac -> .m4a)"""
+    import app as app_module
+    from jobs import Job
+
+    def fake_extract(url, ydl_opts, operation, download=False):
+        # Como FFmpegExtractAudio: aac se guarda como .m4a, vorbis como .ogg
+        codec = ydl_opts['postprocessors'][0]['preferredcodec']
+        path = ydl_opts['outtmpl'].replace('%(ext)s', app_module.DOWNLOAD_EXTENSIONS[codec])
+        with open(path, 'wb') as f:
+            f.write(codec.encode())
+        info = {'title': 'Song'}
+        if codec == 'vorbis':
+            info['requested_downloads'] = [{'filepath': path}]
+        return info
+    monkeypatch.setattr(app_module, 'ytdlp_extract', fake_extract)
+
+    for codec, extension in (('aac', 'm4a'), ('vorbis', 'ogg')):
+        job = Job(1)
+        app_module.run_download(job, f'https://youtu.be/ext-{codec}', codec)
+        assert job.filename == f'Song.{extension}', "El nombre debería llevar la extensión real"
+        with open(job.filepath, 'rb') as f:
+            assert f.read() == codec.encode(), "El audio convertido debería guardarse en la caché"
+
+def test_transcode_cache():
+    """Prueba la caché de audios convertidos: aciertos, LRU por tamaño y huérfanos"""
+    import time
+    from app import extract_video_id
+    from transcode_cache import TranscodeCache
+
+    assert extract_video_id("https://www.youtube.com/watch?v=abc123&list=x") == "abc123"
+    assert extract_video_id("https://youtu.be/abc123") == "abc123"
+    assert extract_video_id("https://www.youtube.com/shorts/abc123") == "abc123"
+
+    root = tempfile.mkdtemp()
+    try:
+        cache = TranscodeCache(root, max_bytes=10)
+
+        def add(video_id):
+            temp_dir = cache.make_temp_dir()
+            source = os.path.join(temp_dir, 'audio.mp3')
+            with open(source, 'wb') as f:
+                f.write(b'12345')
+            path = cache.put((video_id, 'mp3', '192'), source, f'Title {video_id}')
+            os.rmdir(temp_dir)
+            return path
+
+        path_a = add('a')
+        assert cache.get(('a', 'mp3', '192')) == (path_a, 'Title a'), "Debería encontrarse el audio en caché"
+        assert cache.get(('a', 'wav', '192')) is None, "Otro formato no debería estar en caché"
+
+        add('b')
+        # 'a' es el más antiguo: al añadir 'c' se supera el tamaño y debe salir
+        old = time.time() - 100
+        os.utime(path_a, (old, old))
+        add('c')
+        assert cache.get(('a', 'mp3', '192')) is None, "El audio menos usado debería expulsarse"
+        assert cache.get(('c', 'mp3', '192')) is not None
+
+        # Los directorios temporales abandonados se limpian
+        orphan = cache.make_temp_dir()
+        os.utime(orphan, (old - 3600, old - 3600))
+        cache.cleanup_orphans()
+        assert not os.path.exists(orphan), "El directorio huérfano debería borrarse"
+    finally:
+        import shutil
+        shutil.rmtree(root, ignore_errors=True)
+
+def test_stream_proxy(app, client, monkeypatch):
+    """Prueba que el proxy de audio reenvía Range y vuelve a resolver URLs caducadas"""
+    import app as app_module
+    stream_cache = app.extensions['betawave'].stream_cache
+
+    class FakeUpstream:
+        def __init__(self, status, body=b'', headers=None):
+            self.status = status
+            self.body = body
+            self.headers = headers or {}
+            self.released = False
+        def stream(self, chunk_size):
+            for i in range(0, len(self.body), 2):
+                yield self.body[i:i + 2]
+        def release_conn(self):
+            self.released = True
+
+    requests_seen = []
+    responses = [
+        FakeUpstream(403),
+        FakeUpstream(206, b'abcd', {'Content-Type': 'audio/webm', 'Content-Range': 'bytes 0-3/10'})
+    ]
+    class FakePool:
+        def request(self, method, url, headers=None, preload_content=True):
+            requests_seen.append((url, headers))
+            return responses.pop(0)
+    monkeypatch.setattr(app.extensions['betawave'], 'http_pool', FakePool())
+
+    user = login_test_user(client)
+    song_url = "https://www.youtube.com/watch?v=stream"
+    song_id = add_song("Stream Song", "Artist", song_url, user['id'])
+    stream_cache.put(song_url, 'https://example.com/expired')
+    monkeypatch.setattr(app_module, 'resolve_stream_url',
+                        lambda url: stream_cache.get(url) or 'https://example.com/fresh')
+
+    response = client.get(f'/api/stream/{song_id}', headers={'Range': 'bytes=0-3'})
+    assert response.status_code == 206, "Debería devolver contenido parcial"
+    assert response.data == b'abcd'
+    assert response.headers['Content-Range'] == 'bytes 0-3/10'
+    assert requests_seen[0] == ('https://example.com/expired', {'Range': 'bytes=0-3'})
+    assert requests_seen[1][0] == 'https://example.com/fresh', "Debería resolverse de nuevo la URL caducada"
+
+    assert client.get('/api/stream/999999').status_code == 404
+
+def test_bulk_import(client, monkeypatch):
+    """Prueba la importación masiva con extracción concurrente e inserción en bloque"""
+    import time
+    import app as app_module
+    from app import infer_artist
+
+    assert infer_artist({'uploader': 'Band'}, 'Song') == 'Band'
+    assert infer_artist({}, 'Band - Song') == 'Band'
+    assert infer_artist({}, 'Song') == 'Artista Desconocido'
+
+    def fake_metadata(url):
+        if url.endswith('bad'):
+            raise ValueError('Video no disponible')
+        return {'video_id': url[-1], 'title': f"Title {url[-1]}", 'artist': "Artist",
+                'duration': 60, 'thumbnail': None, 'fetched_at': int(time.time())}
+    monkeypatch.setattr(app_module, 'fetch_video_metadata', fake_metadata)
+
+    user = login_test_user(client)
+    add_song("Title 1", "Artist", "https://youtu.be/1", user['id'])
+
+    urls = ["https://youtu.be/1", "https://youtu.be/2", "https://youtu.be/3", "https://youtu.be/bad"]
+    response = client.post('/api/import', json={'urls': urls})
+    assert response.status_code == 202, "La importación debería encolarse"
+    job_id = response.get_json()['job_id']
+
+    for _ in range(50):
+        job = client.get(f'/api/import/{job_id}').get_json()
+        if job['status'] == 'done':
+            break
+        time.sleep(0.05)
+    assert job['status'] == 'done', "La importación debería terminar"
+    assert job['result'] == {'total': 4, 'processed': 4, 'cached': 0, 'imported': 2, 'skipped': 1, 'failed': 1}
+
+    names = [song['name'] for song in get_songs(user['id'])]
+    assert names == ["Title 1", "Title 2", "Title 3"], "Las canciones deberían insertarse en orden y sin repetir"
+
+    response = client.post('/api/import', json={'urls': ["https://example.com/x"]})
+    assert response.status_code == 400, "Solo deberían aceptarse URLs de YouTube"
+    for urls in ([None], "https://youtu.be/abc", [["https://youtu.be/abc"]]):
+        response = client.post('/api/import', json={'urls': urls})
+        assert response.status_code == 400, "urls debería ser una lista de cadenas"
+
+def test_video_metadata_cache(app, client, monkeypatch):
+    """Prueba que los metadatos de un vídeo se piden a YouTube una sola vez para todos los usuarios"""
+    import time
+    import app as app_module
+    from app import extract_song_metadata, get_video_metadata
+
+    calls = []
+    def fake_fetch(url):
+        calls.append(url)
+        return {'video_id': 'abc123', 'title': 'Cached Song', 'artist': 'Cached Artist',
+                'duration': 215, 'thumbnail': 'https://i.ytimg.com/vi/abc123/hq.jpg',
+                'fetched_at': int(time.time())}
+    monkeypatch.setattr(app_module, 'fetch_video_metadata', fake_fetch)
+    monkeypatch.setattr(app_module, 'resolve_stream_url', lambda url: 'https://stream.example.com/audio')
+
+    user = login_test_user(client)
+    response = client.post('/api/add_song', json={'song_url': 'https://www.youtube.com/watch?v=abc123'})
+    assert response.status_code == 200, "La canción debería añadirse"
+    song_id = response.get_json()['song']['id']
+
+    # Otro usuario añade el mismo vídeo con otra forma de URL
+    add_user("otheruser", "password123")
+    with client.session_transaction() as sess:
+        sess['user_id'] = verify_user("otheruser", "password123")['id']
+    response = client.post('/api/add_song', json={'song_url': 'https://youtu.be/abc123'})
+    assert response.get_json()['song']['name'] == 'Cached Song'
+    assert len(calls) == 1, "El segundo usuario debería usar los metadatos guardados"
+
+    # Los datos caducados se refrescan, y si YouTube falla se usan los antiguos
+    with app.app_context():
+        entry = get_video_metadata(['abc123'])['abc123']
+        entry['fetched_at'] = 0
+        app_module.save_video_metadata([entry])
+        assert extract_song_metadata('https://youtu.be/abc123') == ('Cached Song', 'Cached Artist')
+        assert len(calls) == 2, "Los metadatos caducados deberían refrescarse"
+
+        entry['fetched_at'] = 0
+        app_module.save_video_metadata([entry])
+        def failing_fetch(url):
+            raise ValueError('Sin conexión')
+        monkeypatch.setattr(app_module, 'fetch_video_metadata', failing_fetch)
+        assert extract_song_metadata('https://youtu.be/abc123') == ('Cached Song', 'Cached Artist')
+
+    # /api/play devuelve la duración y la portada guardadas
+    with client.session_transaction() as sess:
+        sess['user_id'] = user['id']
+    data = client.post('/api/play', json={'song_id': song_id}).get_json()
+    assert data['duration'] == 215
+    assert data['thumbnail'] == 'https://i.ytimg.com/vi/abc123/hq.jpg'
+
+def test_structured_logging(client):
+    """Prueba el formato JSON, el id de petición y el muestreo de los logs"""
+    import io
+    import json
+    import logging
+    import log_config
+
+    stream = io.StringIO()
+    log_config.configure_logging('DEBUG', json_format=True, stream=stream)
+    try:
+        response = client.get('/login', headers={'X-Request-ID': 'req-123'})
+        assert response.headers['X-Request-ID'] == 'req-123', "Se debería devolver el id de la petición"
+        entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+        request_log = [e for e in entries if e['logger'] == 'betawave.request']
+        assert request_log and request_log[-1]['request_id'] == 'req-123'
+        assert request_log[-1]['status'] == 200 and 'duration_ms' in request_log[-1]
+
+        # Con muestreo 0 solo pasan los avisos y errores
+        stream.seek(0)
+        stream.truncate()
+        log_config.configure_logging('DEBUG', json_format=True, sample_rate=0.0, stream=stream)
+        logging.getLogger('betawave').info('descartado')
+        logging.getLogger('betawave').warning('conservado')
+        messages = [json.loads(line)['msg'] for line in stream.getvalue().splitlines()]
+        assert messages == ['conservado'], "El muestreo no debería descartar avisos"
+    finally:
+        log_config.configure_logging('WARNING', json_format=True)
+
+def test_metrics_endpoint(app, client, monkeypatch):
+    """Prueba que /metrics expone latencias por ruta, por consulta y de yt-dlp"""
+    import yt_dlp
+    from metrics import Histogram
+
+    histogram = Histogram('test_seconds', 'Test', ['op'], buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, op='x')
+    lines = histogram.render()
+    assert 'test_seconds_bucket{op="x",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{op="x",le="1"} 2' in lines
+    assert 'test_seconds_bucket{op="x",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{op="x"} 3' in lines
+
+    class FailingYDL:
+        def __init__(self, opts):
+            pass
+        def __enter__(self):
+            return self
+        def __exit__(self, *exc):
+            return False
+        def extract_info(self, url, download=False):
+            raise RuntimeError('Video no disponible')
+    monkeypatch.setattr(yt_dlp, 'YoutubeDL', FailingYDL)
+
+    login_test_user(client)
+    client.get('/api/songs')
+    client.post('/api/add_song', json={'song_url': 'https://youtu.be/missing'})
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+    body = response.get_data(as_text=True)
+    assert 'betawave_request_duration_seconds_count{endpoint="main.get_songs_route",method="GET"}' in body
+    assert 'betawave_db_query_duration_seconds_count{query="get_songs"}' in body
+    assert 'betawave_ytdlp_errors_total{operation="metadata"}' in body
+    assert 'betawave_jobs{queue="download",state="running"}' in body
+    assert 'betawave_cache_hit_ratio{cache="stream"}' in body
+
+    response = client.get('/metrics', environ_base={'REMOTE_ADDR': '10.0.0.5'})
+    assert response.status_code == 403, "Desde fuera solo deberían verlo los administradores"
+
+def test_metrics_multiprocess(tmp_path):
+    """Prueba que las métricas de varios workers se suman y no bajan al reciclar uno"""
+    import metrics
+
+    registry = metrics.Registry()
+    requests = registry.counter('test_requests_total', 'Test', ['status'])
+    latency = registry.histogram('test_latency_seconds', 'Test', buckets=(1,))
+    registry.callback('test_open', 'Test', lambda: 2)
+    requests.inc(3, status='200')
+    latency.observe(0.5)
+
+    # Lo que volcó otro worker, con su propio registro
+    other = metrics.Registry()
+    other.counter('test_requests_total', 'Test', ['status']).inc(4, status='200')
+    other.histogram('test_latency_seconds', 'Test', buckets=(1,)).observe(2)
+    other.callback('test_open', 'Test', lambda: 5)
+    metrics.MultiProcessCollector(other, str(tmp_path)).flush()
+    os.replace(tmp_path / f'{os.getpid()}.json', tmp_path / '99999.json')
+
+    collector = metrics.MultiProcessCollector(registry, str(tmp_path))
+    body = collector.render()
+    assert 'test_requests_total{status="200"} 7' in body, "Deberían sumarse los contadores de todos los workers"
+    assert 'test_latency_seconds_bucket{le="1"} 1' in body
+    assert 'test_latency_seconds_count 2' in body
+    assert 'test_open 7' in body
+
+    metrics.archive_process(str(tmp_path), 99999)
+    assert not (tmp_path / '99999.json').exists()
+    body = collector.render()
+    assert 'test_requests_total{status="200"} 7' in body, "Un worker terminado no debería restar"
+    assert 'test_latency_seconds_count 2' in body
+    assert 'test_open 2' in body, "Los valores instantáneos de un worker terminado se descartan"
+
+def test_jobs_shared_between_workers(app, test_db):
+    """Prueba que un trabajo lanzado en un proceso se puede consultar desde otro"""
+    import threading
+    import time
+    from jobs import JobQueue, JobStore, DONE, ERROR
+
+    def work(job, value):
+        job.result = {'value': value}
+
+    # Dos colas con el mismo nombre simulan dos workers de gunicorn
+    worker_a = JobQueue(max_workers=1, name='shared', store=JobStore(app))
+    worker_b = JobQueue(max_workers=1, name='shared', store=JobStore(app))
+    job = worker_a.submit(1, work, 42)
+    for _ in range(50):
+        if job.status == DONE:
+            break
+        time.sleep(0.05)
+
+    remote = worker_b.get(job.id, 1)
+    assert remote is not None, "El otro worker debería encontrar el trabajo"
+    assert remote.status == DONE and remote.result == {'value': 42}
+    assert worker_b.get(job.id, 2) is None, "No debería verlo otro usuario"
+
+    # Al parar un worker, sus trabajos en marcha se marcan como interrumpidos
+    # en vez de seguir como 'running' hasta caducar
+    release = threading.Event()
+    slow = worker_a.submit(1, lambda job: release.wait(5))
+    queued = worker_a.submit(1, lambda job: None)
+    worker_a.shutdown(timeout=0.2)
+    release.set()
+    assert worker_b.get(slow.id, 1).status == ERROR, "El trabajo en marcha debería constar como interrumpido"
+    assert worker_b.get(queued.id, 1).status == ERROR
+
+    # Liberar los hilos de las colas de prueba
+    worker_b.shutdown()
+
+def test_static_asset_fingerprinting(client):
+    """Prueba las URLs con hash de los estáticos, su caché inmutable y la compresión"""
+    import gzip
+    import re
+
+    page = client.get('/login').get_data(as_text=True)
+    match = re.search(r'href="(/assets/[0-9a-f]{12}/css/auth\.css)"', page)
+    assert match, "Las plantillas deberían enlazar los estáticos con su hash"
+    url = match.group(1)
+
+    with open(os.path.join(os.path.dirname(__file__), '..', 'static', 'css', 'auth.css'), 'rb') as f:
+        original = f.read()
+
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert 'immutable' in response.headers['Cache-Control']
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data) == original, "El contenido comprimido debería ser el original"
+
+    response = client.get(url)
+    assert 'Content-Encoding' not in response.headers and response.data == original
+
+    etag = response.headers['ETag']
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+    # Un hash antiguo redirige a la versión actual
+    response = client.get('/assets/000000000000/css/auth.css')
+    assert response.status_code == 302 and response.headers['Location'].endswith(url)
+    assert client.get('/assets/000000000000/css/missing.css').status_code == 404
+
+def test_library_etags(client):
+    """Prueba los ETag de las listas y que cambian con cada modificación de la biblioteca"""
+    from app import get_library_revision
+
+    user = login_test_user(client)
+    song_id = add_song("Song", "Artist", "https://youtu.be/etag", user['id'])
+
+    response = client.get('/api/songs?limit=10')
+    etag = response.headers['ETag']
+    assert response.status_code == 200 and etag
+    assert not response.get_etag()[1], "El ETag debería ser fuerte"
+
+    response = client.get('/api/songs?limit=10', headers={'If-None-Match': etag})
+    assert response.status_code == 304, "Sin cambios debería responder 304"
+    assert response.data == b''
+    assert client.get('/api/songs?limit=5', headers={'If-None-Match': etag}).status_code == 200, \
+        "Otra página no debería compartir ETag"
+
+    revision = get_library_revision(user['id'])
+    client.post('/api/toggle_favorite', json={'song_id': song_id})
+    assert get_library_revision(user['id']) == revision + 1, "Marcar un favorito debería subir la revisión"
+    response = client.get('/api/songs?limit=10', headers={'If-None-Match': etag})
+    assert response.status_code == 200, "Tras un cambio debería devolverse la lista nueva"
+    assert response.get_json()[0]['is_favorite'] is True
+
+    favorites_etag = client.get('/api/favorites').headers['ETag']
+    assert client.get('/api/favorites', headers={'If-None-Match': favorites_etag}).status_code == 304
+    client.post('/api/delete', json={'song_id': song_id})
+    assert client.get('/api/favorites', headers={'If-None-Match': favorites_etag}).status_code == 200
+
+def test_library_changes(client, test_db):
+    """Prueba la sincronización incremental con /api/changes"""
+    user = login_test_user(client)
+    keep_id = add_song("Keep", "Artist", "https://youtu.be/keep", user['id'])
+
+    response = client.get('/api/songs')
+    since = int(response.headers['X-Library-Revision'])
+    assert client.get('/api/changes').status_code == 400, "since debería ser obligatorio"
+    assert client.get(f'/api/changes?since={since}').get_json() == \
+        {'revision': since, 'reset': False, 'songs': [], 'deleted': []}
+
+    new_id = add_song("New", "Artist", "https://youtu.be/new", user['id'])
+    gone_id = add_song("Gone", "Artist", "https://youtu.be/gone", user['id'])
+    client.post('/api/toggle_favorite', json={'song_id': keep_id})
+    client.post('/api/delete', json={'song_id': gone_id})
+
+    changes = client.get(f'/api/changes?since={since}').get_json()
+    assert changes['reset'] is False
+    assert changes['revision'] == since + 4, "Cada cambio debería ser una revisión"
+    assert [(song['id'], song['is_favorite']) for song in changes['songs']] == \
+        [(keep_id, True), (new_id, False)], "Solo deberían llegar las canciones cambiadas"
+    assert changes['deleted'] == [gone_id]
+
+    # Un cliente con una revisión que el servidor no conoce debe recargar todo
+    assert client.get(f"/api/changes?since={changes['revision'] + 1}").get_json()['reset'] is True
+    conn = sqlite3.connect(test_db)
+    conn.execute("DELETE FROM library_changes WHERE revision <= ?", (since + 1,))
+    conn.commit()
+    conn.close()
+    assert client.get(f'/api/changes?since={since}').get_json()['reset'] is True, \
+        "Si faltan cambios el cliente debería recargar"
+
+    # Las canciones de otro usuario no se pueden marcar como favoritas, y si
+    # ya lo estaban no aparecen en la lista de favoritos
+    add_user('owner', 'ownerpass')
+    foreign_id = add_song("Foreign", "Artist", "https://youtu.be/foreign", verify_user('owner', 'ownerpass')['id'])
+    assert client.post('/api/toggle_favorite', json={'song_id': foreign_id}).status_code == 404
+    add_favorite(user['id'], foreign_id)
+    assert foreign_id not in [song['id'] for song in client.get('/api/favorites').get_json()], \
+        "Favoritos y cambios deberían limitarse a las canciones del usuario"
+
+def test_event_stream(client, app):
+    """Prueba que /api/events avisa de cambios en la biblioteca, trabajos y bajas"""
+    user = login_test_user(client)
+    bus = app.extensions['betawave'].events
+    heartbeat = app.config['EVENTS_HEARTBEAT']
+    app.config['EVENTS_HEARTBEAT'] = 0.2
+    try:
+        response = client.get('/api/events')
+        assert response.status_code == 200
+        assert response.mimetype == 'text/event-stream'
+        stream = response.iter_encoded()
+
+        def next_event():
+            while True:
+                chunk = next(stream).decode()
+                if not chunk.startswith(':'):
+                    return chunk
+
+        assert 'event: hello' in next_event()
+        assert bus.has_subscribers(user['id'])
+
+        max_subscribers, bus.max_subscribers = bus.max_subscribers, bus.count()
+        try:
+            assert client.get('/api/events').status_code == 503, "Con el límite alcanzado debería rechazar"
+        finally:
+            bus.max_subscribers = max_subscribers
+
+        song_id = add_song("Song", "Artist", "https://youtu.be/events", user['id'])
+        event = next_event()
+        assert 'event: library' in event and '"revision"' in event
+
+        job = app.extensions['betawave'].download_queue.submit(user['id'], lambda job: None)
+        event = next_event()
+        assert 'event: job' in event and job.id in event and '"queue":"download"' in event
+
+        # Un cambio hecho desde otro proceso llega con el siguiente latido
+        conn = sqlite3.connect(app.config['DATABASE'])
+        conn.execute("DELETE FROM songs WHERE id=?", (song_id,))
+        conn.commit()
+        conn.close()
+        assert 'event: library' in next_event()
+
+        bus.publish(user['id'], 'logout')
+        assert 'event: logout' in next_event()
+        response.close()
+        assert not bus.has_subscribers(user['id']), "Al cerrar la conexión debería darse de baja"
+    finally:
+        app.config['EVENTS_HEARTBEAT'] = heartbeat
+
+def test_user_stats_counters(client):
+    """Prueba que los contadores de user_stats siguen a las canciones y favoritos"""
+    from app import get_user_profile
+    from db import get_db
+
+    user = login_test_user(client)
+    ids = [add_song(f"Song {i}", "Artist", f"https://youtu.be/stats{i}", user['id']) for i in range(3)]
+    add_favorite(user['id'], ids[0])
+    add_favorite(user['id'], ids[1])
+    delete_song(ids[1], user['id'])
+
+    profile = get_user_profile(user['id'])
+    assert (profile['songs_count'], profile['favorites_count']) == (2, 1)
+    c = get_db().cursor()
+    c.execute("SELECT COUNT(*) FROM songs WHERE user_id=?", (user['id'],))
+    assert c.fetchone()[0] == profile['songs_count'], "El contador debería coincidir con COUNT(*)"
+    assert profile['username'] == 'testuser' and profile['created_at']
+
+    response = client.get('/profile')
+    assert response.status_code == 200
+
+    c.execute("DELETE FROM users WHERE id=?", (user['id'],))
+    c.execute("SELECT COUNT(*) FROM user_stats WHERE user_id=?", (user['id'],))
+    assert c.fetchone()[0] == 0, "Al borrar el usuario deberían borrarse sus contadores"
+    get_db().rollback()
+
+def test_admin_user_listing(client):
+    """Prueba el listado paginado, filtrado y ordenado de usuarios del panel"""
+    for name in ('alice', 'Albert', 'bob'):
+        add_user(name, 'pass')
+    albert = verify_user('Albert', 'pass')
+    add_song("Song 1", "Artist", "https://youtu.be/admin1", albert['id'])
+    song_id = add_song("Song 2", "Artist", "https://youtu.be/admin2", albert['id'])
+    add_favorite(albert['id'], song_id)
+
+    admin = verify_user('admin', 'admin123')
+    with client.session_transaction() as sess:
+        sess['user_id'] = admin['id']
+        sess['username'] = admin['username']
+        sess['user_role'] = 'admin'
+
+    data = client.get('/admin/api/users?q=al&sort=username&order=asc').get_json()
+    assert [user['username'] for user in data['users']] == ['Albert', 'alice'], \
+        "La búsqueda por prefijo no debería distinguir mayúsculas"
+    assert data['total'] == 2
+    assert (data['users'][0]['songs_count'], data['users'][0]['favorites_count']) == (2, 1)
+
+    data = client.get('/admin/api/users?sort=songs&page_size=1').get_json()
+    assert data['users'][0]['username'] == 'Albert', "Debería ordenar por número de canciones"
+    assert data['pages'] == data['total'] == 5
+    data = client.get('/admin/api/users?sort=created&order=asc&page=2&page_size=2').get_json()
+    assert [user['username'] for user in data['users']] == ['alice', 'Albert']
+
+    assert client.get('/admin/api/users?role=admin').get_json()['total'] == 1
+    assert client.get('/admin/api/users?q=%25').get_json()['total'] == 0, "% debería buscarse literalmente"
+    assert client.get('/admin/api/users?sort=password').status_code == 400
+
+    response = client.get('/admin?q=bo')
+    assert response.status_code == 200
+    assert b'bob' in response.data and b'alice' not in response.data
+
+    # El rol se lee de la base de datos, no de la cookie
+    with client.session_transaction() as sess:
+        sess['user_id'] = albert['id']
+        sess['user_role'] = 'admin'
+    assert client.get('/admin/api/users').status_code != 200
+
+def test_admin_bulk_delete_and_purge(client):
+    """Prueba el borrado masivo de usuarios en cascada y la purga de inactivos"""
+    from app import delete_users, save_user_config
+    from db import get_db
+
+    ids = {}
+    for name in ('ana', 'ben', 'carla', 'dani'):
+        add_user(name, 'pass')
+        ids[name] = verify_user(name, 'pass')['id']
+    ana_song = add_song("Ana", "Artist", "https://youtu.be/bulk-ana", ids['ana'])
+    ben_song = add_song("Ben", "Artist", "https://youtu.be/bulk-ben", ids['ben'])
+    add_favorite(ids['ana'], ana_song)
+    add_favorite(ids['carla'], ben_song)
+    save_user_config(ids['ana'], True, 70)
+
+    admin = verify_user('admin', 'admin123')
+    with client.session_transaction() as sess:
+        sess['user_id'] = admin['id']
+        sess['username'] = admin['username']
+        sess['user_role'] = 'admin'
+
+    response = client.post('/admin/delete_users', json={'userIds': [ids['ana'], ids['ben'], admin['id']]})
+    assert response.get_json() == {'success': True, 'deleted': 2, 'skipped': 1}, \
+        "Los administradores no deberían borrarse"
+    c = get_db().cursor()
+    for table in ('songs', 'user_config'):
+        c.execute(f"SELECT COUNT(*) FROM {table} WHERE user_id IN (?, ?)", (ids['ana'], ids['ben']))
+        assert c.fetchone()[0] == 0, f"Deberían borrarse en cascada las filas de {table}"
+    assert get_favorites(ids['carla']) == [], "Los favoritos de canciones borradas también deberían borrarse"
+    assert verify_user('admin', 'admin123') is not None
+    assert client.post('/admin/delete_users', json={'userIds': 'x'}).status_code == 400
+
+    # Por tandas: cada usuario en su propia transacción
+    assert delete_users([ids['carla'], ids['dani']], chunk_size=1) == [ids['carla'], ids['dani']]
+
+    for name in ('old', 'recent'):
+        add_user(name, 'pass')
+    c.execute("UPDATE users SET last_login_at = '2000-01-01 00:00:00' WHERE username = 'old'")
+    get_db().commit()
+    client.post('/login', data={'username': 'recent', 'password': 'pass'})
+    c.execute("SELECT last_login_at FROM users WHERE username = 'recent'")
+    assert c.fetchone()[0] is not None, "El inicio de sesión debería quedar registrado"
+    with client.session_transaction() as sess:
+        sess['user_id'] = admin['id']
+        sess['user_role'] = 'admin'
+
+    response = client.post('/admin/purge_inactive', json={'days': 365, 'dry_run': True})
+    assert response.get_json()['matched'] == 1 and verify_user('old', 'pass') is not None
+    assert client.post('/admin/purge_inactive', json={'days': 365}).get_json()['deleted'] == 1
+    assert verify_user('old', 'pass') is None and verify_user('recent', 'pass') is not None
+    assert client.post('/admin/purge_inactive', json={'days': 0}).status_code == 400
+    assert client.post('/admin/purge_inactive', json={'days': 5}).status_code == 400, \
+        "Menos días que media vida de la sesión podrían borrar cuentas en uso"
+
+    # Quien sigue con la sesión abierta cuenta como activo al renovarla
+    import time
+    other = client.application.test_client()
+    other.post('/login', data={'username': 'recent', 'password': 'pass'})
+    recent_id = verify_user('recent', 'pass')['id']
+    c.execute("UPDATE users SET last_login_at = '2000-01-01 00:00:00' WHERE id = ?", (recent_id,))
+    c.execute("UPDATE sessions SET expires_at = ? WHERE user_id = ?", (int(time.time()) + 60, recent_id))
+    get_db().commit()
+    client.application.session_interface.forget_users([recent_id])
+    assert other.get('/profile').status_code == 200
+    c.execute("SELECT last_login_at > '2000-01-01 00:00:00' FROM users WHERE id = ?", (recent_id,))
+    assert c.fetchone()[0], "Renovar la sesión debería contar como actividad"
+
+def test_password_policy_and_login_limits(client, app):
+    """Prueba el rehash al iniciar sesión y el límite de intentos"""
+    from werkzeug.security import generate_password_hash
+    from db import get_db
+    from passwords import PasswordPolicy, benchmark, hash_method
+    from ratelimit import AttemptLimiter
+
+    services = app.extensions['betawave']
+    policy = services.password_policy
+    assert hash_method(policy.hash('secreto')) == policy.current_method
+    assert policy.current_method.startswith(app.config['PASSWORD_HASH_METHOD'].split(':')[0])
+
+    # Un hash antiguo se rehace con el método configurado al iniciar sesión
+    add_user('legacy', 'pass')
+    c = get_db().cursor()
+    c.execute("UPDATE users SET password=? WHERE username='legacy'",
+              (generate_password_hash('pass', method='pbkdf2:sha256:1000'),))
+    get_db().commit()
+    assert verify_user('legacy', 'pass') is not None
+    c.execute("SELECT password FROM users WHERE username='legacy'")
+    assert hash_method(c.fetchone()[0]) == policy.current_method, "El hash debería actualizarse"
+
+    result = benchmark('pbkdf2:sha256:1000', seconds=0.05, threads=2)
+    assert result['single_hashes_per_second'] > 0 and result['hashes_per_second_per_core'] > 0
+
+    ip_limiter, user_limiter = services.login_ip_limiter, services.login_user_limiter
+    services.login_ip_limiter = AttemptLimiter(100, 60)
+    services.login_user_limiter = AttemptLimiter(3, 60)
+    try:
+        for _ in range(3):
+            response = client.post('/login', data={'username': 'Legacy', 'password': 'mal'})
+            assert response.status_code == 200
+        response = client.post('/login', data={'username': 'legacy', 'password': 'pass'})
+        assert response.status_code == 429, "Tras varios fallos el usuario debería bloquearse"
+        assert int(response.headers['Retry-After']) > 0
+
+        services.login_ip_limiter = AttemptLimiter(2, 60)
+        for _ in range(5):
+            assert client.post('/login', data={'username': 'testuser', 'password': 'testpass'}).status_code == 302, \
+                "Los inicios de sesión correctos no deberían gastar el límite de la IP"
+        assert client.post('/login', data={'username': 'nadie', 'password': 'mal'}).status_code == 200
+        assert client.post('/login', data={'username': 'otro', 'password': 'mal'}).status_code == 200
+        assert client.post('/login', data={'username': 'testuser', 'password': 'testpass'}).status_code == 429, \
+            "Superado el límite de fallos por IP no debería comprobarse la contraseña"
+    finally:
+        services.login_ip_limiter, services.login_user_limiter = ip_limiter, user_limiter
+
+def test_server_side_sessions(client, app):
+    """Prueba las sesiones en el servidor: token en la cookie, revocación y rol"""
+    import hashlib
+    from db import get_db
+
+    # Sin usuario la sesión va en una cookie firmada y no se guarda en la tabla
+    c = get_db().cursor()
+    c.execute("SELECT COUNT(*) FROM sessions")
+    before = c.fetchone()[0]
+    for _ in range(3):
+        response = client.get('/', follow_redirects=True)
+        assert 'Debes iniciar sesión'.encode() in response.data, "El mensaje flash debería mostrarse"
+    c.execute("SELECT COUNT(*) FROM sessions")
+    assert c.fetchone()[0] == before, "Las sesiones anónimas no deberían guardarse"
+
+    # Las sesiones caducadas se borran periódicamente
+    import sessions as sessions_module
+    get_db().execute("INSERT INTO sessions (id, user_id, data, expires_at) VALUES ('old', NULL, '{}', 0)")
+    get_db().commit()
+    app.session_interface._pruned_at -= sessions_module.PRUNE_INTERVAL
+
+    add_user('victim', 'victimpass')
+    client.post('/login', data={'username': 'victim', 'password': 'victimpass'})
+    c.execute("SELECT COUNT(*) FROM sessions WHERE id='old'")
+    assert c.fetchone()[0] == 0, "La sesión caducada debería haberse borrado"
+    token = client.get_cookie(app.config['SESSION_COOKIE_NAME']).value
+    assert 'victim' not in token and '.' not in token, "La cookie solo debería llevar un token"
+
+    key = hashlib.sha256(token.encode()).hexdigest()
+    c.execute("SELECT user_id FROM sessions WHERE id=?", (key,))
+    user_id = c.fetchone()[0]
+    assert user_id == verify_user('victim', 'victimpass')['id']
+    assert client.get('/profile').status_code == 200
+
+    # Al volver a iniciar sesión el token cambia y el antiguo deja de valer
+    client.post('/login', data={'username': 'victim', 'password': 'victimpass'})
+    new_token = client.get_cookie(app.config['SESSION_COOKIE_NAME']).value
+    assert new_token != token, "El token debería rotar al iniciar sesión"
+    c.execute("SELECT COUNT(*) FROM sessions WHERE id=?", (key,))
+    assert c.fetchone()[0] == 0
+
+    # Un cambio de rol se ve sin volver a iniciar sesión
+    assert client.get('/admin/api/users').status_code != 200
+    get_db().execute("UPDATE users SET role='admin' WHERE id=?", (user_id,))
+    get_db().commit()
+    app.session_interface.forget_users([user_id])
+    assert client.get('/admin/api/users').status_code == 200
+    get_db().execute("UPDATE users SET role='user' WHERE id=?", (user_id,))
+    get_db().commit()
+    app.session_interface.forget_users([user_id])
+    assert client.get('/admin/api/users').status_code != 200, "Quitar el rol debería tener efecto al momento"
+
+    # Borrar al usuario invalida su sesión al momento
+    admin = verify_user('admin', 'admin123')
+    other = app.test_client()
+    with other.session_transaction() as sess:
+        sess['user_id'] = admin['id']
+    assert other.post('/admin/delete_users', json={'userIds': [user_id]}).status_code == 200
+    assert client.get('/profile').status_code == 302, "La sesión de un usuario borrado no debería valer"
+    c.execute("SELECT COUNT(*) FROM sessions WHERE user_id=?", (user_id,))
+    assert c.fetchone()[0] == 0, "Las sesiones deberían borrarse en cascada"
+
+    # Cerrar sesión borra la fila
+    other.get('/logout')
+    c.execute("SELECT COUNT(*) FROM sessions WHERE user_id=?", (admin['id'],))
+    assert c.fetchone()[0] == 0, "Cerrar sesión debería borrar la sesión del servidor"
+
+def test_delete_account_cascades(client):
+    """Prueba que darse de baja borra también los trabajos y sesiones del usuario"""
+    from db import get_db
+
+    user = login_test_user(client)
+    add_song("Song", "Artist", "https://youtu.be/bye", user['id'])
+    get_db().execute("""INSERT INTO jobs (id, queue, user_id, status, created_at)
+                        VALUES ('job-bye', 'download', ?, 'done', 0)""", (user['id'],))
+    get_db().commit()
+
+    response = client.post('/delete_account', data={'current_password': 'testpass'})
+    assert response.status_code == 302
+    c = get_db().cursor()
+    for table in ('users', 'songs', 'jobs', 'sessions'):
+        column = 'id' if table == 'users' else 'user_id'
+        c.execute(f"SELECT COUNT(*) FROM {table} WHERE {column}=?", (user['id'],))
+        assert c.fetchone()[0] == 0, f"No deberían quedar filas del usuario en {table}"
+
+def test_import_has_no_side_effects(tmp_path):
+    """Prueba que importar app no carga yt_dlp ni crea el directorio de datos"""
+    import subprocess
+    app_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    env = dict(os.environ, PYTHONPATH=app_dir)
+    env.pop('DATA_DIR', None)
+    # En un proceso aparte: en este yt_dlp ya lo han cargado otras pruebas
+    output = subprocess.run(
+        [sys.executable, '-c', "import sys, app; print('yt_dlp' in sys.modules)"],
+        cwd=tmp_path, env=env, capture_output=True, text=True, check=True
+    ).stdout.strip()
+    assert output == 'False', "yt_dlp solo debería importarse al usarse"
+    assert list(tmp_path.iterdir()) == [], "Importar app no debería crear data/ ni ningún fichero"
+
+def test_apps_have_separate_services(tmp_path):
+    """Prueba que cada create_app() tiene sus propias cachés, conexiones y límites"""
+    from app import create_app
+
+    apps = [create_app({'TESTING': True, 'DATABASE': str(tmp_path / f'{i}.db'), 'LOG_LEVEL': 'WARNING',
+                        'DOWNLOAD_CACHE_DIR': str(tmp_path / f'cache{i}')}) for i in range(2)]
+    first, second = (app.extensions['betawave'] for app in apps)
+    try:
+        for name in ('stream_cache', 'transcode_cache', 'http_pool', 'prefetch_executor', 'events',
+                     'download_queue', 'import_queue', 'login_ip_limiter', 'login_user_limiter'):
+            assert getattr(first, name) is not getattr(second, name), f"{name} no debería compartirse"
+        assert apps[0].session_interface is not apps[1].session_interface
+
+        limiter = first.login_ip_limiter
+        for _ in range(limiter.max_attempts):
+            limiter.hit('10.0.0.1')
+        assert limiter.blocked('10.0.0.1')
+        assert not second.login_ip_limiter.blocked('10.0.0.1'), "Los límites de una app no deberían afectar a otra"
+        assert not os.path.exists(apps[0].config['DATABASE']), "create_app no debería tocar la base de datos"
+    finally:
+        first.shutdown()
+        second.shutdown()
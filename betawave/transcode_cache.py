@@ -0,0 +1,115 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+TEMP_PREFIX = 'tmp-'
+ORPHAN_MAX_AGE = 3600       # Segundos tras los que un directorio temporal se considera huérfano
+
+
+class TranscodeCache:
+    """
+    Caché en disco de audios ya convertidos, indexada por
+    (id de vídeo, formato, calidad) y limitada en tamaño con expulsión LRU.
+
+    Los ficheros se escriben primero en un directorio temporal dentro de la
+    propia caché y se mueven con os.replace, así nunca se sirve un fichero a
+    medio escribir.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        video_id, format_type, quality = key
+        safe_id = re.sub(r'[^A-Za-z0-9_-]', '_', video_id)
+        return os.path.join(self.root, f'{safe_id}.{quality}.{format_type}')
+
+    def get(self, key):
+        """
+        Devuelve (ruta, título) si el audio está en caché, o None
+        """
+        path = self._path(key)
+        try:
+            with open(path + '.json', encoding='utf-8') as f:
+                title = json.load(f).get('title')
+            # Marcar como usado recientemente para el LRU
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path, title
+
+    def make_temp_dir(self):
+        os.makedirs(self.root, exist_ok=True)
+        self.cleanup_orphans()
+        return tempfile.mkdtemp(prefix=TEMP_PREFIX, dir=self.root)
+
+    def put(self, key, source_path, title):
+        """
+        Mueve source_path a la caché y devuelve su ruta definitiva
+        """
+        path = self._path(key)
+        meta_tmp = source_path + '.json'
+        with open(meta_tmp, 'w', encoding='utf-8') as f:
+            json.dump({'title': title}, f)
+        # El audio primero: el .json es lo que marca la entrada como válida
+        os.replace(source_path, path)
+        os.replace(meta_tmp, path + '.json')
+        self.evict()
+        return path
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and not entry.name.endswith('.json'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        """
+        Borra los audios menos usados hasta quedar por debajo de max_bytes
+        """
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                for victim in (path + '.json', path):
+                    try:
+                        os.remove(victim)
+                    except OSError:
+                        pass
+                total -= size
+
+    def cleanup_orphans(self, max_age=ORPHAN_MAX_AGE):
+        """
+        Elimina directorios temporales de descargas que nunca terminaron
+        """
+        limit = time.time() - max_age
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and entry.name.startswith(TEMP_PREFIX) and entry.stat().st_mtime < limit:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def stats(self):
+        entries = self._entries() if os.path.isdir(self.root) else []
+        with self._lock:
+            return {
+                'files': len(entries),
+                'bytes': sum(size for _, size, _ in entries),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
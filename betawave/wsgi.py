@@ -0,0 +1,10 @@
+"""
+Punto de entrada WSGI para producción:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+La configuración de procesos, hilos y reciclado está en gunicorn.conf.py
+"""
+from app import create_app
+
+app = create_app()